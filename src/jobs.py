@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import Queue
+import threading
+import time
+import traceback
+
+from contextlib import contextmanager
+
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+# Seconds between the attempts of foreground cells to take the connection.
+POLL_SECONDS = 0.05
+
+
+class Job(object):
+    """Handle to a cell submitted for execution on the background worker."""
+
+    def __init__(self, jobid, description, func):
+        self.jobid = jobid
+        self.description = description
+        self.status = PENDING
+        self.result = None
+        self.exception = None
+        self.cancel_requested = False
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self._func = func
+        self._done = threading.Event()
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.
+        end = self.finished if self.finished is not None else time.time()
+        return end - self.started
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Block until the job finishes; returns whether it has finished."""
+        self._done.wait(timeout)
+        return self.done()
+
+    def status_line(self):
+        seconds = int(self.elapsed)
+        summary = ' '.join(self.description.split())
+        if len(summary) > 60:
+            summary = summary[:57] + '...'
+        return 'Job %d [%s %02d:%02d:%02d] %s' % (
+            self.jobid, self.status, seconds // 3600, (seconds // 60) % 60,
+            seconds % 60, summary)
+
+    def __repr__(self):
+        return '<%s>' % (self.status_line(),)
+
+    def _run(self):
+        self.started = time.time()
+        self.status = RUNNING
+        try:
+            self.result = self._func()
+        except Exception:
+            self.exception = traceback.format_exc()
+            self.status = CANCELLED if self.cancel_requested else FAILED
+        else:
+            self.status = DONE
+        finally:
+            self._func = None
+            self.finished = time.time()
+            self._done.set()
+
+    def _skip(self):
+        self.status = CANCELLED
+        self._func = None
+        self.finished = time.time()
+        self._done.set()
+
+
+class JobManager(object):
+    """Runs submitted jobs one at a time on a daemon worker thread.
+
+    All access to the shared bdb connection from cells running in the
+    foreground must go through `exclusive`, so that at most one statement
+    uses the connection at any time. A job holds the connection while it
+    runs, and lends it to the foreground cells waiting in `exclusive` each
+    time it calls `checkpoint`, e.g. between the iterations of an ANALYZE.
+
+    `interrupt` is an optional nullary callable used by `cancel` to abort the
+    statement of a running job, e.g. the `interrupt` method of the SQLite
+    connection.
+    """
+
+    def __init__(self, interrupt=None):
+        self.jobs = []
+        self._interrupt = interrupt
+        self._lock = threading.RLock()
+        self._queue = Queue.Queue()
+        self._worker = None
+        self._current = None
+        # Number of foreground cells waiting for the connection, and whether
+        # the running job has lent it to them, guarded by `_turn`.
+        self._waiting = 0
+        self._lent = False
+        self._turn = threading.Condition(threading.Lock())
+
+    def submit(self, func, description):
+        job = Job(len(self.jobs) + 1, description, func)
+        self.jobs.append(job)
+        self._queue.put(job)
+        if self._worker is None:
+            self._worker = threading.Thread(
+                target=self._work, name='iventure-jobs')
+            self._worker.daemon = True
+            self._worker.start()
+        return job
+
+    def get(self, jobid):
+        if not 1 <= jobid <= len(self.jobs):
+            raise ValueError('No such job: %r' % (jobid,))
+        return self.jobs[jobid - 1]
+
+    def active(self):
+        return [job for job in self.jobs if not job.done()]
+
+    def in_job(self):
+        """Whether the calling thread is running a job."""
+        return self._current is not None \
+            and threading.current_thread() is self._worker
+
+    def cancel(self, jobid):
+        """Cancel a pending job, or interrupt the statement of a running one.
+
+        Returns the job. A running job stops at the next point where the
+        backend checks for interruption, or at its next `checkpoint`,
+        whichever comes first.
+        """
+        job = self.get(jobid)
+        if job.done():
+            return job
+        job.cancel_requested = True
+        with self._turn:
+            # While the job lends the connection, the statement running on it
+            # belongs to a foreground cell.
+            if job.status == RUNNING and not self._lent \
+                    and self._interrupt is not None:
+                self._interrupt()
+        return job
+
+    @contextmanager
+    def exclusive(self):
+        """Context holding the connection for the duration of a statement.
+
+        If a job holds the connection, waits until it finishes or reaches its
+        next `checkpoint`. Interrupting the kernel stops waiting.
+        """
+        with self._turn:
+            self._waiting += 1
+        try:
+            # Poll rather than block, so that the wait can be interrupted.
+            while not self._lock.acquire(False):
+                time.sleep(POLL_SECONDS)
+        finally:
+            with self._turn:
+                self._waiting -= 1
+                self._turn.notify_all()
+        try:
+            yield
+        finally:
+            self._lock.release()
+
+    def checkpoint(self):
+        """Lend the connection to the foreground cells waiting for it.
+
+        Called by the running job between statements, or between the steps
+        of a long one, see `utils_bql.analyze_steps`. Returns once the cells
+        have released the connection, and raises ValueError if the job has
+        been cancelled. Does nothing outside of a job.
+        """
+        if not self.in_job():
+            return
+        job = self._current
+        with self._turn:
+            lend = self._waiting > 0
+            if lend:
+                self._lent = True
+                self._lock.release()
+                while self._waiting:
+                    self._turn.wait()
+        if lend:
+            self._lock.acquire()
+            with self._turn:
+                self._lent = False
+        if job.cancel_requested:
+            raise ValueError('Job %d was cancelled.' % (job.jobid,))
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job.cancel_requested:
+                job._skip()
+                continue
+            with self._lock:
+                self._current = job
+                try:
+                    job._run()
+                finally:
+                    self._current = None
@@ -0,0 +1,65 @@
+//   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+//
+//   Licensed under the Apache License, Version 2.0 (the "License");
+//   you may not use this file except in compliance with the License.
+//   You may obtain a copy of the License at
+//
+//       http://www.apache.org/licenses/LICENSE-2.0
+//
+//   Unless required by applicable law or agreed to in writing, software
+//   distributed under the License is distributed on an "AS IS" BASIS,
+//   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+//   See the License for the specific language governing permissions and
+//   limitations under the License.
+
+window.iventureJsviz = window.iventureJsviz || {};
+
+// Decode a base64 buffer of the given dtype from jsviz into a typed array.
+iventureJsviz.decodeBuffer = function(column) {
+  const TYPES = {
+    f4: Float32Array,
+    f8: Float64Array,
+    u1: Uint8Array,
+    u2: Uint16Array,
+    u4: Uint32Array,
+  };
+  const bytes = atob(column.buffer);
+  const array = new Uint8Array(bytes.length);
+  for (let i = 0; i < bytes.length; i++) {
+    array[i] = bytes.charCodeAt(i);
+  }
+  return new TYPES[column.dtype](array.buffer);
+};
+
+// Decode a frame from jsviz.encode_frame into the "split" format of
+// df.to_json(orient="split"), which the plots take.
+iventureJsviz.decodeFrame = function(frame) {
+  const columns = frame.columns.map(column => {
+    const values = iventureJsviz.decodeBuffer(column);
+    const decoded = new Array(values.length);
+    if (column.categories) {
+      // Codes are offset by one, with zero for missing values.
+      const categories = [null].concat(column.categories);
+      for (let i = 0; i < values.length; i++) {
+        decoded[i] = categories[values[i]];
+      }
+    } else {
+      for (let i = 0; i < values.length; i++) {
+        decoded[i] = isNaN(values[i]) ? null : values[i];
+      }
+    }
+    return decoded;
+  });
+
+  const index = new Array(frame.length);
+  const data = new Array(frame.length);
+  for (let i = 0; i < frame.length; i++) {
+    const row = new Array(columns.length);
+    for (let j = 0; j < columns.length; j++) {
+      row[j] = columns[j][i];
+    }
+    index[i] = i;
+    data[i] = row;
+  }
+  return { columns: frame.names, index, data };
+};
@@ -0,0 +1,137 @@
+//   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+//
+//   Licensed under the Apache License, Version 2.0 (the "License");
+//   you may not use this file except in compliance with the License.
+//   You may obtain a copy of the License at
+//
+//       http://www.apache.org/licenses/LICENSE-2.0
+//
+//   Unless required by applicable law or agreed to in writing, software
+//   distributed under the License is distributed on an "AS IS" BASIS,
+//   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+//   See the License for the specific language governing permissions and
+//   limitations under the License.
+
+// Tiled heatmap of a large matrix kept in the kernel by jsviz.HeatmapTiles.
+// The overview shows the block means of the whole matrix; dragging over a
+// region requests its entries from the kernel over a comm, and double
+// clicking returns to the overview.
+function heatmap_tiles(overview) {
+  var myCell = element.is('.output_subarea') ? element : element.next();
+
+  const size = 600;
+  const { xlabels, ylabels, vmin, vmax } = overview;
+
+  const container = $('<div>').appendTo(myCell.empty());
+  const status = $('<div style="font-size: small; min-height: 1.5em">').appendTo(container);
+  const canvas = $('<canvas>')
+    .attr({ width: size, height: size })
+    .css({ cursor: 'crosshair', border: '1px solid #ccc' })
+    .appendTo(container);
+  const context = canvas[0].getContext('2d');
+
+  // White to green, as the BuGn colormap of the static heatmaps.
+  function color(value) {
+    if (isNaN(value)) {
+      return '#ffffff';
+    }
+    const t = vmax > vmin ? Math.min(Math.max((value - vmin) / (vmax - vmin), 0), 1) : 0;
+    const [r, g, b] = [[247, 0], [252, 68], [253, 27]].map(([from, to]) =>
+      Math.round(from + t * (to - from)));
+    return `rgb(${r},${g},${b})`;
+  }
+
+  let region = null;
+
+  function label(labels, starts, stop, i) {
+    const last = (i + 1 < starts.length ? starts[i + 1] : stop) - 1;
+    return starts[i] === last ? labels[starts[i]] :
+      `${labels[starts[i]]} (+${last - starts[i]})`;
+  }
+
+  function draw(next) {
+    region = next;
+    region.matrix = iventureJsviz.decodeBuffer(region.values);
+    const { xstarts, ystarts } = region;
+    const width = size / xstarts.length;
+    const height = size / ystarts.length;
+    context.clearRect(0, 0, size, size);
+    for (let i = 0; i < ystarts.length; i++) {
+      for (let j = 0; j < xstarts.length; j++) {
+        context.fillStyle = color(region.matrix[i * xstarts.length + j]);
+        context.fillRect(j * width, i * height, Math.ceil(width), Math.ceil(height));
+      }
+    }
+    status.text(
+      `Rows ${region.rows[0]}-${region.rows[1] - 1} and columns ` +
+      `${region.columns[0]}-${region.columns[1] - 1} of ` +
+      `${ylabels.length} x ${xlabels.length}` +
+      (xstarts.length < region.columns[1] - region.columns[0] ||
+       ystarts.length < region.rows[1] - region.rows[0] ?
+        ', as block means; drag to zoom in' : ''));
+  }
+
+  function cell(event) {
+    const offset = canvas.offset();
+    const { xstarts, ystarts } = region;
+    return [
+      Math.min(Math.floor((event.pageY - offset.top) / size * ystarts.length), ystarts.length - 1),
+      Math.min(Math.floor((event.pageX - offset.left) / size * xstarts.length), xstarts.length - 1),
+    ];
+  }
+
+  const kernel = window.Jupyter && Jupyter.notebook && Jupyter.notebook.kernel;
+  const comm = kernel ? kernel.comm_manager.new_comm(overview.target, {}) : null;
+  if (comm) {
+    comm.on_msg(msg => {
+      const data = msg.content.data;
+      if (data.error) {
+        status.text(data.error);
+      } else {
+        draw(data);
+      }
+    });
+  }
+
+  function request(rows, columns) {
+    if (!comm) {
+      status.text('Zooming requires a connection to the kernel.');
+      return;
+    }
+    status.text('Loading...');
+    comm.send({ id: overview.id, rows, columns });
+  }
+
+  let dragStart = null;
+  canvas.on('mousedown', event => { dragStart = cell(event); });
+  canvas.on('mouseup', event => {
+    if (!dragStart) {
+      return;
+    }
+    const dragEnd = cell(event);
+    const { xstarts, ystarts } = region;
+    const [i0, i1] = [dragStart[0], dragEnd[0]].sort((a, b) => a - b);
+    const [j0, j1] = [dragStart[1], dragEnd[1]].sort((a, b) => a - b);
+    dragStart = null;
+    if (i0 === i1 && j0 === j1 &&
+        ystarts.length === region.rows[1] - region.rows[0] &&
+        xstarts.length === region.columns[1] - region.columns[0]) {
+      return;
+    }
+    const stop = (starts, end, k) => k + 1 < starts.length ? starts[k + 1] : end;
+    request(
+      [ystarts[i0], stop(ystarts, region.rows[1], i1)],
+      [xstarts[j0], stop(xstarts, region.columns[1], j1)]);
+  });
+  canvas.on('dblclick', () => draw(overview));
+  canvas.on('mousemove', event => {
+    const [i, j] = cell(event);
+    const { xstarts, ystarts } = region;
+    canvas.attr('title',
+      `${label(ylabels, ystarts, region.rows[1], i)}\n` +
+      `${label(xlabels, xstarts, region.columns[1], j)}\n` +
+      `${region.matrix[i * xstarts.length + j]}`);
+  });
+
+  draw(overview);
+}
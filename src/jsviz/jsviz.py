@@ -15,31 +15,137 @@
 #   limitations under the License.
 
 
+import base64
 import json
+import uuid
 
-from pkg_resources import resource_string
+from collections import OrderedDict
 
 import numpy as np
+import pandas as pd
+
+from pkg_resources import resource_string
 
 from IPython.display import Javascript
 
 from iventure import utils_plot
 
 
+# Interactive scatter plots send at most this many points by default.
+INTERACTIVE_MAX_POINTS = 10000
+
+# Heatmaps of more variables than this are tiled, see `HeatmapTiles`.
+TILE_THRESHOLD = 500
+# Number of blocks per side of the regions of a tiled heatmap.
+TILE_SIZE = 256
+# Number of tiled heatmaps kept in the kernel to serve their regions.
+TILED_HEATMAPS = 8
+# Target of the comms over which tiled heatmaps request their regions.
+TILES_TARGET = 'iventure_heatmap_tiles'
+
+# Pairplots of more rows than this are aggregated, see `pairplot_aggregates`.
+PAIRPLOT_MAX_ROWS = 10000
+# Number of bins of numerical variables in aggregated pairplots.
+PAIRPLOT_BINS = 20
+# Number of values of nominal variables in aggregated pairplots.
+PAIRPLOT_CATEGORIES = 20
+# Label of the less frequent values of nominal variables, counted together.
+OTHER = '(other)'
+
+# Plots defined under `iventureJsviz`, see `runtime`.
+PLOTS = [
+    'bar', 'heatmap', 'heatmap_tiles', 'pairplot', 'pairplot_aggregates',
+    'scatter',
+]
+
+# Tiled heatmaps by id, and whether their comm target is registered.
+_TILED = OrderedDict()
+_tiles_registered = False
+
+
 def enable_inline():
     """Enable inline JavaScript code to execute in an iventure notebook."""
     js_src = resource_string('iventure.jsviz', 'inline.js')
-    return Javascript(js_src)
+    return Javascript(js_src + ';' + runtime())
+
+def runtime(plots=PLOTS):
+    """Return the JavaScript defining `plots` under `iventureJsviz`.
+
+    Each plot is defined as a function of the output element of its cell,
+    returning the plotting function of its source. Definitions are skipped
+    when the page already has them, so every output can carry the runtime of
+    its plot and still render after a reload or in a reopened notebook.
+    """
+    sources = ['if (!window.iventureJsviz || !iventureJsviz.decodeFrame) {\n'
+        '%s\n}' % (resource_string('iventure.jsviz', 'frame.js'),)]
+    for plot in plots:
+        sources.append(
+            'if (!iventureJsviz.%s) {\n'
+            'iventureJsviz.%s = function(element) {\n%s\nreturn %s;\n};\n'
+            '}' % (
+                plot, plot,
+                resource_string('iventure.jsviz', '%s.js' % (plot,)), plot))
+    return '\n'.join(sources)
+
+def encode_frame(df):
+    """Return df as typed column buffers, for `iventureJsviz.decodeFrame`.
+
+    Numerical columns are sent as little-endian floats, in single precision
+    when it represents all their values exactly, e.g. integers up to 2**24,
+    and otherwise in double precision so the plots show the values as they
+    are in the kernel. Other columns are sent as the list of their distinct
+    values, with the code of each row offset by one, zero for missing values,
+    in the smallest unsigned integer type that fits. Buffers are base64.
+    """
+    columns = []
+    for i in xrange(df.shape[1]):
+        values = df.iloc[:,i]
+        if values.dtype.kind in 'iuf':
+            data = values.values.astype('<f8')
+            single = data.astype('<f4')
+            exact = (single == data) | (np.isnan(single) & np.isnan(data))
+            if exact.all():
+                (dtype, data) = ('f4', single)
+            else:
+                dtype = 'f8'
+            columns.append({'dtype': dtype, 'buffer': _base64(data)})
+        else:
+            codes, categories = pd.factorize(values)
+            dtype = 'u1' if len(categories) < 2**8 \
+                else 'u2' if len(categories) < 2**16 else 'u4'
+            columns.append({
+                'dtype': dtype,
+                'buffer': _base64((codes + 1).astype('<' + dtype)),
+                'categories': _json_values(categories),
+            })
+    return {
+        'names': _json_values(df.columns),
+        'length': len(df),
+        'columns': columns,
+    }
+
+def _base64(array):
+    return base64.b64encode(np.ascontiguousarray(array).tobytes())
+
+def _json_values(values):
+    return json.loads(pd.Series(values).to_json(orient='values'))
+
+def _frame(df):
+    """Return the JavaScript expression of df in "split" format."""
+    return 'iventureJsviz.decodeFrame(%s)' % (json.dumps(encode_frame(df)),)
+
+def _plot(plot, *args):
+    """Return the call of `plot` on the JavaScript expressions `args`.
+
+    The call is preceded by the runtime of `plot`, which the page evaluates
+    only if it is not loaded yet, so each output renders on its own.
+    """
+    call = 'iventureJsviz.%s(element)(%s)' % (plot, ', '.join(args))
+    return Javascript(runtime([plot]) + '\n' + call)
 
 def interactive_bar(df):
     """Create an interactive barplot visualization."""
-    js_src = resource_string('iventure.jsviz', 'bar.js')
-    return Javascript(
-        js_src \
-        + ';bar(' \
-        + df.to_json(orient='split') \
-        + ')'
-    )
+    return _plot('bar', _frame(df))
 
 def interactive_depprob(df_dep, df_data=None, schema=None):
     """Create an interactive dependence probability visualization."""
@@ -65,47 +171,232 @@ def interactive_depprob(df_dep, df_data=None, schema=None):
             + ')'
         )
 
-def interactive_heatmap(df):
-    """Create an interactive heatmap visualization."""
-    js_src = resource_string('iventure.jsviz', 'heatmap.js')
-
-    pivot = df.pivot(
-        index=df.columns[-3],
-        columns=df.columns[-2],
-        values=df.columns[-1],
-    )
-    pivot.fillna(0, inplace=True)
-    D = pivot.as_matrix()
-    ordering = utils_plot._clustermap_ordering(D)
-    labels = list(np.asarray(pivot.columns)[ordering[0]])
-    return Javascript(
-        js_src \
-        + 'heatmap(' \
-        + df.to_json(orient='split') \
-        + ',' \
-        + json.dumps(labels) \
-        + ')'
-    )
-
-def interactive_pairplot(df, schema):
-    """Create an interactive pairplot visualization."""
-    js_src = resource_string('iventure.jsviz', 'pairplot.js')
-    return Javascript(
-        js_src \
-        + ';pairplot(' \
-        + df.to_json(orient='split') \
-        + ',' \
-        + json.dumps(schema) \
-        + ')'
-    )
-
-def interactive_scatter(df):
-    """Create an interactive scatter plot visualization."""
+def interactive_heatmap(df, tiled=None):
+    """Create an interactive heatmap visualization.
+
+    The `df` is a tidy data frame, as for `utils_plot.heatmap`, or a
+    `utils_plot.PairwiseMatrix`.
+
+    Matrices of more than `TILE_THRESHOLD` variables, or any matrix when
+    `tiled` is set, are kept in the kernel as `HeatmapTiles`: the browser
+    receives an overview, and requests the entries of the regions that the
+    user zooms into over a Jupyter comm.
+    """
+    matrix = utils_plot.PairwiseMatrix.coerce(df)
+    if tiled is None:
+        tiled = max(matrix.values.shape) > TILE_THRESHOLD
+    if tiled:
+        tiles = HeatmapTiles(matrix)
+        return _plot('heatmap_tiles', json.dumps(tiles.overview()))
+    if df is matrix:
+        df = matrix.to_tidy()
+    ordering = utils_plot.matrix_ordering(matrix.values)
+    labels = matrix.columns[ordering[0]].tolist()
+    return _plot('heatmap', _frame(df), json.dumps(labels))
+
+class HeatmapTiles(object):
+    """Clustered matrix of a tiled interactive heatmap, kept in the kernel.
+
+    Regions of the matrix are sent as the means of at most `size` by `size`
+    blocks of entries, so the overview is a coarse picture of the matrix and
+    zooming into a region of at most `size` variables shows its entries.
+    The most recent `TILED_HEATMAPS` matrices are kept to serve requests.
+    """
+
+    def __init__(self, matrix, size=TILE_SIZE):
+        (xordering, yordering) = utils_plot.matrix_ordering(matrix.values)
+        self.values = matrix.values[np.ix_(yordering, xordering)]
+        self.xlabels = matrix.columns[xordering].tolist()
+        self.ylabels = matrix.index[yordering].tolist()
+        self.unit = matrix.is_unit()
+        self.size = size
+        self.id = uuid.uuid4().hex
+        _TILED[self.id] = self
+        while len(_TILED) > TILED_HEATMAPS:
+            _TILED.popitem(last=False)
+        _register_tiles_target()
+
+    def overview(self):
+        """Return the whole matrix as a region, with its labels."""
+        (rows, columns) = self.values.shape
+        overview = self.region(0, rows, 0, columns)
+        overview.update({
+            'id': self.id,
+            'target': TILES_TARGET,
+            'xlabels': _json_values(self.xlabels),
+            'ylabels': _json_values(self.ylabels),
+            'vmin': 0. if self.unit else float(np.nanmin(self.values)),
+            'vmax': 1. if self.unit else float(np.nanmax(self.values)),
+        })
+        return overview
+
+    def region(self, row0, row1, column0, column1):
+        """Return the block means of the rows [row0, row1) and the columns
+        [column0, column1), with the first row and column of each block."""
+        (rows, columns) = self.values.shape
+        row0, row1 = max(int(row0), 0), min(int(row1), rows)
+        column0, column1 = max(int(column0), 0), min(int(column1), columns)
+        if not (row0 < row1 and column0 < column1):
+            raise ValueError('Empty region: rows %d:%d, columns %d:%d' %
+                (row0, row1, column0, column1))
+        ystarts = _block_starts(row0, row1, self.size)
+        xstarts = _block_starts(column0, column1, self.size)
+        D = self.values[row0:row1, column0:column1]
+        present = ~np.isnan(D)
+        sums = np.add.reduceat(np.add.reduceat(
+            np.where(present, D, 0), ystarts - row0, axis=0),
+            xstarts - column0, axis=1)
+        counts = np.add.reduceat(np.add.reduceat(
+            present.astype(int), ystarts - row0, axis=0),
+            xstarts - column0, axis=1)
+        with np.errstate(invalid='ignore'):
+            means = sums / counts
+        return {
+            'rows': [row0, row1],
+            'columns': [column0, column1],
+            'ystarts': ystarts.tolist(),
+            'xstarts': xstarts.tolist(),
+            'values': {
+                'dtype': 'f4', 'buffer': _base64(means.astype('<f4')),
+            },
+        }
+
+def _block_starts(start, stop, size):
+    """Return the starts of at most `size` equal blocks of [start, stop)."""
+    return np.unique(np.linspace(start, stop, min(stop - start, size) + 1)
+        .astype(int)[:-1])
+
+def _register_tiles_target():
+    """Register the kernel side of the comms of tiled heatmaps, if any."""
+    global _tiles_registered
+    from IPython import get_ipython
+    shell = get_ipython()
+    if _tiles_registered or getattr(shell, 'kernel', None) is None:
+        return
+    shell.kernel.comm_manager.register_target(TILES_TARGET, _open_tiles)
+    _tiles_registered = True
+
+def _open_tiles(comm, _msg):
+    @comm.on_msg
+    def _request(msg):
+        request = msg['content']['data']
+        tiles = _TILED.get(request.get('id'))
+        if tiles is None:
+            comm.send({'error': 'The heatmap has expired: re-run its cell.'})
+            return
+        try:
+            comm.send(tiles.region(*(request['rows'] + request['columns'])))
+        except ValueError as e:
+            comm.send({'error': str(e)})
+
+def interactive_pairplot(df, schema, aggregate=None):
+    """Create an interactive pairplot visualization.
+
+    Pairplots of more than `PAIRPLOT_MAX_ROWS` rows, or any pairplot when
+    `aggregate` is set, are drawn from the counts of `pairplot_aggregates`
+    instead of from every row.
+    """
+    if aggregate is None:
+        aggregate = len(df) > PAIRPLOT_MAX_ROWS
+    if aggregate:
+        return _plot('pairplot_aggregates',
+            json.dumps(pairplot_aggregates(df, schema)))
+    return _plot('pairplot', _frame(df), json.dumps(schema))
+
+def pairplot_aggregates(df, schema, bins=PAIRPLOT_BINS,
+        categories=PAIRPLOT_CATEGORIES):
+    """Return the counts of the variables of df and of their pairs.
+
+    Numerical variables of `schema` are binned in `bins` equal bins of their
+    range, and other variables keep their `categories` most frequent values,
+    counting the others together as OTHER. For each variable the counts of
+    its bins or values are returned, and for each pair of variables the
+    counts of the pairs of bins or values of the rows: a 2D histogram of two
+    numerical variables, a histogram of a numerical variable for each value
+    of a nominal one, or a contingency table of two nominal variables.
+    Missing values are left out.
+    """
+    stattypes = {entry['name']: entry['stat_type'] for entry in schema}
+    variables = []
+    codes = []
+    for i in xrange(df.shape[1]):
+        values = df.iloc[:,i]
+        if stattypes.get(df.columns[i]) in ('numerical', 'realAdditive'):
+            (variable, code) = _bin_numerical(values, bins)
+        else:
+            (variable, code) = _bin_nominal(values, categories)
+        variable['name'] = _json_values([df.columns[i]])[0]
+        variable['counts'] = _counts(
+            code, variable['levels'], np.zeros(len(code), dtype=int), 1)
+        variables.append(variable)
+        codes.append(code)
+    pairs = []
+    for i in xrange(len(codes)):
+        for j in xrange(i):
+            pairs.append({
+                'y': i,
+                'x': j,
+                'counts': _counts(codes[i], variables[i]['levels'],
+                    codes[j], variables[j]['levels']),
+            })
+    return {'rows': len(df), 'variables': variables, 'pairs': pairs}
+
+def _bin_numerical(values, bins):
+    values = np.asarray(values, dtype=float)
+    present = ~np.isnan(values)
+    if present.any():
+        low, high = values[present].min(), values[present].max()
+    else:
+        low, high = 0., 1.
+    if low == high:
+        low, high = low - .5, high + .5
+    edges = np.linspace(low, high, bins + 1)
+    code = np.full(len(values), -1, dtype=int)
+    code[present] = np.minimum(
+        ((values[present] - low) / (high - low) * bins).astype(int), bins - 1)
+    variable = {
+        'stat_type': 'numerical',
+        'levels': bins,
+        'edges': edges.tolist(),
+    }
+    return (variable, code)
+
+def _bin_nominal(values, categories):
+    code, uniques = pd.factorize(values, sort=True)
+    frequency = np.bincount(code[code >= 0], minlength=len(uniques))
+    if len(uniques) > categories:
+        kept = np.sort(np.argsort(-frequency, kind='mergesort')[:categories])
+        recode = np.full(len(uniques), categories, dtype=int)
+        recode[kept] = np.arange(categories)
+        code = np.where(code >= 0, recode[code], -1)
+        labels = _json_values(uniques[kept]) + [OTHER]
+    else:
+        labels = _json_values(uniques)
+    variable = {
+        'stat_type': 'nominal',
+        'levels': len(labels),
+        'categories': labels,
+    }
+    return (variable, code)
+
+def _counts(ycode, ylevels, xcode, xlevels):
+    """Return the counts of the pairs of codes, as a base64 buffer."""
+    present = (ycode >= 0) & (xcode >= 0)
+    counts = np.bincount(
+        ycode[present] * xlevels + xcode[present],
+        minlength=ylevels * xlevels)
+    return {'dtype': 'u4', 'buffer': _base64(counts.astype('<u4'))}
+
+def interactive_scatter(df, max_points=None):
+    """Create an interactive scatter plot visualization.
+
+    At most `max_points` points are sent to the browser, by default
+    `INTERACTIVE_MAX_POINTS`, see `utils_plot.downsample_points`.
+    """
     df.dropna(inplace=True)
-    js_src = resource_string('iventure.jsviz', 'scatter.js')
-    return Javascript(
-        js_src \
-        + ';scatter(' \
-        + df.to_json(orient='split') \
-        + ')'
-    )
+    if max_points is None:
+        max_points = INTERACTIVE_MAX_POINTS
+    total = len(df)
+    df, dropped = utils_plot.downsample_points(df, int(max_points))
+    note = utils_plot.downsample_note(total, dropped) if dropped else ''
+    return _plot('scatter', _frame(df), json.dumps(note))
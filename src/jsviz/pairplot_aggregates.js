@@ -0,0 +1,138 @@
+//   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+//
+//   Licensed under the Apache License, Version 2.0 (the "License");
+//   you may not use this file except in compliance with the License.
+//   You may obtain a copy of the License at
+//
+//       http://www.apache.org/licenses/LICENSE-2.0
+//
+//   Unless required by applicable law or agreed to in writing, software
+//   distributed under the License is distributed on an "AS IS" BASIS,
+//   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+//   See the License for the specific language governing permissions and
+//   limitations under the License.
+
+// Pairplot drawn from the counts of jsviz.pairplot_aggregates. The diagonal
+// shows the histogram of each variable. Below and above it, each panel shades
+// the counts of the pairs of bins or values of two variables; the histogram
+// of a numerical variable for each value of a nominal one is shaded relative
+// to its own maximum, so the shapes of rare values remain visible.
+function pairplot_aggregates(aggregates) {
+  var myCell = element.is('.output_subarea') ? element : element.next();
+
+  const { variables, pairs, rows } = aggregates;
+  const k = variables.length;
+  const panel = Math.max(60, Math.min(160, Math.floor(900 / k)));
+
+  for (const variable of variables) {
+    variable.counts = iventureJsviz.decodeBuffer(variable.counts);
+  }
+  const counts = {};
+  for (const pair of pairs) {
+    counts[[pair.y, pair.x]] = iventureJsviz.decodeBuffer(pair.counts);
+  }
+
+  function level(variable, i) {
+    if (variable.stat_type === 'nominal') {
+      return `${variable.categories[i]}`;
+    }
+    const [low, high] = [variable.edges[i], variable.edges[i + 1]];
+    return `${+low.toPrecision(4)} to ${+high.toPrecision(4)}`;
+  }
+
+  // Returns the count of level i of variable y and level j of variable x.
+  function count(y, x, i, j) {
+    if (y > x) {
+      return counts[[y, x]][i * variables[x].levels + j];
+    }
+    return counts[[x, y]][j * variables[y].levels + i];
+  }
+
+  const container = $('<div>').appendTo(myCell.empty());
+  $('<div style="font-size: small">')
+    .text(`Counts of ${rows} rows`)
+    .appendTo(container);
+  const grid = $('<table style="border-collapse: collapse">').appendTo(container);
+
+  const header = $('<tr>').appendTo(grid);
+  $('<th>').appendTo(header);
+  for (const variable of variables) {
+    $('<th style="font-size: small; text-align: center">').text(variable.name).appendTo(header);
+  }
+
+  function histogram(canvas, x) {
+    const context = canvas.getContext('2d');
+    const variable = variables[x];
+    const max = Math.max(...variable.counts, 1);
+    const width = panel / variable.levels;
+    context.fillStyle = 'rgb(65,105,225)';
+    for (let i = 0; i < variable.levels; i++) {
+      const height = variable.counts[i] / max * (panel - 2);
+      context.fillRect(i * width + 0.5, panel - height, Math.max(width - 1, 1), height);
+    }
+    return (i, j) => `${variable.name}: ${level(variable, j)}\ncount: ${variable.counts[j]}`;
+  }
+
+  function shade(canvas, y, x) {
+    const context = canvas.getContext('2d');
+    const [vy, vx] = [variables[y], variables[x]];
+    // Normalize each value of a nominal variable against a numerical one.
+    const byRow = vy.stat_type === 'nominal' && vx.stat_type === 'numerical';
+    const byColumn = vx.stat_type === 'nominal' && vy.stat_type === 'numerical';
+    const rowMax = new Array(vy.levels).fill(0);
+    const columnMax = new Array(vx.levels).fill(0);
+    let max = 0;
+    for (let i = 0; i < vy.levels; i++) {
+      for (let j = 0; j < vx.levels; j++) {
+        const c = count(y, x, i, j);
+        rowMax[i] = Math.max(rowMax[i], c);
+        columnMax[j] = Math.max(columnMax[j], c);
+        max = Math.max(max, c);
+      }
+    }
+    const width = panel / vx.levels;
+    const height = panel / vy.levels;
+    for (let i = 0; i < vy.levels; i++) {
+      for (let j = 0; j < vx.levels; j++) {
+        const c = count(y, x, i, j);
+        if (!c) {
+          continue;
+        }
+        const scale = byRow ? rowMax[i] : byColumn ? columnMax[j] : max;
+        // The square root keeps sparse regions visible next to dense ones.
+        const t = Math.sqrt(c / scale);
+        context.fillStyle = `rgba(65,105,225,${0.1 + 0.9 * t})`;
+        // Numerical variables increase upwards.
+        const row = vy.stat_type === 'numerical' ? vy.levels - 1 - i : i;
+        context.fillRect(j * width, row * height, Math.ceil(width), Math.ceil(height));
+      }
+    }
+    return (i, j) => {
+      if (vy.stat_type === 'numerical') {
+        i = vy.levels - 1 - i;
+      }
+      return `${vy.name}: ${level(vy, i)}\n${vx.name}: ${level(vx, j)}\n` +
+        `count: ${count(y, x, i, j)}`;
+    };
+  }
+
+  for (let y = 0; y < k; y++) {
+    const tr = $('<tr>').appendTo(grid);
+    $('<th style="font-size: small; text-align: right; padding-right: 0.5em">')
+      .text(variables[y].name).appendTo(tr);
+    for (let x = 0; x < k; x++) {
+      const canvas = $('<canvas>')
+        .attr({ width: panel, height: panel })
+        .css({ border: '1px solid #ddd', display: 'block' });
+      $('<td style="padding: 1px">').append(canvas).appendTo(tr);
+      const describe = y === x ? histogram(canvas[0], x) : shade(canvas[0], y, x);
+      const levels = [y === x ? 1 : variables[y].levels, variables[x].levels];
+      canvas.on('mousemove', event => {
+        const offset = canvas.offset();
+        const i = Math.min(Math.floor((event.pageY - offset.top) / panel * levels[0]), levels[0] - 1);
+        const j = Math.min(Math.floor((event.pageX - offset.left) / panel * levels[1]), levels[1] - 1);
+        canvas.attr('title', describe(i, j));
+      });
+    }
+  }
+}
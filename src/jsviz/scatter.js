@@ -12,7 +12,7 @@
 //   See the License for the specific language governing permissions and
 //   limitations under the License.
 
-function scatter(df) {
+function scatter(df, note) {
   var myCell = element.is('.output_subarea') ? element : element.next();
 
   // Validate input format.  It should be a pandas dataframe in "split" format:
@@ -49,6 +49,9 @@ function scatter(df) {
 
   const middleContainer = $('<div style="display: flex; flex-direction: column">').appendTo(container);
   middleContainer.append($('<div style="text-align: center; font-weight: bold">').text(xName));
+  if (note) {
+    middleContainer.append($('<div style="text-align: center; font-style: italic">').text(note));
+  }
 
   VizGPMReady
   .then(VizGPM => {
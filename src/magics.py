@@ -14,10 +14,11 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-import StringIO
 import argparse
 import getpass
+import hashlib
 import json
+import os
 import re
 import shlex
 import socket
@@ -45,7 +46,6 @@ from bayeslite.core import bayesdb_has_generator
 from bayeslite.core import bayesdb_has_population
 from bayeslite.core import bayesdb_variable_name
 from bayeslite.core import bayesdb_variable_number
-from bayeslite.parse import bql_string_complete_p
 from bayeslite.util import casefold
 from bayeslite.util import cursor_value
 
@@ -61,14 +61,21 @@ from IPython.core.magic import line_cell_magic
 from IPython.core.magic import line_magic
 from IPython.core.magic import magics_class
 from IPython.display import display_html
+from IPython.display import display_png
 
+from iventure.jobs import DONE
+from iventure.jobs import FAILED
+from iventure.jobs import JobManager
+from iventure.sessions import DBLogger
 from iventure.sessions import LogEntry
 from iventure.sessions import Session
 from iventure.sessions import TextLogger
 
+from iventure import sessions
 from iventure import utils_bql
 from iventure import utils_mml
 from iventure import utils_plot
+from iventure import utils_profile
 from iventure import utils_sql
 from iventure.jsviz import jsviz
 
@@ -151,11 +158,19 @@ class VentureMagics(Magics):
         self._riplseed = None
         # self._ripl.set_mode('church_prime')
         self._venturescript = []
-        # TODO add SQLLogger
         # TODO cache stderr in a better way.
         username = '%s@%s' % (getpass.getuser(), socket.getfqdn())
         self.session = Session(username, [TextLogger()], '.iventure_logs')
         self.session.stderr_cache = None
+        # Background jobs, and the rule serializing access to self._bdb.
+        self._jobs = JobManager(interrupt=self._interrupt_bdb)
+        # Results of read-only BQL queries, invalidated by any other statement.
+        self._cache = utils_bql.QueryCache()
+        # Column profiles of tables, discarded with the cached results.
+        self._profiles = utils_profile.ProfileCache(
+            lambda: self._cache.generation)
+        # Rendered figures of slow plots, keyed on the digest of their data.
+        self._figures = utils_plot.FigureCache()
         # Display entire dataframe.
         pd.set_option('display.max_rows', None)
         pd.set_option('display.max_columns', None)
@@ -178,6 +193,56 @@ class VentureMagics(Magics):
             cell if cell is not None else ''
         ])
 
+    def _interrupt_bdb(self):
+        if self._bdb is not None:
+            self._bdb._sqlite3.interrupt()
+
+    def _parse_flags(self, line, allowed):
+        """Strip the leading flags from the line of a magic.
+
+        Recognizes the flags in `_FLAGS`, and returns the remaining line with
+        a dict of the flags, raising an error for any flag not in `allowed`.
+        """
+        flags = {}
+        while True:
+            tokens = line.split(None, 1)
+            if not tokens:
+                break
+            match = re.match(r'^--(\w+)(?:=(\S+))?$', tokens[0])
+            if match is None or match.group(1) not in self._FLAGS:
+                break
+            flag, value = match.groups()
+            if flag not in allowed:
+                raise ValueError('Flag not supported here: --%s' % (flag,))
+            convert = self._FLAGS[flag]
+            if (convert is None) != (value is None):
+                raise ValueError('Invalid flag: %s' % (tokens[0],))
+            flags[flag] = True if convert is None else convert(value)
+            line = tokens[1] if len(tokens) == 2 else ''
+        if flags.get('stream') and 'chunksize' not in flags:
+            flags['chunksize'] = self._CHUNKSIZE
+        if flags.get('background') and flags.get('chunksize'):
+            raise ValueError('Cannot stream the result of a background job.')
+        if flags.get('into') and flags.get('chunksize'):
+            raise ValueError('Cannot both stream and store the result.')
+        return (line, flags)
+
+    def _check_result_flags(self, cmds, flags):
+        """Raise an error if `flags` apply to the result of a dot command."""
+        cmds = [cmd for cmd in cmds if cmd and not cmd.isspace()]
+        if cmds and cmds[-1].startswith('.'):
+            for flag in ['stream', 'chunksize', 'into']:
+                if flags.get(flag):
+                    raise ValueError(
+                        'Flag not supported on a dot command: --%s' % (flag,))
+
+    def _execute(self, func, background, description):
+        """Run `func` on the kernel thread, or submit it as a job."""
+        if background:
+            return self._jobs.submit(func, description)
+        with self._jobs.exclusive():
+            return func()
+
     def write_stderr(self, content):
         sys.stderr.write(content)
         self.session.stderr_cache = content
@@ -203,7 +268,7 @@ class VentureMagics(Magics):
                 try:
                     exception = self.session.stderr_cache
                     self.session.log(
-                        LogEntry(func.__name__, raw, None, exception))
+                        LogEntry(func.__name__, raw, output, exception))
                     self.session.stderr_cache = None
                 except IOError:
                     pass
@@ -259,9 +324,13 @@ class VentureMagics(Magics):
         parser.add_argument('-s', type=int, default=0, help='Seed.')
         parser.add_argument('-j', action='store_true', help='Multiprocessing.')
         args = parser.parse_args(line.split())
+        if self._jobs.active():
+            raise ValueError('Cannot close %s with background jobs running.'
+                % (self._path,))
         if self._bdb is not None:
             self._bdb.close()
             self._bdb = None
+        self._cache.clear()
 
         self._path = args.path
         seed = struct.pack('<QQQQ', 0, 0, 0, args.s)
@@ -307,96 +376,316 @@ class VentureMagics(Magics):
             if len(args.args) == 0:
                 raise ValueError('Specify <path> for loom.')
             loom_store_path = args.args[0]
-            bayesdb_register_backend(self._bdb,
-                LoomBackend(loom_store_path=loom_store_path))
+            with self._jobs.exclusive():
+                bayesdb_register_backend(self._bdb,
+                    LoomBackend(loom_store_path=loom_store_path))
         else:
             raise ValueError('Unknown backend: %s' % (args.backend,))
 
     @logged_cell
     @line_cell_magic
     def sql(self, line, cell=None):
+        line, flags = self._parse_flags(line, ['chunksize', 'into', 'stream'])
         if cell is None:
             ucmds = [line]
         else:
-            ucmds = cell.split(';')
+            ucmds = utils_bql.split_statements(cell)
         cmds = [ucmd.encode('US-ASCII').strip() for ucmd in ucmds]
-        cursor = None
-        for cmd in cmds:
-            if cmd.isspace() or len(cmd) == 0:
-                continue
-            if cmd.startswith('.'):
-                self._cmd(cmd, sql=True)
-                cursor = None
-            else:
-                cursor = self._bdb.sql_execute(cmd)
-        return utils_bql.cursor_to_df(cursor) if cursor else None
+        self._check_result_flags(cmds, flags)
+        with self._jobs.exclusive():
+            cursor = None
+            for cmd in cmds:
+                if cmd.isspace() or len(cmd) == 0:
+                    continue
+                if cmd.startswith('.'):
+                    self._cmd(cmd, sql=True)
+                    cursor = None
+                else:
+                    self._cache.observe(cmd)
+                    cursor = self._bdb.sql_execute(cmd)
+            if cursor is None:
+                return None
+            if flags.get('into'):
+                return self._store(cursor, flags['into'])
+            if flags.get('chunksize'):
+                return utils_bql.ResultStream(cursor, flags['chunksize'],
+                    exclusive=self._jobs.exclusive)
+            return utils_bql.cursor_to_df(cursor)
 
     @logged_cell
     @line_cell_magic
     def mml(self, line, cell=None):
+        line, flags = self._parse_flags(line, ['background'])
+        background = flags.get('background', False)
         if cell is None:
             ucmds = [line]
         else:
             ucmds = cell.split('\n')
         cmds = [ucmd.encode('US-ASCII') for ucmd in ucmds]
-        cmd_q = None
-        bql_q = []
-        for cmd in cmds:
+        if background and any(cmd.startswith('.') for cmd in cmds):
+            raise ValueError('Dot commands cannot run in the background.')
+        def execute():
+            cmd_q = None
+            bql_q = []
+            for cmd in cmds:
+                assert not cmd_q or not bql_q
+                if cmd.isspace() or not cmd:
+                    continue
+                if cmd_q:
+                    self._cmd(cmd_q)
+                    cmd_q = None
+                if cmd.startswith('.'):
+                    if bql_q:
+                        self._bql(bql_q)
+                        bql_q = []
+                    cmd_q = cmd
+                else:
+                    bql_q.append(cmd)
             assert not cmd_q or not bql_q
-            if cmd.isspace() or not cmd:
-                continue
             if cmd_q:
-                self._cmd(cmd_q)
-                cmd_q = None
-            if cmd.startswith('.'):
-                if bql_q:
-                    self._bql(bql_q)
-                    bql_q = []
-                cmd_q = cmd
-            else:
-                bql_q.append(cmd)
-        assert not cmd_q or not bql_q
-        if cmd_q:
-            return self._cmd(cmd_q)
-        if bql_q:
-            return self._bql(bql_q)
+                return self._cmd(cmd_q)
+            if bql_q:
+                return self._bql(bql_q)
+        return self._execute(
+            execute, background, self._retrieve_raw(line, cell))
 
     @logged_cell
     @line_cell_magic
     def bql(self, line, cell=None):
+        line, flags = self._parse_flags(
+            line, ['background', 'chunksize', 'into', 'stream'])
+        background = flags.get('background', False)
         if cell is None:
             ucmds = [line]
         else:
-            ucmds = cell.split(';')
+            ucmds = utils_bql.split_statements(cell)
         cmds = [ucmd.encode('US-ASCII').strip() for ucmd in ucmds]
-        result = None
-        for cmd in cmds:
-            if cmd.isspace() or len(cmd) == 0:
-                continue
-            if cmd.startswith('.'):
-                result = self._cmd(cmd)
-            else:
-                result = self._bql([cmd])
-        return result
-
-    def _bql(self, lines):
-        out = StringIO.StringIO()
-        ok = False
-        for line in lines:
-            if ok:
-                self._bdb.execute(out.getvalue())
-                out = StringIO.StringIO()
-                ok = False
-            out.write('%s\n' % (line,))
-            if out.getvalue() and bql_string_complete_p(out.getvalue()):
-                ok = True
-        cursor = self._bdb.execute(out.getvalue())
-        return utils_bql.cursor_to_df(cursor)
+        cmds = [cmd for cmd in cmds if not cmd.isspace() and len(cmd) > 0]
+        if background and any(cmd.startswith('.') for cmd in cmds):
+            raise ValueError('Dot commands cannot run in the background.')
+        self._check_result_flags(cmds, flags)
+        def execute():
+            result = None
+            for i, cmd in enumerate(cmds):
+                if cmd.startswith('.'):
+                    result = self._cmd(cmd)
+                elif i == len(cmds) - 1:
+                    # Only the result of the final statement is returned.
+                    result = self._bql([cmd],
+                        chunksize=flags.get('chunksize'), into=flags.get('into'))
+                else:
+                    result = self._bql([cmd])
+            return result
+        return self._execute(
+            execute, background, self._retrieve_raw(line, cell))
+
+    def _bql(self, lines, chunksize=None, into=None):
+        statements = utils_bql.split_statements('\n'.join(lines))
+        if not statements:
+            return None
+        for statement in statements[:-1]:
+            self._execute_bql(statement)
+        if into:
+            return self._store(self._execute_bql(statements[-1]), into)
+        if chunksize:
+            cursor = self._execute_bql(statements[-1])
+            return utils_bql.ResultStream(
+                cursor, chunksize, exclusive=self._jobs.exclusive)
+        if not self._cache.cacheable(statements[-1]):
+            return utils_bql.cursor_to_df(self._execute_bql(statements[-1]))
+        self._jobs.checkpoint()
+        return utils_bql.query(self._bdb, statements[-1], cache=self._cache)
+
+    def _execute_bql(self, statement):
+        """Executes the BQL statement, and returns its cursor.
+
+        In a background job, an ANALYZE is executed in the steps of
+        `utils_bql.analyze_steps`, and the cells waiting for the bdb run
+        between steps and between statements, see `JobManager.checkpoint`.
+        In the foreground, the statement is executed as written.
+        """
+        steps = None
+        if self._jobs.in_job():
+            steps = utils_bql.analyze_steps(statement)
+        cursor = None
+        for step in steps or [statement]:
+            self._jobs.checkpoint()
+            self._cache.observe(step)
+            cursor = self._bdb.execute(step)
+        return cursor
+
+    def _store(self, cursor, table):
+        """Inserts the rows of `cursor` into the new table `table`."""
+        self._cache.invalidate()
+        rows = utils_bql.cursor_to_table(self._bdb, cursor, table)
+        print 'Inserted %d rows into %s.' % (rows, table)
+
+    def _query(self, query, sql=None, stattypes=None):
+        """Returns the result of the query of a dot command as a DataFrame."""
+        if sql:
+            self._cache.observe(query)
+            cursor = self._bdb.sql_execute(query)
+            return utils_bql.cursor_to_df(cursor, stattypes=stattypes)
+        return utils_bql.query(
+            self._bdb, query, cache=self._cache, stattypes=stattypes)
+
+    def _query_counts(self, query, sql=None, bins=None):
+        """Counts the rows of the query of a histogram inside SQLite.
+
+        Returns the result of `utils_bql.histogram_counts`, or None if the
+        query is a BQL ESTIMATE, SIMULATE or INFER rather than a SELECT, in
+        which case its rows must be fetched.
+        """
+        if not sql:
+            tokens = utils_bql.normalize_bql(query).split(None, 1)
+            if not tokens or tokens[0].upper() != 'SELECT':
+                return None
+        return utils_bql.histogram_counts(
+            self._bdb, query, bins=bins, bql=not sql)
+
+    @line_magic
+    def bql_jobs(self, line, cell=None):
+        '''Returns a table of the jobs submitted with --background.'''
+        return pd.DataFrame([
+            (job.jobid, job.status, round(job.elapsed, 1),
+                ' '.join(job.description.split()))
+            for job in self._jobs.jobs
+        ], columns=['job', 'status', 'elapsed', 'statement'])
+
+    @line_magic
+    def bql_wait(self, line, cell=None):
+        '''Waits for a background job and returns its result.
+
+        Usage: %bql_wait [<job>]
+
+        Without <job>, waits for the most recently submitted job. The status
+        line of the job is refreshed while waiting; interrupting the kernel
+        stops waiting without cancelling the job.
+        '''
+        if not self._jobs.jobs:
+            raise ValueError('No background jobs.')
+        jobid = int(line) if line.strip() else len(self._jobs.jobs)
+        job = self._jobs.get(jobid)
+        try:
+            while not job.wait(1):
+                sys.stdout.write('\r%s' % (job.status_line(),))
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            sys.stdout.write('\n')
+            return job
+        sys.stdout.write('\r%s\n' % (job.status_line(),))
+        if job.status == DONE:
+            return job.result
+        elif job.status == FAILED:
+            self.write_stderr(job.exception)
+        else:
+            self.write_stderr('Job %d was cancelled.\n' % (job.jobid,))
+
+    @line_magic
+    def bql_cancel(self, line, cell=None):
+        '''Cancels a pending background job, or interrupts a running one.
+
+        Usage: %bql_cancel <job>
+        '''
+        job = self._jobs.cancel(int(line))
+        print job.status_line()
+
+    @line_magic
+    def bql_cache(self, line, cell=None):
+        '''Shows statistics of, or clears, the cache of BQL query results.
+
+        Usage: %bql_cache stats|clear
+        '''
+        if line.strip() == 'stats':
+            return self._cache.stats()
+        elif line.strip() == 'clear':
+            self._cache.clear()
+        else:
+            self.write_stderr('Usage: %bql_cache stats|clear\n')
+
+    @line_magic
+    def bql_figures(self, line, cell=None):
+        '''Shows statistics of, or clears, the cache of rendered figures.
+
+        Usage: %bql_figures stats|clear
+        '''
+        if line.strip() == 'stats':
+            return self._figures.stats()
+        elif line.strip() == 'clear':
+            self._figures.clear()
+        else:
+            self.write_stderr('Usage: %bql_figures stats|clear\n')
+
+    @line_magic
+    def iventure_log(self, line, cell=None):
+        '''Sets how the outputs of cells are captured in the session logs,
+        also logs the session to an SQLite database, or searches the cells
+        logged to it.
+
+        Usage: %iventure_log capture summary|hash|full
+               %iventure_log retention <days>|off
+               %iventure_log database [<path>] [--no-wal]
+               %iventure_log search <pattern> [--since=<time>] [--type=<magic>]
+                   [--errors] [--limit=<n>]
+
+        The database is `~/.iventure_logs/iventure_logs.db` by default; pass
+        `--no-wal` for a database on a network filesystem. `<pattern>` is an
+        SQLite full-text query, and `--since` is an ISO date or time, or a
+        relative time such as `12h` or `7d`. With `retention`, the logs and
+        database entries older than `<days>` are deleted now and whenever a
+        session starts; they are kept forever by default, or with `off`.
+        '''
+        words = shlex.split(line)
+        databases = [logger for logger in self.session.loggers
+            if isinstance(logger, DBLogger)]
+        if len(words) == 2 and words[0] == 'capture' \
+                and words[1] in sessions.CAPTURE_POLICIES:
+            for logger in self.session.loggers:
+                logger.capture = words[1]
+        elif len(words) == 2 and words[0] == 'retention' \
+                and (words[1] == 'off' or words[1].isdigit()):
+            days = None if words[1] == 'off' else int(words[1])
+            for logger in self.session.loggers:
+                logger.expire(days)
+        elif words and words[0] == 'database':
+            parser = argparse.ArgumentParser(prog='%iventure_log database')
+            parser.add_argument('path', nargs='?')
+            parser.add_argument('--no-wal', action='store_true')
+            args = parser.parse_args(words[1:])
+            if databases:
+                raise ValueError('The session is already logged to %s.'
+                    % (databases[0].filename or databases[0].database,))
+            self.session.add_logger(DBLogger(
+                filename=args.path and os.path.abspath(args.path),
+                wal=not args.no_wal,
+                retention_days=self.session.loggers[0].retention_days))
+        elif words and words[0] == 'search':
+            parser = argparse.ArgumentParser(prog='%iventure_log search')
+            parser.add_argument('pattern', nargs='?', default='')
+            parser.add_argument('--since')
+            parser.add_argument('--type')
+            parser.add_argument('--errors', action='store_true')
+            parser.add_argument('--limit', type=int, default=100)
+            args = parser.parse_args(words[1:])
+            if not databases:
+                raise ValueError('The session is not logged to a database, '
+                    'see %iventure_log database.')
+            return databases[0].search(args.pattern, since=args.since,
+                entry_type=args.type, errors=args.errors, limit=args.limit)
+        else:
+            self.write_stderr(
+                'Usage: %%iventure_log capture %s\n'
+                '       %%iventure_log retention <days>|off\n'
+                '       %%iventure_log database [<path>] [--no-wal]\n'
+                '       %%iventure_log search <pattern> [--since=<time>] '
+                '[--type=<magic>] [--errors] [--limit=<n>]\n'
+                % ('|'.join(sessions.CAPTURE_POLICIES),))
 
     @line_magic
     def multiprocess(self, line, cell=None):
         switch = False if line == 'off' else True
-        old = self._bdb.backends['cgpm'].set_multiprocess(switch)
+        with self._jobs.exclusive():
+            old = self._bdb.backends['cgpm'].set_multiprocess(switch)
         def word(b): return "on" if b else "off"
         print "Multiprocessing turned %s from %s." % (word(switch), word(old))
 
@@ -407,6 +696,15 @@ class VentureMagics(Magics):
     @line_magic
     def dump_models(self, line, cell=None):
         population_name = line
+        with self._jobs.exclusive():
+            j = self._dump_models(population_name)
+        if j is None:
+            return
+        path = population_name + '_models.json'
+        with open(path, 'w') as outfile:
+            json.dump(j, outfile, indent=2)
+
+    def _dump_models(self, population_name):
         if not bayesdb_has_population(self._bdb, population_name):
             raise ValueError('No such population: %r' % (population_name,))
         population_id = bayesdb_get_population(self._bdb, population_name)
@@ -421,11 +719,8 @@ class VentureMagics(Magics):
         if backend.name() != 'cgpm':
             self.write_stderr('%dump_models requires generator from the '
                 'cgpm backend')
-            return
-        j = backend.json_ready_models(self._bdb, population_id, generator_id)
-        path = population_name + '_models.json'
-        with open(path, 'w') as outfile:
-            json.dump(j, outfile, indent=2)
+            return None
+        return backend.json_ready_models(self._bdb, population_id, generator_id)
 
     def _cmd(self, cmd, sql=None):
         assert cmd[0] == '.'
@@ -444,26 +739,103 @@ class VentureMagics(Magics):
             for m in matches:
                 args = str.replace(args, m, '')
             args = str.strip(args)
+            if dot_command in self._FIGURES:
+                return self._cached_plot(dot_command, args, sql, kwargs)
             return self._PLTS[dot_command](self, args, sql=sql, **kwargs)
         else:
             self.write_stderr('Unknown command: %s\n' % (dot_command,))
             return
 
+    def _cached_plot(self, dot_command, args, sql, kwargs):
+        """Plots as `_PLTS[dot_command]`, reusing a stored figure if any.
+
+        The figure is keyed on the plot, its options and the digest of its
+        data by `_FIGURES[dot_command]`, and shown from the figure cache
+        without plotting while that data is unchanged. The digest comes with
+        the DataFrame it was computed from, if any, which is plotted rather
+        than running its query again.
+        """
+        (digest, df) = self._FIGURES[dot_command](self, args, sql)
+        data = {} if df is None else {'df': df}
+        if digest is None:
+            return self._PLTS[dot_command](
+                self, args, sql=sql, **dict(kwargs, **data))
+        key = self._figures.key(dot_command, kwargs, digest)
+        png = self._figures.get(key)
+        if png is not None:
+            display_png(png, raw=True)
+            return
+        self._PLTS[dot_command](self, args, sql=sql, **dict(kwargs, **data))
+        png = utils_plot.figure_png()
+        if png is not None:
+            self._figures.put(key, png)
+
+    def _digest_query(self, query, sql=None):
+        df = self._query(query, sql=sql)
+        return (utils_plot.frame_digest(df), df)
+
+    def _digest_crosscat(self, query, sql=None):
+        tokens = query.split()
+        if len(tokens) != 2 or \
+                not bayesdb_has_generator(self._bdb, None, tokens[0]):
+            return (None, None)
+        generator_id = bayesdb_get_generator(self._bdb, None, tokens[0])
+        cursor = self._bdb.sql_execute('''
+            SELECT engine_json FROM bayesdb_cgpm_generator
+            WHERE generator_id = ?
+        ''', (generator_id,))
+        engine = cursor_value(cursor, nullok=True)
+        if engine is None:
+            return (None, None)
+        return (hashlib.sha1(str(engine)).hexdigest() + ' ' + tokens[1], None)
+
     def _cmd_nullify(self, args):
-        '''Convert <value> in <table> to SQL NULL.
+        '''Convert each <value> in <table> to SQL NULL.
 
-        Usage: .nullify <table> <value>
+        Returns a table of the number of cells changed in each column.
+
+        Usage: .nullify <table> <value> [<value> ...]
         '''
         tokens = args.split()   # XXX
-        if len(tokens) != 2:
-            self.write_stderr('Usage: .nullify <table> <value>')
+        if len(tokens) < 2:
+            self.write_stderr('Usage: .nullify <table> <value> [<value> ...]')
             return
         table = tokens[0]
-        expression = tokens[1]
-        value = self._bdb.execute('SELECT %s' % (expression,)).fetchvalue()
-        cells_changed = utils_bql.nullify(self._bdb, table, value)
-        print "Nullified %d cells" % (cells_changed,)
-        return None
+        values = [
+            self._bdb.execute('SELECT %s' % (expression,)).fetchvalue()
+            for expression in tokens[1:]
+        ]
+        self._cache.invalidate()
+        counts = utils_bql.nullify_columns(self._bdb, table, values)
+        print "Nullified %d cells" % (sum(counts.itervalues()),)
+        return pd.DataFrame(
+            [(column, count) for column, count in counts.iteritems() if count],
+            columns=['column', 'cells_changed'])
+
+    def _cmd_load_csv(self, args):
+        '''Loads the CSV file at <path> into the new table <table>.
+
+        Usage: .load_csv <table> <path> [options]
+
+        [options]
+            --chunksize=<n>     Number of rows to insert at a time.
+            --nullify=<value>   Value to convert to SQL NULL, in addition to
+                                empty cells. May be repeated.
+        '''
+        parser = argparse.ArgumentParser()
+        parser.add_argument('table',
+            help='Name of new table.')
+        parser.add_argument('path',
+            help='Path of CSV file.')
+        parser.add_argument('--chunksize', type=int, default=10000,
+            help='Number of rows to insert at a time.')
+        parser.add_argument('--nullify', type=str, default=[], action='append',
+            help='Value to convert to NULL.')
+        pargs = parser.parse_args(shlex.split(args))
+        self._cache.invalidate()
+        rows = utils_bql.load_csv(self._bdb, pargs.table, pargs.path,
+            chunksize=pargs.chunksize, nullify=pargs.nullify)
+        print 'Loaded %d rows into %s.' % (rows, pargs.table)
 
     def _cmd_table(self, args):
         '''Returns a table of the PRAGMA schema of <table>.
@@ -499,6 +871,7 @@ class VentureMagics(Magics):
         parser.add_argument('--seed', type=int, default=1,
             help='Seed of the subsampler.')
         pargs = parser.parse_args(shlex.split(args))
+        self._cache.invalidate()
         try:
             return utils_bql.subsample_table_columns(
                 self._bdb, pargs.table, pargs.new_table, pargs.limit,
@@ -527,23 +900,97 @@ class VentureMagics(Magics):
         ''', {'population_id': population_id})
         return utils_bql.cursor_to_df(cursor)
 
+    def _cmd_profile(self, args):
+        '''Returns the column profile of <table>, recomputing it.
+
+        The profile holds the number of NULL and distinct values, the minimum,
+        maximum and most frequent values of each column, and is kept in
+        memory for use by the interactive plots until the bdb is modified.
+
+        Usage: .profile <table> [--top_k=<k>]
+        '''
+        parser = argparse.ArgumentParser()
+        parser.add_argument('table',
+            help='Name of existing table.')
+        parser.add_argument('--top_k', type=int, default=utils_profile.TOP_K,
+            help='Number of most frequent values to keep per column.')
+        pargs = parser.parse_args(shlex.split(args))
+        return self._profiles.refresh(
+            self._bdb, pargs.table, top_k=pargs.top_k)
+
+    def _cmd_render_batch(self, args):
+        '''Renders the plots listed in <spec-file> to files in <dir>.
+
+        <spec-file> is a JSON list of plots, each an object with the name of
+        its plotting dot command in "plot", e.g. "scatter", its BQL query in
+        "query", and optionally its options in "kwargs", the name of its file
+        in "name", and "sql": true for an SQL query. The queries run in turn
+        on the bdb, and the figures are drawn and saved by <n> processes.
+
+        Returns a table of the plots and the paths of their files.
+
+        Usage: .render_batch <spec-file> [--out=<dir>] [--jobs=<n>]
+            [--format=png|svg]
+        '''
+        parser = argparse.ArgumentParser()
+        parser.add_argument('spec',
+            help='Path of JSON list of plots.')
+        parser.add_argument('--out', default='.',
+            help='Directory of the rendered files.')
+        parser.add_argument('--jobs', type=int, default=None,
+            help='Number of rendering processes, by default one per CPU.')
+        parser.add_argument('--format', choices=['png', 'svg'], default='png',
+            help='Format of the rendered files.')
+        pargs = parser.parse_args(shlex.split(args))
+        with open(pargs.spec, 'r') as f:
+            spec = json.load(f)
+        if not os.path.isdir(pargs.out):
+            os.makedirs(pargs.out)
+        entries = []
+        rows = []
+        for i, plot in enumerate(spec):
+            if plot.get('plot') not in utils_plot.PLOTS:
+                raise ValueError('Unknown plot in entry %d: %s' %
+                    (i, plot.get('plot')))
+            name = plot.get('name', '%03d_%s' % (i, plot['plot']))
+            path = os.path.join(pargs.out, '%s.%s' % (name, pargs.format))
+            # Options take the string values of dot command options.
+            kwargs = {
+                key: value if isinstance(value, (basestring, list))
+                    else str(value)
+                for key, value in plot.get('kwargs', {}).iteritems()
+            }
+            df = self._query(plot['query'], sql=plot.get('sql'))
+            entries.append((plot['plot'], df, path, kwargs))
+            rows.append((name, plot['plot'], len(df)))
+        paths = utils_plot.render_batch(entries, processes=pargs.jobs)
+        return pd.DataFrame(
+            [row + (path,) for row, path in zip(rows, paths)],
+            columns=['name', 'plot', 'rows', 'path'])
+
     def _cmd_guess_schema(self, args):
         '''Returns an MML schema using the guessed stattypes for <table>.
 
         Using the `--reasons` flag includes the heuristic reasons for the
-        stattype guesses.
+        stattype guesses. Using `--sample=<n>` guesses from a random sample of
+        <n> rows rather than from every row, and annotates each guess with its
+        confidence and with whether the sample may have missed rare
+        categories.
 
-        Usage: .guess_schema [--reasons] <table>
+        Usage: .guess_schema [--reasons] [--sample=<n> [--seed=<s>]] <table>
         '''
-        tokens = args.split()
-        if len(tokens) == 1:
-            reasons = False
-            table = tokens[0]
-        elif len(tokens) == 2:
-            assert tokens[0] == '--reasons'
-            reasons = True
-            table = tokens[1]
-        schema = utils_mml.guess_schema(self._bdb, table, reasons)
+        parser = argparse.ArgumentParser()
+        parser.add_argument('table',
+            help='Name of existing table.')
+        parser.add_argument('--reasons', action='store_true',
+            help='Include the reasons for the guesses.')
+        parser.add_argument('--sample', type=int, default=None,
+            help='Number of rows to sample.')
+        parser.add_argument('--seed', type=int, default=None,
+            help='Seed of the sampler.')
+        pargs = parser.parse_args(shlex.split(args))
+        schema = utils_mml.guess_schema(self._bdb, pargs.table, pargs.reasons,
+            sample=pargs.sample, seed=pargs.seed)
         # XXX Rather than return the schema, print it to the console. Returning
         # the raw string will not cause the notebook to pretty-print it.
         print schema
@@ -575,8 +1022,7 @@ class VentureMagics(Magics):
 
         Usage: .assert <query>
         '''
-        c = self._bdb.sql_execute(query) if sql else self._bdb.execute(query)
-        df = utils_bql.cursor_to_df(c)
+        df = self._query(query, sql=sql)
         if df.shape != (1,1):
             self.write_stderr(
                 'The query must return a table with exactly one '\
@@ -603,54 +1049,58 @@ class VentureMagics(Magics):
 
     # Plotting.
 
-    def _cmd_clustermap(self, query, sql=None, **kwargs):
-        c = self._bdb.sql_execute(query) if sql else self._bdb.execute(query)
-        df = utils_bql.cursor_to_df(c)
-        utils_plot.clustermap(df)
+    def _cmd_clustermap(self, query, sql=None, df=None, **kwargs):
+        if df is None:
+            df = self._query(query, sql=sql)
+        utils_plot.clustermap(df, **kwargs)
 
-    def _cmd_heatmap(self, query, sql=None, **kwargs):
-        c = self._bdb.sql_execute(query) if sql else self._bdb.execute(query)
-        df = utils_bql.cursor_to_df(c)
+    def _cmd_heatmap(self, query, sql=None, df=None, **kwargs):
+        if df is None:
+            df = self._query(query, sql=sql)
         utils_plot.heatmap(df, **kwargs)
 
     def _cmd_density(self, query, sql=None, **kwargs):
-        c = self._bdb.sql_execute(query) if sql else self._bdb.execute(query)
-        df = utils_bql.cursor_to_df(c)
+        df = self._query(query, sql=sql)
         utils_plot.density(df, **kwargs)
 
     def _cmd_bar(self, query, sql=None, **kwargs):
-        c = self._bdb.sql_execute(query) if sql else self._bdb.execute(query)
-        df = utils_bql.cursor_to_df(c)
+        df = self._query(query, sql=sql)
         utils_plot.bar(df, **kwargs)
 
     def _cmd_barh(self, query, sql=None, **kwargs):
-        c = self._bdb.sql_execute(query) if sql else self._bdb.execute(query)
-        df = utils_bql.cursor_to_df(c)
+        df = self._query(query, sql=sql)
         utils_plot.barh(df, **kwargs)
 
     def _cmd_scatter(self, query, sql=None, **kwargs):
-        c = self._bdb.sql_execute(query) if sql else self._bdb.execute(query)
-        df = utils_bql.cursor_to_df(c)
+        df = self._query(query, sql=sql)
         utils_plot.scatter(df, **kwargs)
 
     def _cmd_histogram_nominal(self, query, sql=None, **kwargs):
-        c = self._bdb.sql_execute(query) if sql else self._bdb.execute(query)
-        df = utils_bql.cursor_to_df(c)
-        utils_plot.histogram_nominal(df, **kwargs)
+        counts = self._query_counts(query, sql=sql)
+        if counts is None:
+            df = self._query(query, sql=sql)
+            utils_plot.histogram_nominal(df, **kwargs)
+        else:
+            (df, weights, _edges) = counts
+            utils_plot.histogram_nominal(df, weights=weights, **kwargs)
 
     def _cmd_histogram_numerical(self, query, sql=None, **kwargs):
-        c = self._bdb.sql_execute(query) if sql else self._bdb.execute(query)
-        df = utils_bql.cursor_to_df(c)
-        utils_plot.histogram_numerical(df, **kwargs)
+        bins = int(kwargs.pop('bins', 10))
+        counts = self._query_counts(query, sql=sql, bins=bins)
+        if counts is None:
+            df = self._query(query, sql=sql)
+            utils_plot.histogram_numerical(df, bins=bins, **kwargs)
+        else:
+            (df, weights, edges) = counts
+            utils_plot.histogram_numerical(
+                df, weights=weights, bins=edges, **kwargs)
 
     def _cmd_interactive_bar(self, query, sql=None, **kwargs):
-        c = self._bdb.sql_execute(query) if sql else self._bdb.execute(query)
-        df = utils_bql.cursor_to_df(c)
+        df = self._query(query, sql=sql)
         return jsviz.interactive_bar(df)
 
     def _cmd_interactive_heatmap(self, query, sql=None, **kwargs):
-        c = self._bdb.sql_execute(query) if sql else self._bdb.execute(query)
-        df = utils_bql.cursor_to_df(c)
+        df = self._query(query, sql=sql)
         # XXX Take the last three columns of the dataframe. This behavior is
         # intended to allow BQL PAIRWISE queries to be passed through directly
         # to %bql .interactive_heatmap. Unfortunately, PAIRWISE will return
@@ -670,15 +1120,20 @@ class VentureMagics(Magics):
             df_lookup = utils_bql.cursor_to_df(c)
             lookup = dict(zip(df_lookup[label0], df_lookup[label1]))
             df = df.replace({df.columns[0]: lookup, df.columns[1]: lookup})
-        return jsviz.interactive_heatmap(df)
+        tiled = kwargs.get('tiled', None)
+        if tiled is not None:
+            assert tiled in ['True', 'False']
+            tiled = tiled == 'True'
+        return jsviz.interactive_heatmap(df, tiled=tiled)
 
     def _cmd_interactive_pairplot(self, query, sql=None, **kwargs):
         population = kwargs.get('population', None)
         if population is None:
             raise ValueError('Specify --population=<name> argument.')
-        c = self._bdb.sql_execute(query) if sql else self._bdb.execute(query)
-        df = utils_bql.cursor_to_df(c)
-        schema = utils_mml.get_schema_as_list(self._bdb, population)
+        schema = utils_mml.get_schema_as_list(
+            self._bdb, population, profiles=self._profiles)
+        stattypes = {entry['name']: entry['stat_type'] for entry in schema}
+        df = self._query(query, sql=sql, stattypes=stattypes)
         for colname in df.columns:
             drop = True
             for entry in schema:
@@ -688,12 +1143,15 @@ class VentureMagics(Magics):
             if drop:
                 print "Ignoring non-modelled column %s" % (colname,)
                 del df[colname]
-        return jsviz.interactive_pairplot(df, schema)
+        aggregate = kwargs.get('aggregate', None)
+        if aggregate is not None:
+            assert aggregate in ['True', 'False']
+            aggregate = aggregate == 'True'
+        return jsviz.interactive_pairplot(df, schema, aggregate=aggregate)
 
     def _cmd_interactive_scatter(self, query, sql=None, **kwargs):
-        c = self._bdb.sql_execute(query) if sql else self._bdb.execute(query)
-        df = utils_bql.cursor_to_df(c)
-        return jsviz.interactive_scatter(df)
+        df = self._query(query, sql=sql)
+        return jsviz.interactive_scatter(df, kwargs.get('max_points'))
 
     def _cmd_render_crosscat(self, query, sql=None, **kwargs):
         '''Returns a rendering of the specified crosscat state
@@ -791,12 +1249,26 @@ class VentureMagics(Magics):
         if 'progress' in kwargs:
             sys.stdout.write('Rendering figure...\n')
 
+    # Rows per chunk of results streamed with --stream.
+    _CHUNKSIZE = 10000
+
+    # Leading flags of %bql, %mml and %sql, with the conversion of their value.
+    _FLAGS = {
+        'background'           : None,
+        'chunksize'            : int,
+        'into'                 : str,
+        'stream'               : None,
+    }
+
     _CMDS = {
         'assert'               : _cmd_assert,
         'guess_schema'         : _cmd_guess_schema,
+        'load_csv'             : _cmd_load_csv,
         'nullify'              : _cmd_nullify,
         'population'           : _cmd_population,
+        'profile'              : _cmd_profile,
         'regress_sql'          : _cmd_regress_sql,
+        'render_batch'         : _cmd_render_batch,
         'subsample_columns'    : _cmd_subsample_columns,
         'table'                : _cmd_table,
     }
@@ -817,6 +1289,14 @@ class VentureMagics(Magics):
         'scatter'              : _cmd_scatter,
     }
 
+    # Plots whose figures are cached, with functions returning the digest of
+    # the data they show and, if it was queried, its DataFrame.
+    _FIGURES = {
+        'clustermap'           : _digest_query,
+        'heatmap'              : _digest_query,
+        'render_crosscat'      : _digest_crosscat,
+    }
+
 
 def load_ipython_extension(ipython):
     ipython.register_magics(VentureMagics)
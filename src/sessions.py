@@ -14,66 +14,602 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import Queue
+import StringIO
+import atexit
 import datetime
+import gzip
+import hashlib
 import os
 import random
+import re
+import sqlite3
+import threading
+import time
+import zlib
 
 from collections import namedtuple
 
+import pandas as pd
+
+from iventure.utils_plot import frame_digest
+
 
 # `output` is either `None` or a `pandas.DataFrame`.
 # `exception` is the currently traceback string.
 LogEntry = namedtuple('LogEntry', ['type', 'input', 'output', 'exception'])
 
+# Policies of a TextLogger for capturing the output of a cell: its first and
+# last rows with its shape and column types, its shape and a hash of its
+# content, or in full, compressed into a sidecar file next to the log.
+SUMMARY = 'summary'
+HASH = 'hash'
+FULL = 'full'
+CAPTURE_POLICIES = [SUMMARY, HASH, FULL]
+
+# Table of the log entries in the database of a DBLogger.
+LOG_TABLE = 'iventure_log'
+
+# Kinds of the messages queued to the writer thread of a TextLogger.
+_ENTRY = 'entry'
+_FLUSH = 'flush'
+_REOPEN = 'reopen'
+_CLOSE = 'close'
+_EXPIRE = 'expire'
+
+# The start of every log file, and the names of sidecar files, of a
+# TextLogger, by which its expiry tells them from other files.
+_LOG_HEADER = '---\n:TIME:'
+_SIDECAR = re.compile(r'\.\d+\.(csv|txt)\.gz$')
+
 class TextLogger(object):
+    """Appends log entries to a text file from a background writer thread.
+
+    `log` only queues the entry, so cells never wait on disk I/O, e.g. of a
+    home directory on NFS. The writer keeps the file open, formats and writes
+    the entries, and flushes the file once `flush_bytes` bytes are pending or
+    `flush_interval` seconds after the first pending entry, whichever comes
+    first. `close`, also called at exit, writes and flushes any remaining
+    entries. As the target of the log file may not always be writeable, an
+    entry that cannot be written is dropped and counted in `errors`.
+
+    Outputs are captured according to `capture`, one of CAPTURE_POLICIES,
+    with `head_rows` first and last rows in summaries. Once a session has
+    written `max_session_bytes` bytes, including sidecar files, outputs are
+    only hashed. A log file larger than `max_file_bytes` is continued in a
+    new file, `<session>.<n>.txt`. If `retention_days` is not None, the logs
+    and sidecars written by a TextLogger older than that many days are
+    deleted when a session starts, and other files are left alone.
+    """
+
+    def __init__(self, flush_interval=1., flush_bytes=64 * 2**10,
+            capture=SUMMARY, head_rows=5, max_session_bytes=256 * 2**20,
+            max_file_bytes=16 * 2**20, retention_days=None):
+        if capture not in CAPTURE_POLICIES:
+            raise ValueError('Unknown capture policy: %s' % (capture,))
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.capture = capture
+        self.head_rows = head_rows
+        self.max_session_bytes = max_session_bytes
+        self.max_file_bytes = max_file_bytes
+        self.retention_days = retention_days
+        self.filename = None
+        self.errors = 0
+        self.session_bytes = 0
+        self._queue = Queue.Queue()
+        self._writer = None
+        self._file = None
+        self._base = None
+        self._part = 0
 
     def new_session(self, username, session_id, root):
         # XXX Is username being used?
         home = os.path.expanduser('~')
-        if not os.path.exists(os.path.join(home, root)):
-            os.mkdir(os.path.join(home, root))
-        self.filename = os.path.join(home, root, session_id + '.txt')
+        filename = os.path.join(home, root, session_id + '.txt')
+        self._queue.put((_REOPEN, filename))
+        self._start_writer()
+
+    def _start_writer(self):
+        if self._writer is None:
+            self._writer = threading.Thread(
+                target=self._write, name='iventure-log')
+            self._writer.daemon = True
+            self._writer.start()
+            atexit.register(self.close)
 
     def log(self, time, counter, entry):
-        with open(self.filename, 'a') as f:
-            f.write('---\n')
-            self._write_entry(f, 'TIME', time)
+        # Outputs are converted here, on the kernel thread, as the writer
+        # must not read objects that a later cell may modify in place, e.g. a
+        # DataFrame, or whose __str__ reads state only the kernel may use,
+        # e.g. the cursor of a ResultStream. Summaries and hashes are made
+        # now; full outputs are copied, or converted to text, for the writer.
+        capture = self.capture
+        if self.session_bytes >= self.max_session_bytes:
+            capture = HASH
+        output = entry.output
+        try:
+            if output is None or isinstance(output, basestring):
+                pass
+            elif capture != FULL:
+                output = _ConvertedOutput(
+                    self._convert_output(output, counter, capture))
+            elif isinstance(output, (pd.DataFrame, pd.Series)):
+                output = output.copy()
+            else:
+                output = _OutputText(output)
+        except Exception:
+            self.errors += 1
+            return
+        entry = entry._replace(output=output)
+        self._queue.put((_ENTRY, (time, counter, entry, capture)))
+
+    def expire(self, retention_days):
+        """Set `retention_days`, and delete the logs older than that now."""
+        self.retention_days = retention_days
+        if self._writer is not None:
+            self._queue.put((_EXPIRE, None))
+
+    def flush(self, timeout=None):
+        """Wait until the entries logged so far are written and flushed."""
+        if self._writer is None:
+            return True
+        if not self._writer.is_alive():
+            return False
+        flushed = threading.Event()
+        self._queue.put((_FLUSH, flushed))
+        flushed.wait(timeout)
+        return flushed.is_set()
+
+    def close(self, timeout=10.):
+        """Write and flush the queued entries, and stop the writer."""
+        if self._writer is None:
+            return
+        if self._writer.is_alive():
+            self._queue.put((_CLOSE, None))
+            self._writer.join(timeout)
+        self._writer = None
+
+    def _write(self):
+        pending = 0
+        deadline = None
+        while True:
+            try:
+                timeout = None if deadline is None \
+                    else max(deadline - time.time(), 0)
+                (kind, value) = self._queue.get(timeout=timeout)
+            except Queue.Empty:
+                (kind, value) = (_FLUSH, None)
+            if kind == _ENTRY:
+                # Count, rather than raise, any failure to write an entry, as
+                # it would stop the writer and lose the rest of the session.
+                try:
+                    pending += self._write_log(*value)
+                except Exception:
+                    self.errors += 1
+                if deadline is None:
+                    deadline = time.time() + self.flush_interval
+                if pending < self.flush_bytes:
+                    continue
+            self._flush_file()
+            pending = 0
+            deadline = None
+            if kind == _FLUSH and value is not None:
+                value.set()
+            elif kind == _REOPEN:
+                try:
+                    self._reopen(value)
+                except Exception:
+                    self.errors += 1
+            elif kind == _EXPIRE:
+                try:
+                    self._expire_logs()
+                except Exception:
+                    self.errors += 1
+            elif kind == _CLOSE:
+                self._close_file()
+                return
+
+    def _reopen(self, filename):
+        self._close_file()
+        self.filename = filename
+        self._base = os.path.splitext(filename)[0]
+        self._part = 0
+        self.session_bytes = 0
+        self._expire_logs()
+
+    def _write_log(self, timestamp, counter, entry, capture):
+        """Write an entry, returning its size, or 0 if it was dropped."""
+        try:
+            if self._file is not None and \
+                    self._file.tell() >= self.max_file_bytes:
+                self._close_file()
+                self._part += 1
+                self.filename = '%s.%d.txt' % (self._base, self._part)
+            if self._file is None:
+                directory = os.path.dirname(self.filename)
+                if not os.path.exists(directory):
+                    os.mkdir(directory)
+                self._file = open(self.filename, 'a')
+                self._file.seek(0, os.SEEK_END)
+            # Fields are formatted as unicode, and encoded once as UTF-8.
+            f = StringIO.StringIO()
+            f.write(u'---\n')
+            self._write_entry(f, 'TIME', timestamp)
             self._write_entry(f, 'COUNTER', str(counter))
             self._write_entry(f, 'TYPE', entry.type)
             self._write_entry(f, 'INPUT', entry.input)
-            self._write_entry(
-                f, 'OUTPUT', self._convert_output(entry.output))
+            self._write_entry(f, 'OUTPUT',
+                self._convert_output(entry.output, counter, capture))
             self._write_entry(
                 f, 'EXCEPTION', self._convert_exception(entry.exception))
+            text = f.getvalue().encode('utf-8')
+            self._file.write(text)
+            self.session_bytes += len(text)
+            return len(text)
+        except (IOError, OSError):
+            self.errors += 1
+            self._close_file()
+            return 0
+
+    def _flush_file(self):
+        try:
+            if self._file is not None:
+                self._file.flush()
+        except (IOError, OSError):
+            self.errors += 1
+            self._close_file()
+
+    def _close_file(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except (IOError, OSError):
+                self.errors += 1
+            self._file = None
 
     def _write_entry(self, f, label, entry):
-        f.write(':' + label + ':' + entry + '\n')
+        f.write(u':' + label + u':' + _text(entry) + u'\n')
 
-    def _convert_output(self, output):
-        # For pandas objects (series/dataframes) use the pretty-print method.
-        # Otherwise convert output to a string using it __str__ and return it.
-        try:
-            return output.to_string().encode('utf-8')
-        except AttributeError:
-            return str(output)
+    def _convert_output(self, output, counter, capture):
+        if output is None:
+            return u'None'
+        if isinstance(output, _ConvertedOutput):
+            return output
+        if self.session_bytes >= self.max_session_bytes:
+            capture = HASH
+        if capture == FULL:
+            return self._write_sidecar(output, counter)
+        if capture == HASH:
+            return u'%s; sha1 %s' % (_text(_shape(output)), _digest(output))
+        # For pandas objects (series/dataframes) use the pretty-print method
+        # on the first and last rows. Otherwise convert output to a string
+        # using its __str__, keeping its first and last lines.
+        if isinstance(output, (pd.DataFrame, pd.Series)):
+            n = self.head_rows
+            if len(output) <= 2 * n:
+                text = output.to_string()
+            else:
+                text = '%s\n...\n%s' % (
+                    output.head(n).to_string(),
+                    output.tail(n).to_string(header=False))
+            return u'%s\n%s' % (_text(_shape(output)), _text(text))
+        lines = _text(output).splitlines()
+        n = self.head_rows
+        if len(lines) > 2 * n:
+            lines = lines[:n] + ['... (%d lines)' % (len(lines),)] + lines[-n:]
+        return u'\n'.join(lines)
+
+    def _write_sidecar(self, output, counter):
+        """Write output compressed next to the log, returning its summary."""
+        extension, content = _full_content(output)
+        path = '%s.%d.%s.gz' % (self._base, counter, extension)
+        with gzip.open(path, 'wb') as f:
+            f.write(content)
+        self.session_bytes += os.path.getsize(path)
+        return u'%s; in %s' % (
+            _text(_shape(output)), _text(os.path.basename(path)))
+
+    def _expire_logs(self):
+        """Delete the logs and sidecars older than `retention_days`."""
+        directory = os.path.dirname(self.filename)
+        if self.retention_days is None or not os.path.isdir(directory):
+            return
+        cutoff = time.time() - self.retention_days * 24 * 3600
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff and \
+                        _written_by_logger(path):
+                    os.remove(path)
+            except (IOError, OSError):
+                self.errors += 1
 
     def _convert_exception(self, exception):
-        return '' if exception is None else exception
+        return u'' if exception is None else exception
+
+
+def _written_by_logger(path):
+    """Whether path is a log or a sidecar written by a TextLogger."""
+    if _SIDECAR.search(path):
+        return True
+    if not path.endswith('.txt'):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(_LOG_HEADER)) == _LOG_HEADER
+
+def _shape(output):
+    """Return a summary of the shape and column types of output."""
+    if isinstance(output, pd.DataFrame):
+        return 'shape %d x %d; dtypes %s' % (output.shape + (', '.join(
+            '%s:%s' % (column, dtype)
+            for column, dtype in output.dtypes.iteritems()),))
+    if isinstance(output, pd.Series):
+        return 'shape %d; dtype %s' % (len(output), output.dtype)
+    return 'type %s' % (
+        getattr(output, 'type_name', None) or type(output).__name__,)
+
+def _full_content(output):
+    """Return the file extension and the UTF-8 content of output in full."""
+    if isinstance(output, (pd.DataFrame, pd.Series)):
+        return 'csv', output.to_csv(encoding='utf-8')
+    return 'txt', _text(output).encode('utf-8')
+
+def _digest(output):
+    """Return a hash of the content of output."""
+    if isinstance(output, (pd.DataFrame, pd.Series)):
+        return frame_digest(output)
+    return hashlib.sha1(_text(output).encode('utf-8')).hexdigest()
+
+def _text(value):
+    """Return value as unicode text, decoding byte strings as UTF-8, or
+    None."""
+    if value is None or isinstance(value, unicode):
+        return value
+    return str(value).decode('utf-8', 'replace')
+
+class _OutputText(unicode):
+    """The text of an output, with the name of its type."""
+
+    def __new__(cls, output):
+        text = super(_OutputText, cls).__new__(cls, _text(output))
+        text.type_name = type(output).__name__
+        return text
+
+class _ConvertedOutput(unicode):
+    """An output already converted under the capture policy of its entry."""
+
+# Relative times accepted by DBLogger.search, e.g. `12h` or `7d`.
+_SINCE_UNITS = {'m': 60, 'h': 3600, 'd': 24 * 3600, 'w': 7 * 24 * 3600}
+
+
+class DBLogger(TextLogger):
+    """Inserts log entries into an SQLite database, for `search`.
+
+    The entries of all sessions share the table `LOG_TABLE` of `filename`,
+    by default `~/<root>/iventure_logs.db`, indexed on session, time, type
+    and whether an exception was raised, with their input, output and
+    exception indexed for full-text search in the FTS4 table
+    `LOG_TABLE_text`. Entries are inserted from the background writer thread
+    of a TextLogger, and committed in batches as the text log is flushed,
+    under the same capture policies, byte budget and retention, by which
+    entries older than `retention_days`, if not None, are deleted when a
+    session starts.
+    Full outputs are stored compressed with zlib in the `content` column of
+    their entry rather than in sidecar files.
+
+    The database is in write-ahead log mode if `wal`, unless SQLite cannot
+    enable it, in which case it keeps its rollback journal. As write-ahead
+    logs do not work on network filesystems, pass `wal=False` for a
+    database on NFS.
+    """
+
+    def __init__(self, filename=None, wal=True, **kwargs):
+        super(DBLogger, self).__init__(**kwargs)
+        self.database = filename
+        self.wal = wal
+        self.session_id = None
+        self.username = None
+        self._content = None
+
+    def new_session(self, username, session_id, root):
+        home = os.path.expanduser('~')
+        filename = self.database or \
+            os.path.join(home, root, 'iventure_logs.db')
+        self._queue.put((_REOPEN, (username, session_id, filename)))
+        self._start_writer()
+
+    def search(self, pattern, since=None, entry_type=None, errors=False,
+            limit=100, timeout=10.):
+        """Returns the logged entries whose input, output or exception
+        match `pattern`, most recent first, as a DataFrame.
+
+        `pattern` is an SQLite full-text query, e.g. `nullify`, `simul*`
+        or `"guess schema"`. `since` is an ISO date or time, or a relative
+        time such as `30m`, `12h`, `7d` or `2w`. Entries still queued are
+        written first.
+        """
+        self.flush(timeout)
+        conditions = []
+        parameters = []
+        if pattern:
+            conditions.append('''rowid IN (
+                SELECT docid FROM %s_text WHERE %s_text MATCH ?
+            )''' % (LOG_TABLE, LOG_TABLE))
+            parameters.append(_text(pattern))
+        if since is not None:
+            conditions.append('time >= ?')
+            parameters.append(parse_since(since))
+        if entry_type is not None:
+            conditions.append('type = ?')
+            parameters.append(entry_type)
+        if errors:
+            conditions.append('error = 1')
+        where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+        connection = sqlite3.connect(self.filename)
+        try:
+            return pd.read_sql_query('''
+                SELECT session, time, counter, type, input, output, exception
+                FROM %s %s ORDER BY time DESC LIMIT ?
+            ''' % (LOG_TABLE, where), connection, params=parameters + [limit])
+        except pd.io.sql.DatabaseError as e:
+            raise ValueError('Invalid search: %s' % (e,))
+        finally:
+            connection.close()
+
+    def _reopen(self, value):
+        (self.username, self.session_id, filename) = value
+        self._close_file()
+        self.filename = filename
+        self.session_bytes = 0
+        self._expire_logs()
+
+    def _open(self):
+        directory = os.path.dirname(self.filename)
+        if not os.path.exists(directory):
+            os.mkdir(directory)
+        self._file = sqlite3.connect(self.filename)
+        if self.wal:
+            self._file.execute('PRAGMA journal_mode=WAL')
+        self._file.execute('''
+            CREATE TABLE IF NOT EXISTS %s (
+                session     TEXT NOT NULL,
+                username    TEXT,
+                time        TEXT NOT NULL,
+                counter     INTEGER NOT NULL,
+                type        TEXT NOT NULL,
+                input       TEXT,
+                output      TEXT,
+                exception   TEXT,
+                error       INTEGER NOT NULL,
+                content     BLOB
+            )
+        ''' % (LOG_TABLE,))
+        for name, columns in [
+                ('session', 'session, counter'),
+                ('time', 'time'),
+                ('type', 'type, time'),
+                ('error', 'error, time')]:
+            self._file.execute('''
+                CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)
+            ''' % (LOG_TABLE, name, LOG_TABLE, columns))
+        self._file.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS %s_text
+                USING fts4(content="%s", input, output, exception)
+        ''' % (LOG_TABLE, LOG_TABLE))
+        self._file.commit()
+
+    def _write_log(self, timestamp, counter, entry, capture):
+        """Insert an entry, returning its size, or 0 if it was dropped."""
+        try:
+            if self._file is None:
+                self._open()
+            self._content = None
+            text = (
+                _text(entry.input),
+                _text(self._convert_output(entry.output, counter, capture)),
+                _text(entry.exception),
+            )
+            cursor = self._file.execute('''
+                INSERT INTO %s (
+                    session, username, time, counter, type, input, output,
+                    exception, error, content
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''' % (LOG_TABLE,), (
+                self.session_id, self.username, timestamp, counter,
+                entry.type) + text + (
+                int(entry.exception is not None), self._content))
+            self._file.execute('''
+                INSERT INTO %s_text (docid, input, output, exception)
+                VALUES (?, ?, ?, ?)
+            ''' % (LOG_TABLE,), (cursor.lastrowid,) + text)
+            size = sum(len(value) for value in text if value)
+            self.session_bytes += size
+            return size
+        except (IOError, OSError, sqlite3.Error):
+            self.errors += 1
+            self._close_file()
+            return 0
+
+    def _write_sidecar(self, output, counter):
+        """Keep output compressed for the `content` column of its entry."""
+        self._content = buffer(zlib.compress(_full_content(output)[1]))
+        self.session_bytes += len(self._content)
+        return u'%s; in content' % (_text(_shape(output)),)
+
+    def _flush_file(self):
+        try:
+            if self._file is not None:
+                self._file.commit()
+        except sqlite3.Error:
+            self.errors += 1
+            self._close_file()
+
+    def _close_file(self):
+        if self._file is not None:
+            try:
+                self._file.commit()
+                self._file.close()
+            except sqlite3.Error:
+                self.errors += 1
+            self._file = None
+
+    def _expire_logs(self):
+        """Delete the entries older than `retention_days`."""
+        if self.retention_days is None:
+            return
+        cutoff = datetime.datetime.now() - \
+            datetime.timedelta(days=self.retention_days)
+        try:
+            if self._file is None:
+                self._open()
+            # The external content of the full-text index is deleted last,
+            # as deleting from the index reads the text of the entries.
+            self._file.execute('''
+                DELETE FROM %s_text WHERE docid IN (
+                    SELECT rowid FROM %s WHERE time < ?
+                )
+            ''' % (LOG_TABLE, LOG_TABLE), (cutoff.isoformat(),))
+            self._file.execute('DELETE FROM %s WHERE time < ?' % (LOG_TABLE,),
+                (cutoff.isoformat(),))
+            self._file.commit()
+        except (IOError, OSError, sqlite3.Error):
+            self.errors += 1
+            self._close_file()
+
+
+def parse_since(since, now=None):
+    """Returns the ISO time of `since`, an ISO date or time or a relative
+    time such as `30m`, `12h`, `7d` or `2w` before `now`."""
+    match = re.match(r'^(\d+)([mhdw])$', since)
+    if match:
+        now = now or datetime.datetime.now()
+        seconds = int(match.group(1)) * _SINCE_UNITS[match.group(2)]
+        return (now - datetime.timedelta(seconds=seconds)).isoformat()
+    if re.match(r'^\d{4}-\d{2}-\d{2}([T ][\d:.]+)?$', since):
+        return since.replace(' ', 'T')
+    raise ValueError('Invalid time: %s' % (since,))
 
-# TODO implement DBLogger which takes a .db file as input
 
 class Session(object):
 
     def __init__(self, username, loggers, root):
         self.loggers = loggers
         self.counter = 0
+        self.username = username
+        self.root = root
         # XXX Global random state!
         rand = str(random.choice('0123456789ABCDEF'))
-        session_id = \
+        self.session_id = \
             username + '_' + datetime.datetime.now().isoformat() + '_' + rand
         for logger in self.loggers:
-            logger.new_session(username, session_id, root)
-        print 'session_id: %s' % (session_id,)
+            logger.new_session(username, self.session_id, root)
+        print 'session_id: %s' % (self.session_id,)
+
+    def add_logger(self, logger):
+        """Log the rest of the session with `logger` too."""
+        logger.new_session(self.username, self.session_id, self.root)
+        self.loggers.append(logger)
 
     def log(self, entry):
         self.counter += 1
@@ -14,7 +14,13 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import csv
 import itertools
+import re
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import pandas as pd
 import numpy as np
@@ -28,68 +34,826 @@ from bayeslite.core import bayesdb_table_has_column
 from bayeslite.util import cursor_value
 from bayeslite.util import casefold
 
+from iventure import utils_profile
+
 
 def nullify(bdb, table, value):
-    """Replace specified values in a SQL table with ``NULL``."""
+    """Replace specified values in a SQL table with ``NULL``.
+
+    `value` is a single value, or a list of values. Returns the number of
+    cells changed.
+    """
+    values = value if isinstance(value, (list, tuple)) else [value]
+    return sum(nullify_columns(bdb, table, values).itervalues())
+
+
+def nullify_columns(bdb, table, values, batch=256):
+    """Replace any of `values` in the columns of a SQL table with ``NULL``.
+
+    The columns are processed `batch` at a time, with one scan of the table
+    to count the matching cells of every column in the batch and one UPDATE
+    to nullify them. Returns a dict mapping each column to the number of
+    cells changed in it.
+    """
     qtable = bql_quote_name(table)
     cursor = bdb.sql_execute('pragma table_info(%s)' % (qtable,))
     columns = [row[1] for row in cursor]
-    if value == '\'\'':
-        sql = 'UPDATE %s SET {0} = NULL WHERE {0} = \'\'' % (qtable,)
+    # The empty string may be given quoted, as in SQL.
+    values = ['' if v == '\'\'' else v for v in values]
+    # Numbered parameters, shared by the expressions of every column.
+    qvalues = ','.join('?%d' % (i + 1,) for i in xrange(len(values)))
+    counts = OrderedDict()
+    with bdb.savepoint():
+        for start in xrange(0, len(columns), batch):
+            names = columns[start:start + batch]
+            qcols = map(bql_quote_name, names)
+            cursor = bdb.sql_execute('SELECT %s FROM %s' % (
+                ','.join('SUM(%s IN (%s))' % (qc, qvalues) for qc in qcols),
+                qtable,
+            ), values)
+            batch_counts = [int(c or 0) for c in cursor.fetchall()[0]]
+            counts.update(zip(names, batch_counts))
+            changed = [qc for qc, c in zip(qcols, batch_counts) if c > 0]
+            if not changed:
+                continue
+            bdb.sql_execute('UPDATE %s SET %s WHERE %s' % (
+                qtable,
+                ','.join(
+                    '%s = CASE WHEN %s IN (%s) THEN NULL ELSE %s END'
+                    % (qc, qc, qvalues, qc) for qc in changed),
+                ' OR '.join('%s IN (%s)' % (qc, qvalues) for qc in changed),
+            ), values)
+    return counts
+
+
+def load_csv(bdb, table, path, chunksize=10000, nullify=None, sample=1000):
+    """Load the CSV file at `path` into a new table named `table`.
+
+    The first row of the file names the columns. The declared type of each
+    column (INTEGER, REAL or TEXT) is guessed from the next `sample` rows.
+    The file is then read and inserted in chunks of `chunksize` rows with
+    `executemany`, inside a single savepoint. Empty cells, and cells equal
+    to any of the strings in `nullify`, are inserted as NULL, so no separate
+    pass of `nullify` over the table is needed. Returns the number of rows
+    loaded.
+    """
+    if bayesdb_has_table(bdb, table):
+        raise ValueError('Table already exists: %s' % (table,))
+    missing = set([''] + list(nullify or []))
+    with open(path, 'rb') as f:
+        reader = csv.reader(f)
+        try:
+            header = [name.decode('utf-8').strip() for name in next(reader)]
+        except StopIteration:
+            raise ValueError('Empty CSV file: %s' % (path,))
+        if not all(header):
+            raise ValueError('Empty column name(s) in %s' % (path,))
+        if len(set(map(casefold, header))) != len(header):
+            raise ValueError('Duplicate column names in %s' % (path,))
+        head = list(itertools.islice(reader, sample))
+        types = [
+            _guess_csv_type([row[i] for row in head if i < len(row)], missing)
+            for i in xrange(len(header))
+        ]
+        qt = bql_quote_name(table)
+        qcs = ','.join(
+            '%s %s' % (bql_quote_name(name), t) for name, t in zip(header, types))
+        insert = 'INSERT INTO %s VALUES (%s)' % (
+            qt, ','.join('?' for _name in header))
+        def convert(lineno, row):
+            if len(row) != len(header):
+                raise ValueError('Line %d of %s has %d cells, expected %d.'
+                    % (lineno, path, len(row), len(header)))
+            return [
+                None if cell in missing else _convert_csv_cell(cell, t)
+                for cell, t in zip(row, types)
+            ]
+        rows = itertools.chain(head, reader)
+        # The header is line 1.
+        lines = itertools.count(2)
+        count = 0
+        # Writes are durable once the savepoint is released; do not wait on
+        # the disk for each page of the journal before then. SQLite refuses
+        # to change the safety level inside a transaction, so it is kept if
+        # the caller has one open.
+        tune = bdb._sqlite3.getautocommit()
+        synchronous = cursor_value(bdb.sql_execute('PRAGMA synchronous'))
+        cache_size = cursor_value(bdb.sql_execute('PRAGMA cache_size'))
+        if tune:
+            bdb.sql_execute('PRAGMA synchronous = OFF')
+        bdb.sql_execute('PRAGMA cache_size = -65536')
+        try:
+            with bdb.savepoint():
+                bdb.sql_execute('CREATE TABLE %s (%s)' % (qt, qcs))
+                # bayeslite has no executemany, and tracing and preparing each
+                # INSERT through sql_execute would dominate the load, so the
+                # batches go straight to the SQLite connection.
+                writer = bdb._sqlite3.cursor()
+                while True:
+                    chunk = [
+                        convert(lineno, row) for row, lineno in
+                        itertools.izip(itertools.islice(rows, chunksize), lines)
+                    ]
+                    if not chunk:
+                        break
+                    writer.executemany(insert, chunk)
+                    count += len(chunk)
+        finally:
+            if tune:
+                bdb.sql_execute('PRAGMA synchronous = %d' % (synchronous,))
+            bdb.sql_execute('PRAGMA cache_size = %d' % (cache_size,))
+    return count
+
+
+def _guess_csv_type(cells, missing):
+    """Returns the declared type of a column from a sample of its cells,
+    TEXT if they are all missing."""
+    cells = [cell for cell in cells if cell not in missing]
+    if not cells:
+        return 'TEXT'
+    for t, cast in [('INTEGER', int), ('REAL', float)]:
+        try:
+            for cell in cells:
+                cast(cell)
+        except ValueError:
+            continue
+        return t
+    return 'TEXT'
+
+
+def _convert_csv_cell(cell, t):
+    """Converts the string `cell` for a column of declared type `t`."""
+    if t in ('INTEGER', 'REAL'):
+        try:
+            return int(cell) if t == 'INTEGER' else float(cell)
+        except ValueError:
+            try:
+                return float(cell)
+            except ValueError:
+                pass
+    return cell.decode('utf-8')
+
+
+def histogram_counts(bdb, query, bins=None, bql=False):
+    """Counts the rows of the SQL `query` by value, inside SQLite.
+
+    The first column of `query` holds the values and the optional second
+    column their labels; rows with a NULL in either are skipped. Nominal
+    values are counted with GROUP BY. If `bins` is a number of bins, the
+    values are numerical and are counted in that many buckets of equal width
+    spanning their range, which a first pass over `query` finds. As the
+    values of a query fetched into a DataFrame are converted to floats, text
+    that float() converts to a finite number is counted as that number, and
+    other text, e.g. a 'NaN' sentinel, is skipped as NULL. Unlike in a
+    DataFrame, 'inf' is skipped too, rather than stretching the range of
+    the buckets without end. Only the counts are fetched from SQLite. If
+    `bql`, `query` is a BQL SELECT, and is counted in BQL queries selecting
+    from it.
+
+    Returns a DataFrame with the columns of `query`, holding the values (or
+    the centers of the buckets) and labels, the array of their counts, and
+    the edges of the buckets, or None for nominal values.
+    """
+    execute = bdb.execute if bql else bdb.sql_execute
+    cursor = execute('SELECT * FROM (%s) LIMIT 1' % (query,))
+    names = [desc[0] for desc in cursor.description]
+    if not 1 <= len(names) <= 2:
+        raise ValueError('Only one or two columns allowed: %s' % (names,))
+    cursor.fetchall()
+    # Name the columns of the query by position, whatever their names.
+    qcolumns = ['v', 'l'][:len(names)]
+    numbers = ', '.join(['%s AS v' % (_number('v'),)] + qcolumns[1:])
+    if bql:
+        # BQL has no WITH, so the query is renamed in nested subqueries.
+        subquery = ''
+        q = '(SELECT %s FROM (%s))' % (', '.join(
+            '%s AS %s' % (bql_quote_name(name), column)
+            for name, column in zip(names, qcolumns)), query)
+        if bins is not None:
+            q = '(SELECT %s FROM %s)' % (numbers, q)
     else:
-        sql = 'UPDATE %s SET {0} = NULL WHERE {0} = ?' % (qtable,)
-    cells_changed = 0
-    for col in columns:
-        qcol = bql_quote_name(col)
-        old_changes = bdb._sqlite3.totalchanges()
-        bdb.sql_execute(sql.format(qcol), (value,))
-        rows_changed = bdb._sqlite3.totalchanges() - old_changes
-        cells_changed += rows_changed
-    return cells_changed
-
-
-def cardinality(bdb, table, columns=None):
-    """Compute the number of unique values in the columns of a table."""
-    qtable = bql_quote_name(table)
-    # If no columns specified then use all.
+        q = 'q'
+        subquery = 'WITH q(%s) AS (%s)' % (','.join(qcolumns), query)
+        if bins is not None:
+            subquery = 'WITH q0(%s) AS (%s), q(%s) AS (SELECT %s FROM q0)' % (
+                ','.join(qcolumns), query, ','.join(qcolumns), numbers)
+    where = ' AND '.join('%s IS NOT NULL' % (c,) for c in qcolumns)
+    labels = ', l' if len(names) == 2 else ''
+    edges = None
+    if bins is None:
+        bucket = 'v'
+        bindings = ()
+    else:
+        cursor = execute('''
+            %s SELECT MIN(v), MAX(v) FROM %s WHERE %s
+        ''' % (subquery, q, where))
+        (lo, hi) = cursor.fetchone()
+        if lo is None:
+            raise ValueError('No valid values in dataframe!')
+        # As numpy.histogram, give a range of one to a single value.
+        if lo == hi:
+            (lo, hi) = (lo - .5, hi + .5)
+        edges = np.linspace(lo, hi, bins + 1)
+        bucket = 'MIN(CAST((v - ?1) / ?2 AS INTEGER), ?3)'
+        bindings = (lo, (hi - lo) / float(bins), bins - 1)
+    cursor = execute('''
+        %s SELECT %s AS b%s, COUNT(*) FROM %s WHERE %s GROUP BY b%s
+    ''' % (subquery, bucket, labels, q, where, labels), bindings)
+    rows = cursor.fetchall()
+    if not rows:
+        raise ValueError('No valid values in dataframe!')
+    df = pd.DataFrame([row[:-1] for row in rows], columns=names)
+    counts = np.array([row[-1] for row in rows])
+    if edges is not None:
+        centers = (edges[:-1] + edges[1:]) / 2.
+        df.iloc[:,0] = centers[df.iloc[:,0].values.astype(int)]
+    return df, counts, edges
+
+
+def _number(v):
+    """Returns an SQL expression of the number held by the value `v`, which
+    is NULL unless it is a number or text that float() converts to a finite
+    number: an optional sign, digits with at most one decimal point, and an
+    optional exponent, within whitespace."""
+    t = "trim(%s, ' ' || char(9) || char(10) || char(13))" % (v,)
+    unsigned = "(CASE WHEN %s GLOB '[-+]*' THEN substr(%s, 2) ELSE %s END)"
+    u = unsigned % (t, t, t)
+    e = "instr(lower(%s), 'e')" % (u,)
+    mantissa = "(CASE WHEN %s > 0 THEN substr(%s, 1, %s - 1) ELSE %s END)" % (
+        e, u, e, u)
+    x = "substr(%s, %s + 1)" % (u, e)
+    exponent = unsigned % (x, x, x)
+    return """CASE
+    WHEN typeof(%(v)s) = 'integer' OR typeof(%(v)s) = 'real' THEN %(v)s
+    WHEN typeof(%(v)s) = 'text'
+        AND %(m)s GLOB '*[0-9]*'
+        AND NOT %(m)s GLOB '*[^0-9.]*'
+        AND NOT %(m)s GLOB '*.*.*'
+        AND (%(e)s = 0
+            OR (%(x)s <> '' AND NOT %(x)s GLOB '*[^0-9]*'))
+        THEN CAST(%(t)s AS REAL)
+END""" % {'v': v, 't': t, 'm': mantissa, 'e': e, 'x': exponent}
+
+
+def cardinality(bdb, table, columns=None, profiles=None):
+    """Compute the number of unique values in the columns of a table.
+
+    If `profiles` is a `utils_profile.ProfileCache`, the counts are read from
+    the column profile of the table, which is computed in a single scan and
+    reused until the bdb changes. Columns with more distinct values than the
+    profile counts exactly are counted with COUNT(DISTINCT), together in a
+    second scan. Without `profiles`, only the requested columns are counted
+    with COUNT(DISTINCT), together in one scan inside SQLite.
+    """
+    if profiles is None:
+        # If no columns specified then use all.
+        names = list(columns) if columns \
+            else bayesdb_table_column_names(bdb, table)
+        counts = _count_distinct(bdb, table, names)
+    else:
+        profile = profiles.get(bdb, table)
+        if columns:
+            profile = utils_profile.lookup_columns(profile, columns)
+        names = profile['name'].tolist()
+        counts = profile['distinct_count'].tolist()
+        inexact = [i for i, exact in enumerate(profile['exact']) if not exact]
+        if inexact:
+            for i, count in zip(inexact, _count_distinct(
+                    bdb, table, [names[i] for i in inexact])):
+                counts[i] = count
+    return pd.DataFrame({
+        'name': list(columns) if columns else names,
+        'distinct_count': [int(count) for count in counts],
+    })
+
+
+def _count_distinct(bdb, table, columns):
+    """Returns the numbers of distinct values in `columns`, in one scan."""
     if not columns:
-        cursor = bdb.sql_execute('PRAGMA table_info(%s)' % (qtable,))
-        columns = [row[1] for row in cursor]
-    names = []
-    counts = []
-    for column in columns:
-        qcolumn = bql_quote_name(column)
-        cursor = bdb.sql_execute('''
-            SELECT COUNT (DISTINCT %s) FROM %s
-        ''' % (qcolumn, qtable))
-        names.append(column)
-        counts.append(cursor_value(cursor))
-    return pd.DataFrame({'name': names, 'distinct_count': counts})
-
-
-def cursor_to_df(cursor):
-    """Converts SQLite3 cursor to a pandas DataFrame."""
+        return []
+    cursor = bdb.sql_execute('SELECT %s FROM %s' % (
+        ', '.join('COUNT(DISTINCT %s)' % (bql_quote_name(column),)
+            for column in columns),
+        bql_quote_name(table)))
+    return list(cursor.fetchone())
+
+
+def cursor_to_df(cursor, stattypes=None, arraysize=4096):
+    """Converts SQLite3 cursor to a pandas DataFrame.
+
+    Rows are fetched in batches of `arraysize`, and each batch is copied
+    into one growing NumPy array per column and then freed. Columns whose
+    SQLite declared type has TEXT affinity, or whose stattype in the optional
+    dict `stattypes` is nominal, are kept as objects. Every other column is
+    stored as floats, unless one of its values cannot be converted, in which
+    case the whole column falls back to objects: text converted in earlier
+    batches is restored, and their numbers are kept as floats.
+    """
+    names = None
+    columns = None
     # Perform in savepoint to enable caching from row to row in BQL queries.
     with cursor.connection.savepoint():
-        df = pd.DataFrame.from_records(cursor, coerce_float=True)
-    if not df.empty:
-        df.columns = [desc[0] for desc in cursor.description]
-        for col in df.columns:
+        for names, dtypes, values in _value_batches(
+                cursor, stattypes, arraysize):
+            if columns is None:
+                columns = [_ColumnBuffer(dtype, arraysize) for dtype in dtypes]
+            for column, batch in zip(columns, values):
+                column.extend(batch)
+    if columns is None:
+        return pd.DataFrame()
+    return _columns_to_df(names, [column.finish() for column in columns])
+
+
+def cursor_to_table(bdb, cursor, table, arraysize=4096):
+    """Inserts the rows of `cursor` into a new table named `table`.
+
+    Rows are fetched and inserted in batches of `arraysize` with
+    `executemany`, inside a single savepoint, and are never converted to a
+    DataFrame. The columns of the new table take the names, and where
+    available the declared types, of the columns of `cursor`. Returns the
+    number of rows inserted. Raises ValueError if `cursor` has no columns,
+    as happens when a query returning no rows does not start with SELECT.
+    """
+    if bayesdb_has_table(bdb, table):
+        raise ValueError('Table already exists: %s' % (table,))
+    if not cursor.description:
+        raise ValueError('Query returned no rows and no columns, so table %s'
+            ' cannot be created.' % (table,))
+    qt = bql_quote_name(table)
+    columns = [
+        bql_quote_name(desc[0]) + (' %s' % (desc[1],)
+            if len(desc) > 1 and isinstance(desc[1], basestring) else '')
+        for desc in cursor.description
+    ]
+    insert = 'INSERT INTO %s VALUES (%s)' % (
+        qt, ','.join('?' for _column in columns))
+    rows = 0
+    with bdb.savepoint():
+        bdb.sql_execute('CREATE TABLE %s (%s)' % (qt, ','.join(columns)))
+        writer = bdb._sqlite3.cursor()
+        batch = cursor.fetchmany(arraysize)
+        while batch:
+            writer.executemany(insert, batch)
+            rows += len(batch)
+            batch = cursor.fetchmany(arraysize)
+    return rows
+
+
+class ResultStream(object):
+    """Lazy iterator over the result of a query, in DataFrames of at most
+    `chunksize` rows.
+
+    Displaying the stream in a notebook fetches and renders only the first
+    page of rows. Iterating over the stream, or writing it with `to_csv` or
+    `to_parquet`, fetches one chunk at a time, so the full result is never
+    held in memory. A stream can be iterated only once. As chunks are
+    converted one at a time, a float column falls back to objects only from
+    the chunk holding its first value that cannot be converted.
+
+    `exclusive` is an optional nullary callable returning a context manager
+    which is held while fetching each chunk, e.g. `JobManager.exclusive`.
+    """
+
+    page_rows = 50
+
+    def __init__(self, cursor, chunksize, stattypes=None, exclusive=None):
+        self.chunksize = chunksize
+        self.rows = 0
+        self._cursor = cursor
+        self._batches = _column_batches(cursor, stattypes, chunksize)
+        self._exclusive = exclusive or _unlocked
+        self._first = None
+        self._pending = []
+        self._iterated = False
+
+    def head(self):
+        """Returns the first chunk, or None if the result is empty."""
+        if self._first is None and not self._iterated:
+            chunk = self._fetch()
+            if chunk is not None:
+                self._pending.append(chunk)
+        return self._first
+
+    def __iter__(self):
+        if self._iterated:
+            raise ValueError('The result stream has already been consumed.')
+        self._iterated = True
+        while self._pending:
+            yield self._pending.pop(0)
+        while True:
+            chunk = self._fetch()
+            if chunk is None:
+                return
+            yield chunk
+
+    def to_csv(self, path, **kwargs):
+        """Writes the stream to the CSV file `path`, one chunk at a time.
+
+        Returns the number of rows written.
+        """
+        rows = 0
+        with open(path, 'w') as f:
+            for chunk in self:
+                chunk.to_csv(f, header=(rows == 0), index=False, **kwargs)
+                rows += len(chunk)
+        return rows
+
+    def to_parquet(self, path):
+        """Writes the stream to the Parquet file `path`, one chunk at a time.
+
+        Returns the number of rows written. Requires pyarrow.
+        """
+        import pyarrow
+        import pyarrow.parquet
+        rows = 0
+        writer = None
+        try:
+            for chunk in self:
+                table = pyarrow.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pyarrow.parquet.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+                rows += len(chunk)
+        finally:
+            if writer is not None:
+                writer.close()
+        return rows
+
+    def _fetch(self):
+        with self._exclusive():
+            with self._cursor.connection.savepoint():
+                batch = next(self._batches, None)
+        if batch is None:
+            return None
+        chunk = _columns_to_df(*batch)
+        chunk.index += self.rows
+        self.rows += len(chunk)
+        if self._first is None:
+            self._first = chunk
+        return chunk
+
+    def _footer(self):
+        return 'First %d rows of a result streamed in chunks of %d rows.' \
+            % (min(self.rows, self.page_rows), self.chunksize)
+
+    def _repr_html_(self):
+        head = self.head()
+        if head is None:
+            return '<p>Empty result.</p>'
+        return '%s<p>%s</p>' % (
+            head.head(self.page_rows).to_html(), self._footer())
+
+    def __repr__(self):
+        head = self.head()
+        if head is None:
+            return 'Empty result.'
+        return '%s\n%s' % (
+            head.head(self.page_rows).to_string(), self._footer())
+
+
+@contextmanager
+def _unlocked():
+    yield
+
+
+def _value_batches(cursor, stattypes, arraysize):
+    """Yields, for each batch of `arraysize` rows of `cursor`, the column
+    names, their declared dtypes and a tuple of values per column."""
+    rows = cursor.fetchmany(arraysize)
+    if not rows:
+        return
+    names = [desc[0] for desc in cursor.description]
+    stattypes = {
+        casefold(name): casefold(stattype)
+        for name, stattype in (stattypes or {}).iteritems()
+    }
+    dtypes = [_column_dtype(desc, stattypes) for desc in cursor.description]
+    while rows:
+        yield names, dtypes, zip(*rows)
+        rows = cursor.fetchmany(arraysize)
+
+
+def _column_batches(cursor, stattypes, arraysize):
+    """Yields the column names and, for each batch of `arraysize` rows of
+    `cursor`, a list with one array per column. A float column falls back to
+    objects from the first batch in which a value cannot be converted."""
+    dtypes = None
+    for names, declared, values in _value_batches(
+            cursor, stattypes, arraysize):
+        columns = [
+            _column_array(column, dtype)
+            for column, dtype in zip(values, dtypes or declared)
+        ]
+        dtypes = [column.dtype for column in columns]
+        yield names, columns
+
+
+def _column_array(values, dtype):
+    """Returns `values` in an array of floats if `dtype` is float and they
+    can all be converted, and in an array of objects otherwise."""
+    if dtype == float:
+        try:
+            return np.array(values, dtype=float)
+        except (TypeError, ValueError):
+            pass
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+
+class _ColumnBuffer(object):
+    """Array of the values of a column, filled one batch at a time.
+
+    The array is allocated with the dtype of the column, and its capacity is
+    doubled whenever a batch does not fit. A float column keeps the text it
+    converts, by position, until it falls back to objects or is finished.
+    """
+
+    def __init__(self, dtype, capacity):
+        self.size = 0
+        self.array = np.empty(capacity, dtype=dtype)
+        self.text = {}
+
+    def extend(self, values):
+        n = len(values)
+        if self.size + n > len(self.array):
+            grown = np.empty(
+                max(2 * len(self.array), self.size + n), dtype=self.array.dtype)
+            grown[:self.size] = self.array[:self.size]
+            self.array = grown
+        if self.array.dtype == float:
             try:
-                df[col] = df[col].astype(float)
-            except ValueError:
-                pass
+                self.array[self.size:self.size + n] = np.array(
+                    values, dtype=float)
+            except (TypeError, ValueError):
+                self._fall_back()
+            else:
+                for i, value in enumerate(values):
+                    if isinstance(value, basestring):
+                        self.text[self.size + i] = value
+                self.size += n
+                return
+        self.array[self.size:self.size + n] = values
+        self.size += n
+
+    def finish(self):
+        """Returns the array of the values, trimmed to their number."""
+        self.array.resize(self.size, refcheck=False)
+        self.text = None
+        return self.array
+
+    def _fall_back(self):
+        column = np.empty(len(self.array), dtype=object)
+        column[:self.size] = self.array[:self.size]
+        for i, value in self.text.iteritems():
+            column[i] = value
+        self.array = column
+        self.text = None
+
+
+def _columns_to_df(names, columns):
+    # Build from positions, since query results may repeat column names.
+    df = pd.DataFrame(OrderedDict(enumerate(columns)))
+    df.columns = names
     return df
 
 
-def query(bdb, bql, bindings=None, logger=None):
-    """Execute the `bql` query on the `bdb` instance."""
+_NOMINAL = ('categorical', 'nominal')
+
+
+def _column_dtype(desc, stattypes):
+    """Returns the dtype for a column, given its cursor description."""
+    stattype = stattypes.get(casefold(desc[0]))
+    if stattype is not None:
+        return object if stattype in _NOMINAL else float
+    # Declared type, available for columns selected directly from a table.
+    decltype = desc[1] if len(desc) > 1 else None
+    if isinstance(decltype, basestring):
+        # SQLite rules for determining the affinity of a declared type.
+        decltype = decltype.upper()
+        if 'INT' not in decltype and any(
+                t in decltype for t in ['CHAR', 'CLOB', 'TEXT']):
+            return object
+    return float
+
+
+def query(bdb, bql, bindings=None, logger=None, cache=None, stattypes=None):
+    """Execute the `bql` query on the `bdb` instance.
+
+    If `cache` is a `QueryCache`, the results of read-only queries are served
+    from and stored in it, and any other statement invalidates it. The dict
+    `stattypes` is passed to `cursor_to_df`.
+    """
     if bindings is None:
         bindings = ()
+    if cache is not None:
+        cache.observe(bql)
+        df = cache.get(bql, bindings)
+        if df is not None:
+            if logger:
+                logger.info("BQL (cached) [%s] %s", bql, bindings)
+            return df
     if logger:
         logger.info("BQL [%s] %s", bql, bindings)
     cursor = bdb.execute(bql, bindings)
-    return cursor_to_df(cursor)
+    df = cursor_to_df(cursor, stattypes=stattypes)
+    if cache is not None:
+        cache.put(bql, bindings, df)
+    return df
+
+
+# Statements whose results depend only on the state of the bdb. SIMULATE is
+# deliberately absent, since re-running it is expected to draw fresh samples.
+_CACHEABLE = ('ESTIMATE', 'INFER', 'SELECT')
+
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"")
+
+# Quoted strings and names, comments, parentheses and statement terminators.
+# Unterminated quotes and comments extend to the end of the text.
+_STATEMENT_TOKEN = re.compile(r"""
+      '(?:[^']|'')*'?
+    | "(?:[^"]|"")*"?
+    | --[^\n]*
+    | \#[^\n]*
+    | /\*.*?(?:\*/|\Z)
+    | [;()]
+""", re.VERBOSE | re.DOTALL)
+
+
+# Seconds of inference per step of an ANALYZE for a duration.
+ANALYZE_STEP_SECONDS = 5
+
+_ANALYZE = re.compile(r"""
+    ^(\s*ANALYZE\s.*?\sFOR\s+)(\d+)\s+(ITERATIONS?|SECONDS?|MINUTES?)\b(.*)$
+""".strip(), re.VERBOSE | re.IGNORECASE | re.DOTALL)
+
+
+def analyze_steps(bql):
+    """Return the statements running the ANALYZE `bql` in short steps.
+
+    An ANALYZE for a number of iterations is run one iteration at a time, and
+    one for a duration `ANALYZE_STEP_SECONDS` at a time, with the rest of the
+    statement unchanged. Returns None if `bql` is not such an ANALYZE.
+    """
+    match = _ANALYZE.match(bql)
+    if match is None:
+        return None
+    (head, count, unit, tail) = match.groups()
+    count = int(count)
+    if unit.upper().startswith('ITERATION'):
+        return ['%s1 ITERATIONS%s' % (head, tail)] * count
+    if unit.upper().startswith('MINUTE'):
+        count *= 60
+    return [
+        '%s%d SECONDS%s' % (head, min(ANALYZE_STEP_SECONDS, count - i), tail)
+        for i in xrange(0, count, ANALYZE_STEP_SECONDS)
+    ]
+
+
+def normalize_bql(bql):
+    """Collapse whitespace outside of quoted strings and strip semicolons."""
+    pieces = []
+    start = 0
+    for match in _LITERAL.finditer(bql):
+        pieces.append(re.sub(r'\s+', ' ', bql[start:match.start()]))
+        pieces.append(match.group())
+        start = match.end()
+    pieces.append(re.sub(r'\s+', ' ', bql[start:]))
+    return ''.join(pieces).strip().rstrip(';').rstrip()
+
+
+def split_statements(text):
+    """Split `text` into statements at the semicolons terminating them.
+
+    Semicolons inside parentheses, such as the clauses of a schema or of an
+    ANALYZE, and inside quoted strings, quoted names and comments do not end
+    a statement. Comments are `--` and `#` to the end of the line, and
+    `/* */`. In a statement starting with `.`, i.e. a dot command, `--` and
+    `#` introduce options rather than comments. The text is scanned once, so
+    the cost is linear in its length. The terminating semicolons are dropped,
+    as are statements consisting only of whitespace and comments.
+    """
+    statements = []
+    start = 0
+    end = 0
+    depth = 0
+    content = False
+    dot = False
+    while True:
+        match = _STATEMENT_TOKEN.search(text, end)
+        if match is None:
+            break
+        token = match.group()
+        gap = text[end:match.start()]
+        if not content and gap.strip():
+            content = True
+            dot = gap.lstrip().startswith('.')
+        if token == ';' and depth == 0:
+            if content:
+                statements.append(text[start:match.start()].strip())
+            start = match.end()
+            content = dot = False
+        elif token in '();':
+            content = True
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                depth = max(depth - 1, 0)
+        elif token[0] in '\'"':
+            content = True
+        elif dot:
+            # Not a comment: resume scanning just past its first character.
+            end = match.start() + 1
+            continue
+        end = match.end()
+    if content or text[end:].strip():
+        statements.append(text[start:].strip())
+    return statements
+
+
+class QueryCache(object):
+    """LRU cache of query results, bounded by their total memory footprint.
+
+    Entries are keyed on the normalized text of the query, its bindings, and
+    the generation of the bdb. The generation is advanced by `invalidate`,
+    which `observe` calls for every statement that may modify the bdb, such
+    as ANALYZE, INITIALIZE, DROP, INSERT or any MML definition.
+    """
+
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.generation = 0
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def cacheable(self, bql):
+        tokens = normalize_bql(bql).split(None, 1)
+        return bool(tokens) and tokens[0].upper() in _CACHEABLE
+
+    def observe(self, bql):
+        """Invalidate the cache unless `bql` is a read-only query."""
+        if not self.cacheable(bql):
+            self.invalidate()
+
+    def get(self, bql, bindings=()):
+        """Return a copy of the cached result of `bql`, or None."""
+        if not self.cacheable(bql):
+            return None
+        key = self._key(bql, bindings)
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            df, nbytes = self._entries.pop(key)
+            self._entries[key] = (df, nbytes)
+            self.hits += 1
+        return df.copy()
+
+    def put(self, bql, bindings, df):
+        if not self.cacheable(bql):
+            return
+        nbytes = int(df.memory_usage(index=True, deep=True).sum())
+        if nbytes > self.max_bytes:
+            return
+        key = self._key(bql, bindings)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (df.copy(), nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _key, (_df, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+                self.evictions += 1
+
+    def invalidate(self):
+        """Advance the generation, discarding every cached result."""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self.nbytes = 0
+
+    def clear(self):
+        self.invalidate()
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        return pd.DataFrame([(
+            len(self._entries), self.nbytes, self.max_bytes, self.hits,
+            self.misses, self.evictions, self.generation,
+        )], columns=[
+            'entries', 'bytes', 'max_bytes', 'hits', 'misses', 'evictions',
+            'generation',
+        ])
+
+    def _key(self, bql, bindings):
+        if isinstance(bindings, dict):
+            bindings = sorted(bindings.iteritems())
+        return (self.generation, normalize_bql(bql), tuple(bindings))
 
 
 def subsample_table_columns(bdb, table, new_table, limit, keep, drop, seed):
@@ -130,3 +894,50 @@ def subsample_table_columns(bdb, table, new_table, limit, keep, drop, seed):
         CREATE TABLE %s AS SELECT %s FROM %s
     ''' % (qnt, qc, qt))
     return cursor_to_df(cursor)
+
+
+def sample_table_rows(bdb, table, limit, seed=None):
+    """Returns a uniform random sample of `limit` rows of the table.
+
+    The rowids are reservoir sampled in one pass over the table (Li's
+    Algorithm L, which draws random numbers only for the rows it keeps) and
+    the sampled rows are then read by rowid, so the table is never sorted.
+    Returns the column names, the sampled rows in rowid order, and the total
+    number of rows in the table.
+    """
+    if not bayesdb_has_table(bdb, table):
+        raise ValueError('No such table: %s' % (table,))
+    if limit < 1:
+        raise ValueError('Sample size must be positive: %r' % (limit,))
+    qt = bql_quote_name(table)
+    columns = bayesdb_table_column_names(bdb, table)
+    rng = np.random.RandomState(seed)
+    with bdb.savepoint():
+        cursor = iter(bdb.sql_execute('SELECT oid FROM %s' % (qt,)))
+        reservoir = [rowid for (rowid,) in itertools.islice(cursor, limit)]
+        count = len(reservoir)
+        if count == limit:
+            # Random numbers in (0, 1], whose logarithm is finite.
+            uniform = lambda: 1 - rng.random_sample()
+            w = np.exp(np.log(uniform()) / limit)
+            while True:
+                skip = int(np.floor(np.log(uniform()) / np.log1p(-w)))
+                skipped = sum(1 for _row in itertools.islice(cursor, skip))
+                count += skipped
+                row = next(cursor, None) if skipped == skip else None
+                if row is None:
+                    break
+                count += 1
+                reservoir[rng.randint(limit)] = row[0]
+                w *= np.exp(np.log(uniform()) / limit)
+        reservoir.sort()
+        select = 'SELECT %s FROM %s WHERE oid IN (%%s) ORDER BY oid' % (
+            ','.join(map(bql_quote_name, columns)), qt)
+        rows = []
+        # Stay below the default limit of 999 parameters per statement.
+        for start in xrange(0, len(reservoir), 500):
+            rowids = reservoir[start:start + 500]
+            cursor = bdb.sql_execute(
+                select % (','.join('?' for _rowid in rowids),), rowids)
+            rows.extend(cursor.fetchall())
+    return columns, rows, count
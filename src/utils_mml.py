@@ -16,6 +16,11 @@
 
 import StringIO
 
+from collections import Counter
+from itertools import izip
+
+import numpy as np
+
 from bayeslite import bql_quote_name
 from bayeslite.core import bayesdb_get_population
 from bayeslite.core import bayesdb_population_table
@@ -23,16 +28,71 @@ from bayeslite.core import bayesdb_variable_names
 from bayeslite.core import bayesdb_variable_number
 from bayeslite.core import bayesdb_variable_stattype
 from bayeslite.exception import BQLError
+from bayeslite.guess import bayesdb_guess_stattypes
 
 from iventure import utils_bql
+from iventure import utils_profile
+
+
+def guess_sample_stattypes(columns, rows, seed=None, resamples=20):
+    """Guesses the stattypes of columns from a sample of their rows.
+
+    The stattypes are guessed by bayeslite, as in GUESS SCHEMA. Returns a
+    list of (stattype, reason, confidence, unseen) tuples, one per column.
+    The confidence is the fraction of random half-size subsamples of `rows`
+    from which the same stattype is guessed. For nominal columns, `unseen`
+    is the Good-Turing estimate of the fraction of values in the full table
+    belonging to categories that the sample missed, namely the fraction of
+    sampled values seen exactly once; it is 0 otherwise.
+    """
+    rng = np.random.RandomState(seed)
+    n = len(rows)
+    half = n // 2
+    guessed = bayesdb_guess_stattypes(columns, rows)
+    agree = [0] * len(columns)
+    for _i in xrange(resamples if half else 0):
+        subsample = [rows[i] for i in rng.choice(n, half, replace=False)]
+        for j, guess in enumerate(bayesdb_guess_stattypes(columns, subsample)):
+            agree[j] += guess[0] == guessed[j][0]
+    guesses = []
+    for j, values in enumerate(izip(*rows) if rows else [()] * len(columns)):
+        (stattype, reason) = guessed[j][:2]
+        counter = Counter(v for v in values if v is not None)
+        present = sum(counter.itervalues())
+        singletons = sum(1 for count in counter.itervalues() if count == 1)
+        confidence = float(agree[j]) / resamples if half else 0.
+        unseen = float(singletons) / present \
+            if stattype.lower() == 'nominal' and present else 0.
+        guesses.append((stattype, reason, confidence, unseen))
+    return guesses
+
 
+def guess_schema(bdb, table, reasons, sample=None, seed=None):
+    """Returns a guessed MML schema for a population derived from `table`.
 
-def guess_schema(bdb, table, reasons):
-    """Returns a guessed MML schema for a population derived from `table`."""
-    df = utils_bql.query(bdb, 'GUESS SCHEMA FOR %s' % (table,))
-    columns = df['column'].tolist()
-    stattypes = df['stattype'].tolist()
-    reasons = df['reason'].tolist() if reasons else [''] * len(columns)
+    The stattypes are guessed by GUESS SCHEMA, which reads every row of
+    `table`. If `sample` is given, they are instead guessed from a random
+    sample of that many rows, see `utils_bql.sample_table_rows`, and each
+    guess is annotated with its confidence and with the fraction of values
+    estimated to be in nominal categories that the sample missed.
+    """
+    if sample is None:
+        df = utils_bql.query(bdb, 'GUESS SCHEMA FOR %s' % (table,))
+        columns = df['column'].tolist()
+        stattypes = df['stattype'].tolist()
+        reasons = df['reason'].tolist() if reasons else [''] * len(columns)
+    else:
+        columns, rows, row_count = utils_bql.sample_table_rows(
+            bdb, table, sample, seed=seed)
+        guessed = guess_sample_stattypes(columns, rows, seed=seed)
+        stattypes = [stattype for stattype, _r, _c, _u in guessed]
+        reasons = [
+            '%sconfidence %.2f%s' % (
+                reason + '; ' if reasons else '', confidence,
+                '; may miss rare categories, %.1f%% of values'
+                    % (100 * unseen,) if unseen else '')
+            for _s, reason, confidence, unseen in guessed
+        ]
 
     guesses = {
         c: [stattypes[i], reasons[i]]
@@ -40,6 +100,9 @@ def guess_schema(bdb, table, reasons):
     }
 
     schema = StringIO.StringIO()
+    if sample is not None:
+        schema.write('# Guessed from a sample of %d of %d rows.\n' %
+            (len(rows), row_count))
     nominal = []
     numerical = []
     ignore = []
@@ -97,11 +160,16 @@ def guess_schema(bdb, table, reasons):
     schema.close()
     return result
 
-def get_schema_as_list(bdb, population_name):
+def get_schema_as_list(bdb, population_name, profiles=None):
     population_id = bayesdb_get_population(bdb, population_name)
     table_name = bayesdb_population_table(bdb, population_id)
     qt = bql_quote_name(table_name)
     variable_names = bayesdb_variable_names(bdb, population_id, None)
+    # With a ProfileCache, nominal values are read from the profile of the
+    # base table, unless a variable has more distinct values than it keeps.
+    profile = None
+    if profiles is not None:
+        profile = profiles.get(bdb, table_name)
     schema = []
     for variable_name in variable_names:
         colno =  bayesdb_variable_number(
@@ -117,12 +185,20 @@ def get_schema_as_list(bdb, population_name):
             'stat_type' : stattype_lookup[stattype]
         }
         if stattype == 'nominal':
-            qv = bql_quote_name(variable_name)
-            values = utils_bql.query(bdb, '''
-                SELECT DISTINCT(%s) FROM %s
-                WHERE %s IS NOT NULL
-            ''' % (qv, qt, qv,))
-            schema_entry['unique_values'] = \
-                values[values.columns[0]].unique().tolist()
+            values = None
+            if profile is not None:
+                [entry] = utils_profile.lookup_columns(
+                    profile, [variable_name]).itertuples()
+                if entry.exact and \
+                        entry.distinct_count <= len(entry.top_values):
+                    values = [value for value, _count in entry.top_values]
+            if values is None:
+                qv = bql_quote_name(variable_name)
+                values = utils_bql.query(bdb, '''
+                    SELECT DISTINCT(%s) FROM %s
+                    WHERE %s IS NOT NULL
+                ''' % (qv, qt, qv,))
+                values = values[values.columns[0]].unique().tolist()
+            schema_entry['unique_values'] = values
         schema.append(schema_entry)
     return schema
@@ -14,8 +14,24 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import StringIO
+import cPickle as pickle
+import hashlib
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from collections import OrderedDict
+
 import matplotlib.cm
+import matplotlib.collections
 import matplotlib.colors
+import matplotlib.figure
+import matplotlib.gridspec
+import matplotlib.ticker
 import matplotlib.pyplot as plt
 
 import numpy as np
@@ -29,6 +45,8 @@ def density(df, ax=None, **kwargs):
 
     If df has one column, then a regular kdeplot is produced. If df has two
     columns, then the final column is used as the label for each data point.
+    The densities are computed by `binned_kde`, and the rug of each label is
+    thinned by `thin_rug`.
     """
     if df.shape[1] not in [1, 2]:
         raise ValueError('Only one or two columns allowed: %s' % df.columns)
@@ -59,10 +77,12 @@ def density(df, ax=None, **kwargs):
     sns.set_style('white')
     for label, color in zip(labels, colors):
         points = _filter_points(df, labels, label)
-        sns.kdeplot(
-            points.iloc[:,0], color=color, shade=shade, ax=ax, legend=False)
+        grid, density = binned_kde(points.iloc[:,0])
+        ax.plot(grid, density, color=color)
+        if shade:
+            ax.fill_between(grid, 1e-12, density, facecolor=color, alpha=.25)
         if rug:
-            sns.rugplot(points.iloc[:,0], color=color, ax=ax)
+            _rugplot(ax, thin_rug(points.iloc[:,0]), color)
     ax.set_xlabel(df.columns[0], fontweight='bold')
     ax.set_ylabel('Density', fontweight='bold')
     ax.grid()
@@ -75,6 +95,68 @@ def density(df, ax=None, **kwargs):
 
     return fig
 
+# Density plots evaluate the KDE at this many points.
+KDE_GRIDSIZE = 512
+# Rugs of more points than this are thinned, see `thin_rug`.
+RUG_THRESHOLD = 1000
+
+
+def binned_kde(values, gridsize=KDE_GRIDSIZE, cut=3):
+    """Returns a Gaussian KDE of values as arrays (grid, density).
+
+    The bandwidth follows Scott's rule, as in seaborn.kdeplot, and the grid
+    extends `cut` bandwidths past the extreme values. The values are linearly
+    binned onto the grid and the counts are convolved with the kernel by FFT,
+    which takes O(n + gridsize log gridsize) time for n values instead of the
+    O(n gridsize) of evaluating the kernel at every value.
+    """
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    bw = np.std(values, ddof=1) * n ** -.2 if n > 1 else 0.
+    if not bw > 0:
+        # Constant values have no spread to estimate a bandwidth from.
+        bw = max(abs(values[0]), 1.) * .1
+    low = values.min() - cut * bw
+    high = values.max() + cut * bw
+    grid, delta = np.linspace(low, high, gridsize, retstep=True)
+    position = (values - low) / delta
+    left = np.minimum(position.astype(int), gridsize - 2)
+    right = position - left
+    counts = np.bincount(left, 1 - right, gridsize) \
+        + np.bincount(left + 1, right, gridsize)
+    offsets = np.arange(-(gridsize - 1), gridsize) * delta / bw
+    kernel = np.exp(-.5 * offsets ** 2) / (bw * (2 * np.pi) ** .5)
+    size = 1 << int(np.ceil(np.log2(3 * gridsize - 2)))
+    density = np.fft.irfft(
+        np.fft.rfft(counts, size) * np.fft.rfft(kernel, size), size)
+    density = density[gridsize - 1:2 * gridsize - 1] / n
+    return grid, np.maximum(density, 0)
+
+
+def thin_rug(values, threshold=RUG_THRESHOLD):
+    """Returns at most about `threshold` of values to draw as a rug.
+
+    The range of values is split into `threshold` bins and the smallest value
+    of each occupied bin is kept. Rug marks closer than a bin are drawn on top
+    of each other at any legible size, so the plot looks the same.
+    """
+    values = np.sort(np.asarray(values, dtype=float))
+    if len(values) <= threshold:
+        return values
+    fractions = _grid_fractions(values)
+    bins = np.minimum((fractions * threshold).astype(int), threshold - 1)
+    _bins, first = np.unique(bins, return_index=True)
+    return values[first]
+
+
+def _rugplot(ax, values, color, height=.05):
+    """Draws values as tick marks along the x-axis, in a single collection."""
+    segments = [[(value, 0), (value, height)] for value in values]
+    ax.add_collection(matplotlib.collections.LineCollection(
+        segments, colors=[color], transform=ax.get_xaxis_transform()),
+        autolim=False)
+
+
 def scatter(df, ax=None, **kwargs):
     """Scatter the NUMERICAL data points in df.
 
@@ -95,12 +177,18 @@ def scatter(df, ax=None, **kwargs):
     if 'colors' in kwargs:
         assert len(kwargs['colors']) == len(labels)
         colors = kwargs['colors']
+    total = len(df)
+    df, dropped = downsample_points(
+        df, int(kwargs.get('max_points', SCATTER_MAX_POINTS)))
     for label, color in zip(labels, colors):
         points = _filter_points(df, labels, label)
         ax.scatter(points.iloc[:,0], points.iloc[:,1], color=color, label=label)
     ax.set_xlabel(df.columns[0], fontweight='bold')
     ax.set_ylabel(df.columns[1], fontweight='bold')
     ax.grid()
+    if dropped:
+        ax.text(1, 1.01, downsample_note(total, dropped), fontsize='small',
+            ha='right', va='bottom', transform=ax.transAxes)
 
     # Plot the legend if there are three columns.
     if df.shape[1] == 3:
@@ -113,6 +201,61 @@ def scatter(df, ax=None, **kwargs):
     return fig
 
 
+# Scatter plots keep at most this many points by default.
+SCATTER_MAX_POINTS = 100000
+
+
+def downsample_points(df, max_points, seed=0):
+    """Returns at most `max_points` rows of df, and the number of rows dropped.
+
+    The first two columns of df are binned on a grid, separately for each
+    label in the third column if there is one, and one random row of each
+    occupied cell is kept, so that outliers, sparse regions and rare labels
+    survive. The rest of the budget is spent on a uniform sample of the other
+    rows, which preserves the density of crowded regions. The grid is made
+    coarser until the representatives fit in `max_points`.
+    """
+    n = len(df)
+    if n <= max_points:
+        return df, 0
+    rng = np.random.RandomState(seed)
+    order = rng.permutation(n)
+    codes = pd.factorize(df.iloc[:,2])[0] if df.shape[1] == 3 \
+        else np.zeros(n, dtype=int)
+    x = _grid_fractions(df.iloc[:,0])
+    y = _grid_fractions(df.iloc[:,1])
+    side = max(int((max_points / 2.) ** .5), 1)
+    while True:
+        ix = np.minimum((x * side).astype(int), side - 1)
+        iy = np.minimum((y * side).astype(int), side - 1)
+        cells = (codes * side + ix) * side + iy
+        _cells, first = np.unique(cells[order], return_index=True)
+        if len(first) <= max_points or side == 1:
+            break
+        side //= 2
+    keep = order[first][:max_points]
+    rest = np.ones(n, dtype=bool)
+    rest[keep] = False
+    fill = rng.choice(
+        np.flatnonzero(rest), max_points - len(keep), replace=False)
+    keep = np.sort(np.concatenate([keep, fill]))
+    return df.iloc[keep], n - max_points
+
+
+def downsample_note(total, dropped):
+    """Returns the annotation of a plot of `total` points with some dropped."""
+    return 'Showing %d of %d points (%d dropped)' % (
+        total - dropped, total, dropped)
+
+
+def _grid_fractions(values):
+    """Returns the positions of values in their range, between 0 and 1."""
+    values = np.asarray(values, dtype=float)
+    low, high = values.min(), values.max()
+    return (values - low) / (high - low) if high > low \
+        else np.zeros(len(values))
+
+
 def bar(df, ax=None, **kwargs):
     """Vertical barplot of data in df.
 
@@ -181,20 +324,34 @@ def histogram_nominal(df, ax=None, **kwargs):
 
     If df has one column, then a regular histogram is produced. If df has two
     columns, then the final column is used as the label for each data point.
+
+    The optional `weights` are the number of times each row of df occurs,
+    for data points already counted, e.g. by `utils_bql.histogram_counts`.
     """
     if df.shape[1] not in [1, 2]:
         raise ValueError('Only one or two columns allowed: %s' % df.columns)
     else:
+        weights = _weights(df, kwargs.pop('weights', None))
         df = _preprocess_dataframe(df)
+        weights = weights[df.index]
     if ax is None:
         fig, ax = plt.subplots()
     else:
         fig = ax.get_figure()
-    # Retrieve the nominal values, sorted by overall frequency.
-    nominals = df.iloc[:,0].value_counts().index.tolist()
     # Retrieve the labels.
     labels, colors = _retrieve_labels_colors(
         df.iloc[:,1] if df.shape[1] == 2 else [0] * len(df))
+    # Count each nominal value for each label in one pass, and sort the
+    # nominal values by overall frequency.
+    counts = _count_matrix(
+        df.iloc[:,0],
+        df.iloc[:,1] if df.shape[1] == 2 else np.zeros(len(df), dtype=int),
+        weights,
+    ).reindex(columns=labels, fill_value=0)
+    counts = counts.loc[counts.sum(axis=1).sort_values(ascending=False).index]
+    if 'normed' in kwargs:
+        counts = counts / counts.sum(axis=0)
+    nominals = counts.index.tolist()
     # Compute the offset for each label.
     offset = len(labels)/2 + len(labels) % 2
     width = 0.25
@@ -204,13 +361,9 @@ def histogram_nominal(df, ax=None, **kwargs):
     assert len(indices) == len(nominals)
     # Histogram each series.
     for i, (label, color) in enumerate(zip(labels, colors)):
-        points = _filter_points(df, labels, label)
-        raw_counts = points.iloc[:,0].value_counts()
-        normalizer = float(sum(raw_counts)) if 'normed' in kwargs else 1.
-        counts = [raw_counts.get(n, 0) / normalizer for n in nominals]
         ax.barh(
             [index - 0.2*offset + i*width for index in indices],
-            counts, width, color=color, alpha=.7, label=label)
+            counts.iloc[:,i].values, width, color=color, alpha=.7, label=label)
     # Fix up the axes and their labels.
     ax.set_xlabel('Frequency', fontweight='bold')
     ax.set_ylabel(df.columns[0], fontweight='bold')
@@ -233,11 +386,21 @@ def histogram_numerical(df, ax=None, **kwargs):
 
     If df has one column, then a regular histogram is produced. If df has two
     columns, then the final column is used as the label for each data point.
+
+    The data points are grouped into `bins` bins (default 10), or into the
+    bins between the given edges. The optional `weights` are the number of
+    times each row of df occurs, for data points already counted, e.g. by
+    `utils_bql.histogram_counts`.
     """
     if df.shape[1] not in [1, 2]:
         raise ValueError('Only one or two columns allowed: %s' % df.columns)
     else:
+        weights = _weights(df, kwargs.pop('weights', None))
         df = _preprocess_dataframe(df)
+        weights = weights[df.index]
+    bins = kwargs.pop('bins', 10)
+    if isinstance(bins, basestring):
+        bins = int(bins)
     if ax is None:
         fig, ax = plt.subplots()
     else:
@@ -246,9 +409,11 @@ def histogram_numerical(df, ax=None, **kwargs):
         df.iloc[:,1] if df.shape[1] == 2 else [0] * len(df))
     data = [df[df.iloc[:,1]==l].iloc[:,0].values for l in labels]\
         if df.shape[1] == 2 else df.iloc[:,0]
+    weights = [weights[df.iloc[:,1]==l].values for l in labels]\
+        if df.shape[1] == 2 else weights.values
     ax.hist(
-        data, 10, normed=kwargs.pop('normed', None), histtype='bar',
-        color=colors, label=labels, alpha=0.7)
+        data, bins, normed=kwargs.pop('normed', None), histtype='bar',
+        weights=weights, color=colors, label=labels, alpha=0.7)
     # Fix up the axes and their labels.
     ax.set_ylabel('Frequency', fontweight='bold')
     ax.set_xlabel(df.columns[0], fontweight='bold')
@@ -270,33 +435,39 @@ def histogram_numerical(df, ax=None, **kwargs):
 def clustermap(df, ax=None, **kwargs):
     """Plot a clustermap by pivoting the last 3 columns of `df`.
 
-    The `df` is typically returned from an ESTIMATE PAIRWISE query in BQL.
+    The `df` is typically returned from an ESTIMATE PAIRWISE query in BQL, or
+    is a `PairwiseMatrix`, which is plotted without pivoting.
+
+    Matrices of more than `RASTER_THRESHOLD` variables, or any matrix when
+    `raster` is set, are drawn as a single image; setting `blocks` to a
+    distance collapses the clusters below that distance into blocks.
     """
-    if len(df.columns) < 3:
-        raise ValueError('At least three columns requried: %s' % (df.columns,))
     # Pivot the matrix.
-    pivot = df.pivot(
-        index=df.columns[-3],
-        columns=df.columns[-2],
-        values=df.columns[-1],
-    )
-    pivot.fillna(0, inplace=True)
+    matrix = PairwiseMatrix.coerce(df)
     # Check if all values are between 0 and 1 to set vmin and vmax.
-    (vmin, vmax) = (None, None)
-    if all(0 <= v <= 1 for v in df.iloc[:,-1]):
-        (vmin, vmax) = (0, 1)
-    zmatrix =  _clustermap(
-        pivot.as_matrix(),
-        xticklabels=pivot.columns.tolist(),
-        yticklabels=pivot.index.tolist(),
-        vmin=vmin,
-        vmax=vmax
-    )
+    (vmin, vmax) = (0, 1) if matrix.is_unit() else (None, None)
     # Heuristics for the size.
     figsize = kwargs.pop('figsize', None)
     if figsize is None:
-        half_root_col = (df.shape[0] ** .5) / 2.
+        half_root_col = (matrix.values.size ** .5) / 2.
         figsize = (half_root_col, .8 * half_root_col)
+    if _raster_mode(matrix.values.shape, kwargs):
+        return _raster_clustermap(
+            matrix.values,
+            matrix.columns,
+            matrix.index,
+            vmin=vmin,
+            vmax=vmax,
+            blocks=kwargs.get('blocks', None),
+            figsize=_raster_figsize(figsize),
+        )
+    zmatrix =  _clustermap(
+        matrix.values,
+        xticklabels=list(matrix.columns),
+        yticklabels=list(matrix.index),
+        vmin=vmin,
+        vmax=vmax
+    )
     zmatrix.fig.set_size_inches(figsize)
     return zmatrix
 
@@ -304,29 +475,36 @@ def clustermap(df, ax=None, **kwargs):
 def heatmap(df, ax=None, **kwargs):
     """Plot a heatmap by pivoting the last 3 columns of `df`.
 
-    The `df` is a "tidy-dataframe" i.e. from an ESTIMATE PAIRWISE query in BQL.
+    The `df` is a "tidy-dataframe" i.e. from an ESTIMATE PAIRWISE query in BQL,
+    or a `PairwiseMatrix`, which is plotted without pivoting.
+
+    Matrices of more than `RASTER_THRESHOLD` variables, or any matrix when
+    `raster` is set, are drawn as a single image; setting `blocks` to a
+    distance collapses the clusters below that distance into blocks.
     """
-    if len(df.columns) < 3:
-        raise ValueError('At least three columns requried: %s' % (df.columns,))
     from .seaborn import apionly as sns
     # Pivot the matrix.
-    pivot = df.pivot(
-        index=df.columns[-3],
-        columns=df.columns[-2],
-        values=df.columns[-1],
-    )
-    pivot.fillna(0, inplace=True)
+    matrix = PairwiseMatrix.coerce(df)
     # Check if all values are between 0 and 1 to set vmin and vmax.
-    (vmin, vmax) = (None, None)
-    if all(0 <= v <= 1 for v in df.iloc[:,-1]):
-        (vmin, vmax) = (0, 1)
-    # Apply the optimal ordering from a clustermap.
-    D = pivot.as_matrix()
-    (xordering, yordering) = _clustermap_ordering(D)
-    xticklabels = np.asarray(pivot.columns)[xordering]
-    yticklabels = np.asarray(pivot.index)[yordering]
-    D = D[:,xordering]
-    D = D[yordering,:]
+    (vmin, vmax) = (0, 1) if matrix.is_unit() else (None, None)
+    # Heuristics for the size.
+    figsize = kwargs.pop('figsize', None)
+    if figsize is None:
+        half_root_col = (matrix.values.size ** .5) / 2.5
+        figsize = (half_root_col, .8 * half_root_col)
+    # Apply the optimal ordering from a hierarchical clustering.
+    raster = _raster_mode(matrix.values.shape, kwargs)
+    (D, xticklabels, yticklabels) = _ordered_matrix(
+        matrix.values, matrix.columns, matrix.index,
+        blocks=kwargs.get('blocks', None))
+    if raster:
+        if ax is None:
+            ax = plt.gca()
+        ax.get_figure().set_size_inches(_raster_figsize(figsize))
+        _raster_heatmap(
+            ax, D, xticklabels, yticklabels, vmin=vmin, vmax=vmax,
+            cbar=kwargs.get('cbar', True))
+        return ax
     ax = sns.heatmap(
         D,
         xticklabels=xticklabels,
@@ -338,15 +516,228 @@ def heatmap(df, ax=None, **kwargs):
         vmin=vmin,
         vmax=vmax,
     )
-    # Heuristics for the size.
-    figsize = kwargs.pop('figsize', None)
-    if figsize is None:
-        half_root_col = (df.shape[0] ** .5) / 2.5
-        figsize = (half_root_col, .8 * half_root_col)
     ax.get_figure().set_size_inches(figsize)
     return ax
 
 
+# Matrices with more variables than this are drawn as a single image.
+RASTER_THRESHOLD = 200
+# Largest side, in inches, of the figure of a matrix drawn as an image.
+RASTER_FIGSIZE = 12.
+# Range of the font size, in points, of the tick labels of such a figure.
+RASTER_FONTSIZE = (4., 10.)
+
+
+def _raster_mode(shape, kwargs):
+    """Returns whether to draw a matrix of `shape` as a single image."""
+    if 'blocks' in kwargs:
+        return True
+    if 'raster' in kwargs:
+        if kwargs['raster'] in [True, False]:
+            return kwargs['raster']
+        assert kwargs['raster'] in ['True', 'False']
+        return kwargs['raster'] == 'True'
+    return max(shape) > RASTER_THRESHOLD
+
+
+def _raster_figsize(figsize):
+    scale = min(1., RASTER_FIGSIZE / max(figsize))
+    return (figsize[0] * scale, figsize[1] * scale)
+
+
+def _ordered_matrix(D, xlabels, ylabels, blocks=None):
+    """Returns D and its labels in clustered order.
+
+    If `blocks` is a distance, the clusters of rows and of columns below that
+    distance are each collapsed into one, whose entries are the means of the
+    entries of the clusters, and whose label is the first label followed by
+    the number of others.
+    """
+    (xordering, yordering) = matrix_ordering(D)
+    (xlinkage, ylinkage) = matrix_linkage(D)
+    D = D[np.ix_(yordering, xordering)]
+    xlabels = np.asarray(xlabels)[xordering]
+    ylabels = np.asarray(ylabels)[yordering]
+    if blocks is None:
+        return (D, xlabels, ylabels)
+    xstarts = _block_starts(xlinkage, xordering, float(blocks))
+    ystarts = _block_starts(ylinkage, yordering, float(blocks))
+    xsizes = np.diff(np.append(xstarts, len(xordering)))
+    ysizes = np.diff(np.append(ystarts, len(yordering)))
+    sums = np.add.reduceat(np.add.reduceat(D, ystarts, axis=0), xstarts, axis=1)
+    D = sums / np.outer(ysizes, xsizes)
+    return (
+        D,
+        _block_labels(xlabels, xstarts, xsizes),
+        _block_labels(ylabels, ystarts, ysizes),
+    )
+
+
+def _block_starts(linkage, ordering, threshold):
+    """Returns the positions in `ordering` at which each cluster starts."""
+    from scipy.cluster import hierarchy
+    if linkage is None:
+        return np.arange(len(ordering))
+    clusters = hierarchy.fcluster(linkage, threshold, criterion='distance')
+    # Every cluster is a subtree, hence contiguous in the leaf ordering.
+    clusters = clusters[ordering]
+    return np.flatnonzero(np.append(True, clusters[1:] != clusters[:-1]))
+
+
+def _block_labels(labels, starts, sizes):
+    return np.asarray([
+        labels[start] if size == 1 else '%s (+%d)' % (labels[start], size - 1)
+        for start, size in zip(starts, sizes)
+    ])
+
+
+def _raster_heatmap(ax, D, xticklabels, yticklabels, vmin, vmax, cbar=True):
+    """Draws D on `ax` as one image, with as many tick labels as fit."""
+    image = ax.imshow(
+        D,
+        cmap='BuGn',
+        vmin=vmin,
+        vmax=vmax,
+        interpolation='nearest',
+        aspect='auto',
+    )
+    if cbar:
+        ax.get_figure().colorbar(image, ax=ax)
+    _scale_ticklabels(ax, xticklabels, yticklabels)
+    return image
+
+
+def _raster_clustermap(
+        D, xticklabels, yticklabels, vmin, vmax, blocks=None, figsize=None):
+    """Draws D and its dendrograms as in `_clustermap`, as one image."""
+    from scipy.cluster import hierarchy
+    (xlinkage, ylinkage) = matrix_linkage(D)
+    (D, xticklabels, yticklabels) = _ordered_matrix(
+        D, xticklabels, yticklabels, blocks=blocks)
+    fig = plt.figure(figsize=figsize)
+    # Lay out the axes as seaborn does, with the colorbar at the top left.
+    grid = matplotlib.gridspec.GridSpec(
+        2, 2, width_ratios=[.2, 1], height_ratios=[.2, 1],
+        wspace=.02, hspace=.02, right=.85)
+    ax_heatmap = fig.add_subplot(grid[1, 1])
+    ax_row = fig.add_subplot(grid[1, 0])
+    ax_col = fig.add_subplot(grid[0, 1])
+    ax_cbar = matplotlib.gridspec.GridSpecFromSubplotSpec(
+        2, 4, subplot_spec=grid[0, 0], hspace=.5)[0, 1:3]
+    ax_cbar = fig.add_subplot(ax_cbar)
+    ax_heatmap.yaxis.tick_right()
+    image = _raster_heatmap(
+        ax_heatmap, D, xticklabels, yticklabels, vmin, vmax, cbar=False)
+    cbar = fig.colorbar(image, cax=ax_cbar, orientation='horizontal')
+    cbar.locator = matplotlib.ticker.MaxNLocator(3)
+    cbar.update_ticks()
+    for (ax, linkage, n, orientation) in [
+            (ax_row, ylinkage, len(yticklabels), 'left'),
+            (ax_col, xlinkage, len(xticklabels), 'top')]:
+        if linkage is not None:
+            hierarchy.dendrogram(
+                linkage,
+                ax=ax,
+                orientation=orientation,
+                truncate_mode='lastp' if blocks is not None else None,
+                p=n,
+                no_labels=True,
+                color_threshold=-np.inf,
+                above_threshold_color='k',
+            )
+        # Dendrogram leaves are 10 units apart, from the first row at the top.
+        if orientation == 'left':
+            ax.set_ylim(10 * n, 0)
+        else:
+            ax.set_xlim(0, 10 * n)
+        ax.set_axis_off()
+    return fig
+
+
+def _scale_ticklabels(ax, xticklabels, yticklabels):
+    """Labels the ticks of a matrix image, scaling fonts to its size.
+
+    Tick labels are shrunk to fit one per row and column, down to the
+    smallest font size of `RASTER_FONTSIZE`, beyond which only every few
+    labels are shown.
+    """
+    (width, height) = ax.get_figure().get_size_inches()
+    box = ax.get_position()
+    (smallest, largest) = RASTER_FONTSIZE
+    for (axis, labels, inches) in [
+            (ax.xaxis, xticklabels, box.width * width),
+            (ax.yaxis, yticklabels, box.height * height)]:
+        fontsize = min(largest, 72. * inches / max(len(labels), 1))
+        step = int(np.ceil(smallest / fontsize)) if fontsize < smallest else 1
+        ticks = np.arange(0, len(labels), step)
+        axis.set_ticks(ticks)
+        axis.set_ticklabels(
+            [labels[i] for i in ticks], fontsize=max(fontsize, smallest))
+    plt.setp(ax.get_xticklabels(), rotation=90)
+
+
+# Matrices with at most this many rows (or columns) get an optimal leaf
+# ordering, whose cost is cubic in their number, if scipy (>= 1.0) has it.
+OPTIMAL_ORDERING_LIMIT = 512
+
+_LINKAGE_CACHE = OrderedDict()
+_LINKAGE_CACHE_SIZE = 16
+
+
+def matrix_linkage(D):
+    """Returns the (column, row) hierarchical clusterings of the matrix D.
+
+    The linkages use average linkage on euclidean distances, as does
+    `clustermap`, and have their leaves in optimal order for matrices of at
+    most `OPTIMAL_ORDERING_LIMIT` rows and columns if scipy supports it, and
+    the plain linkage order otherwise. Results are cached on a hash of the
+    contents of D.
+    """
+    D = np.ascontiguousarray(D, dtype=float)
+    key = (D.shape, hashlib.sha1(D).hexdigest())
+    if key in _LINKAGE_CACHE:
+        _LINKAGE_CACHE[key] = _LINKAGE_CACHE.pop(key)
+        return _LINKAGE_CACHE[key]
+    ylinkage = _linkage(D)
+    # Pairwise matrices are symmetric, so cluster them once.
+    if D.shape[0] == D.shape[1] and np.array_equal(D, D.T):
+        xlinkage = ylinkage
+    else:
+        xlinkage = _linkage(D.T)
+    _LINKAGE_CACHE[key] = (xlinkage, ylinkage)
+    while len(_LINKAGE_CACHE) > _LINKAGE_CACHE_SIZE:
+        _LINKAGE_CACHE.popitem(last=False)
+    return (xlinkage, ylinkage)
+
+
+def matrix_ordering(D):
+    """Returns the orderings of the columns and rows of D by clustering."""
+    from scipy.cluster import hierarchy
+    (xlinkage, ylinkage) = matrix_linkage(D)
+    return (
+        _leaves(hierarchy, xlinkage, np.shape(D)[1]),
+        _leaves(hierarchy, ylinkage, np.shape(D)[0]),
+    )
+
+
+def _linkage(X):
+    from scipy.cluster import hierarchy
+    from scipy.spatial import distance
+    if len(X) < 2:
+        return None
+    distances = distance.pdist(X, metric='euclidean')
+    linkage = hierarchy.linkage(distances, method='average')
+    if len(X) <= OPTIMAL_ORDERING_LIMIT \
+            and hasattr(hierarchy, 'optimal_leaf_ordering'):
+        linkage = hierarchy.optimal_leaf_ordering(linkage, distances)
+    return linkage
+
+
+def _leaves(hierarchy, linkage, n):
+    return range(n) if linkage is None else \
+        hierarchy.leaves_list(linkage).tolist()
+
+
 def _clustermap(
         D, xticklabels=None, yticklabels=None, vmin=None, vmax=None, **kwargs):
     from . import seaborn as sns
@@ -355,8 +746,11 @@ def _clustermap(
         xticklabels = range(D.shape[0])
     if yticklabels is None:
         yticklabels = range(D.shape[1])
+    (xlinkage, ylinkage) = matrix_linkage(D)
     zmatrix = sns.clustermap(
         D,
+        row_linkage=ylinkage,
+        col_linkage=xlinkage,
         xticklabels=xticklabels,
         yticklabels=yticklabels,
         linewidths=0.2,
@@ -369,27 +763,310 @@ def _clustermap(
     return zmatrix
 
 
-def _clustermap_ordering(D):
-    """Returns the ordering of variables in D according to the clustermap."""
-    zmatrix = _clustermap(D)
-    plt.close(zmatrix.fig)
-    xordering = zmatrix.dendrogram_col.reordered_ind
-    yordering = zmatrix.dendrogram_row.reordered_ind
-    return (xordering, yordering)
+class PairwiseMatrix(object):
+    """Matrix of values for pairs of variables, with the labels of its axes.
+
+    `values` is a NumPy array whose rows are labelled by `index` and whose
+    columns are labelled by `columns`. The names of the three columns of the
+    tidy form, from which the matrix is pivoted and into which it is melted,
+    are `xlabel`, `ylabel` and `vlabel`.
+    """
+
+    def __init__(self, values, index, columns, xlabel=None, ylabel=None,
+            vlabel=None):
+        values = np.asarray(values, dtype=float)
+        if values.shape != (len(index), len(columns)):
+            raise ValueError('Matrix of shape %s does not match %d x %d labels'
+                % (values.shape, len(index), len(columns)))
+        self.values = values
+        self.index = np.asarray(index)
+        self.columns = np.asarray(columns)
+        self.xlabel = 'var0' if xlabel is None else xlabel
+        self.ylabel = 'var1' if ylabel is None else ylabel
+        self.vlabel = 'value' if vlabel is None else vlabel
+        self._unit = None
+
+    @classmethod
+    def from_tidy(cls, df):
+        """Pivots the last 3 columns of `df` into a matrix.
+
+        Labels are sorted, as by `DataFrame.pivot`, and the values of pairs
+        missing from `df`, or null in it, are 0.
+        """
+        if len(df.columns) < 3:
+            raise ValueError(
+                'At least three columns requried: %s' % (df.columns,))
+        (rows, index) = pd.factorize(df.iloc[:,-3], sort=True)
+        (cols, columns) = pd.factorize(df.iloc[:,-2], sort=True)
+        cells = rows * len(columns) + cols
+        if len(cells) and np.bincount(cells).max() > 1:
+            raise ValueError('Duplicate pairs of variables in %s' %
+                (list(df.columns[-3:]),))
+        tidy = df.iloc[:,-1].values.astype(float)
+        values = np.zeros(len(index) * len(columns))
+        values[cells] = np.where(np.isnan(tidy), 0, tidy)
+        matrix = cls(
+            values.reshape((len(index), len(columns))), index, columns,
+            *df.columns[-3:])
+        # The bounds are those of the values in `df`, nulls included.
+        with np.errstate(invalid='ignore'):
+            matrix._unit = bool(np.all((0 <= tidy) & (tidy <= 1)))
+        return matrix
+
+    @classmethod
+    def coerce(cls, df):
+        """Returns `df` if it is a matrix, or else pivots it."""
+        return df if isinstance(df, cls) else cls.from_tidy(df)
+
+    def is_unit(self):
+        """Returns whether all values are between 0 and 1."""
+        if self._unit is None:
+            self._unit = bool(np.all((0 <= self.values) & (self.values <= 1)))
+        return self._unit
+
+    def to_tidy(self):
+        """Melts the matrix into a data frame with one row per pair."""
+        (nrows, ncols) = self.values.shape
+        return pd.DataFrame(OrderedDict([
+            (self.xlabel, np.repeat(self.index, ncols)),
+            (self.ylabel, np.tile(self.columns, nrows)),
+            (self.vlabel, self.values.ravel()),
+        ]))
+
+    def to_frame(self):
+        """Returns the matrix as a data frame labelled by the variables."""
+        return pd.DataFrame(self.values, index=self.index, columns=self.columns)
 
 
 def tidy_pairwise(array, index, columns, xlabel=None, ylabel=None, vlabel=None):
     """Convert a pairwise matrix into a tidy data frame."""
     assert array.shape == (len(index), len(columns))
-    xlabel = xlabel or 'var0'
-    ylabel = ylabel or 'var1'
-    vlabel = vlabel or 'value'
-    data = [
-        (ind, col, array[i,j])
-        for i, ind in enumerate(index)
-        for j, col in enumerate(columns)
-    ]
-    return pd.DataFrame(data, columns=[xlabel, ylabel, vlabel])
+    return PairwiseMatrix(
+        array, index, columns, xlabel=xlabel, ylabel=ylabel, vlabel=vlabel
+    ).to_tidy()
+
+
+# Plotting functions by the name of their dot command, for `render`.
+PLOTS = {
+    'bar'                  : bar,
+    'barh'                 : barh,
+    'clustermap'           : clustermap,
+    'density'              : density,
+    'heatmap'              : heatmap,
+    'histogram_nominal'    : histogram_nominal,
+    'histogram_numerical'  : histogram_numerical,
+    'scatter'              : scatter,
+}
+
+
+def render(plot, df, path, **kwargs):
+    """Plots df with the function named `plot` in PLOTS and saves it to path.
+
+    The format of the file, e.g. PNG or SVG, follows the extension of path.
+    """
+    if plot not in PLOTS:
+        raise ValueError('Unknown plot: %s' % (plot,))
+    fig = _figure(PLOTS[plot](df, **kwargs))
+    fig.savefig(path, bbox_inches='tight')
+    plt.close(fig)
+    return path
+
+
+def render_batch(entries, processes=None):
+    """Renders the (plot, df, path, kwargs) entries in worker processes.
+
+    Each entry is drawn and saved by `render`, with the agg backend, in one
+    of `processes` worker processes, by default one per CPU. The workers are
+    new Python interpreters rather than forks of the caller, which in a
+    kernel has running threads and an open bdb connection. Returns the list
+    of paths.
+    """
+    entries = list(entries)
+    if not entries:
+        return []
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(entries)))
+    directory = tempfile.mkdtemp(prefix='iventure-render-')
+    env = dict(os.environ, MPLBACKEND='agg',
+        PYTHONPATH=os.pathsep.join(path or os.curdir for path in sys.path))
+    workers = []
+    try:
+        for i in xrange(processes):
+            batch = os.path.join(directory, '%d.pickle' % (i,))
+            with open(batch, 'wb') as f:
+                pickle.dump(entries[i::processes], f, pickle.HIGHEST_PROTOCOL)
+            workers.append(subprocess.Popen(
+                [sys.executable, '-c', _RENDER_WORKER, batch],
+                stderr=subprocess.PIPE, env=env))
+        errors = [worker.communicate()[1] for worker in workers]
+        failed = [worker.returncode != 0 for worker in workers]
+        if any(failed):
+            raise ValueError('Failed to render figures:\n%s' % (
+                ''.join(e for e, f in zip(errors, failed) if f),))
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.kill()
+                worker.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+    return [path for _plot, _df, path, _kwargs in entries]
+
+
+# Program of the worker processes of `render_batch`.
+_RENDER_WORKER = \
+    'import sys; from iventure import utils_plot; ' \
+    'utils_plot._render_file(sys.argv[1])'
+
+
+def _render_file(batch):
+    """Renders the entries pickled in the file `batch`."""
+    plt.switch_backend('agg')
+    with open(batch, 'rb') as f:
+        entries = pickle.load(f)
+    for (plot, df, path, kwargs) in entries:
+        render(plot, df, path, **kwargs)
+
+
+def _figure(plotted):
+    """Returns the figure of the result of a plotting function."""
+    if isinstance(plotted, matplotlib.figure.Figure):
+        return plotted
+    if hasattr(plotted, 'fig'):
+        # A seaborn grid, e.g. from clustermap.
+        return plotted.fig
+    return plotted.get_figure()
+
+
+class FigureCache(object):
+    """LRU cache of rendered figures as PNG files in `directory`.
+
+    Entries are keyed on the plot, its options, and a digest of the data it
+    shows, see `frame_digest`, so a stored figure is reused for as long as
+    its data is unchanged, including across sessions. The files are evicted
+    in order of last use once their total size exceeds `max_bytes`.
+    """
+
+    def __init__(self, directory='.iventure_figures', max_bytes=64 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = None
+
+    def key(self, plot, kwargs, digest):
+        return hashlib.sha1(repr(
+            (plot, sorted(kwargs.iteritems()), digest)
+        )).hexdigest()
+
+    def get(self, key):
+        """Return the PNG of the figure stored under `key`, or None."""
+        entries = self._load()
+        if key not in entries:
+            self.misses += 1
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                png = f.read()
+        except IOError:
+            self.nbytes -= entries.pop(key)
+            self.misses += 1
+            return None
+        entries[key] = entries.pop(key)
+        os.utime(path, None)
+        self.hits += 1
+        return png
+
+    def put(self, key, png):
+        if len(png) > self.max_bytes:
+            return
+        entries = self._load()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self._path(key)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(png)
+        os.rename(path + '.tmp', path)
+        if key in entries:
+            self.nbytes -= entries.pop(key)
+        entries[key] = len(png)
+        self.nbytes += len(png)
+        while self.nbytes > self.max_bytes:
+            evicted, nbytes = entries.popitem(last=False)
+            self.nbytes -= nbytes
+            self.evictions += 1
+            try:
+                os.remove(self._path(evicted))
+            except OSError:
+                pass
+
+    def clear(self):
+        for key in self._load():
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+        self._entries = OrderedDict()
+        self.nbytes = self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        entries = self._load()
+        return pd.DataFrame([(
+            len(entries), self.nbytes, self.max_bytes, self.hits,
+            self.misses, self.evictions,
+        )], columns=[
+            'entries', 'bytes', 'max_bytes', 'hits', 'misses', 'evictions',
+        ])
+
+    def _load(self):
+        """Index the stored figures by key, from least to most recently used."""
+        if self._entries is None:
+            stored = []
+            if os.path.isdir(self.directory):
+                for name in os.listdir(self.directory):
+                    if name.endswith('.png'):
+                        stat = os.stat(os.path.join(self.directory, name))
+                        stored.append((stat.st_mtime, name[:-4], stat.st_size))
+            self._entries = OrderedDict(
+                (key, nbytes) for _mtime, key, nbytes in sorted(stored))
+            self.nbytes = sum(self._entries.itervalues())
+        return self._entries
+
+    def _path(self, key):
+        return os.path.join(self.directory, '%s.png' % (key,))
+
+
+def frame_digest(df):
+    """Returns a digest of the columns, types, index and values of df, a
+    DataFrame or a Series."""
+    df = pd.DataFrame(df)
+    digest = hashlib.sha1(repr((list(df.columns), map(str, df.dtypes))))
+    digest.update(_array_bytes(df.index.values))
+    for i in xrange(df.shape[1]):
+        digest.update(_array_bytes(df.iloc[:, i].values))
+    return digest.hexdigest()
+
+
+def _array_bytes(values):
+    # Numbers and dates are hashed by their bytes, other objects by repr.
+    values = np.asarray(values)
+    if values.dtype.kind in 'biufcmM':
+        return np.ascontiguousarray(values).tobytes()
+    return repr(values.tolist())
+
+
+def figure_png(fig=None):
+    """Returns fig, by default the current figure, as PNG, or None if none."""
+    if fig is None:
+        if not plt.get_fignums():
+            return None
+        fig = plt.gcf()
+    png = StringIO.StringIO()
+    fig.savefig(png, format='png', bbox_inches='tight')
+    return png.getvalue()
 
 
 def _preprocess_dataframe(df):
@@ -400,6 +1077,19 @@ def _preprocess_dataframe(df):
     return df
 
 
+def _weights(df, weights):
+    """Returns the weights of the rows of df as a Series, by default 1."""
+    if weights is None:
+        weights = np.ones(len(df))
+    return pd.Series(np.asarray(weights, dtype=float), index=df.index)
+
+
+def _count_matrix(values, labels, weights):
+    """Returns the total weight of each value (rows) for each label (columns)."""
+    return weights.groupby([values.values, np.asarray(labels)]).sum() \
+        .unstack(fill_value=0)
+
+
 def _plot_legend(fig, ax):
     """Plots legend on the side of a figure."""
     box = ax.get_position()
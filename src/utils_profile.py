@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from collections import Counter
+from itertools import izip
+
+import pandas as pd
+
+from bayeslite import bql_quote_name
+
+from bayeslite.core import bayesdb_has_table
+from bayeslite.core import bayesdb_table_column_names
+
+from bayeslite.util import casefold
+
+
+TOP_K = 100
+# Distinct values of a column counted exactly by a profile; beyond them, only
+# the most frequent values are kept, with approximate counts.
+MAX_DISTINCT = 10000
+
+PROFILE_COLUMNS = [
+    'name', 'row_count', 'null_count', 'distinct_count', 'exact',
+    'value_type', 'min', 'max', 'top_values',
+]
+
+_VALUE_TYPES = {
+    int: 'integer',
+    long: 'integer',
+    float: 'real',
+    str: 'text',
+    unicode: 'text',
+    buffer: 'blob',
+}
+
+
+def profile_table(bdb, table, top_k=TOP_K, max_distinct=MAX_DISTINCT,
+        arraysize=4096):
+    """Profiles every column of `table` in one scan, returning a DataFrame.
+
+    For each column the profile records the number of rows and NULLs, the
+    type of the values, their minimum and maximum, and the `top_k` most
+    frequent values with their counts. The number of distinct values is
+    recorded if it is at most `max_distinct`, in which case `exact` is
+    true. Otherwise the values are counted in a Misra-Gries summary of
+    `max_distinct` values, so memory stays bounded: `distinct_count` is
+    missing, and the top values and their counts are approximate.
+    """
+    if not bayesdb_has_table(bdb, table):
+        raise ValueError('No such table: %s' % (table,))
+    qtable = bql_quote_name(table)
+    columns = bayesdb_table_column_names(bdb, table)
+    summaries = [ColumnSummary(max_distinct) for _column in columns]
+    rows = 0
+    with bdb.savepoint():
+        cursor = bdb.sql_execute('SELECT %s FROM %s' % (
+            ', '.join(map(bql_quote_name, columns)), qtable))
+        batch = cursor.fetchmany(arraysize)
+        while batch:
+            rows += len(batch)
+            for summary, values in izip(summaries, izip(*batch)):
+                summary.update(values)
+            batch = cursor.fetchmany(arraysize)
+    profiles = [summary.profile(top_k) for summary in summaries]
+    return pd.DataFrame([
+        [column, rows] + [profile[key] for key in PROFILE_COLUMNS[2:]]
+        for column, profile in izip(columns, profiles)
+    ], columns=PROFILE_COLUMNS)
+
+
+class ProfileCache(object):
+    """Column profiles of the tables of a bdb, kept in memory.
+
+    The profiles are discarded whenever the nullary callable `generation`
+    returns a new value, e.g. the generation of the `QueryCache` of a
+    session, which every statement that may modify the bdb advances.
+    """
+
+    def __init__(self, generation=None, top_k=TOP_K,
+            max_distinct=MAX_DISTINCT):
+        self.top_k = top_k
+        self.max_distinct = max_distinct
+        self._generation = generation or (lambda: 0)
+        self._profiles = {}
+
+    def get(self, bdb, table):
+        """Returns the profile of `table`, profiling it if necessary."""
+        generation = self._generation()
+        entry = self._profiles.get(casefold(table))
+        if entry is None or entry[0] != generation:
+            return self.refresh(bdb, table)
+        return entry[1]
+
+    def refresh(self, bdb, table, top_k=None):
+        """Profiles `table` again, returning its profile."""
+        generation = self._generation()
+        profile = profile_table(bdb, table, top_k=top_k or self.top_k,
+            max_distinct=self.max_distinct)
+        self._profiles = {
+            key: entry for key, entry in self._profiles.iteritems()
+            if entry[0] == generation
+        }
+        self._profiles[casefold(table)] = (generation, profile)
+        return profile
+
+    def clear(self):
+        self._profiles.clear()
+
+
+def lookup_columns(profile, columns):
+    """Returns the rows of `profile` for `columns`, matched case-insensitively."""
+    index = {casefold(name): i for i, name in enumerate(profile['name'])}
+    missing = [column for column in columns if casefold(column) not in index]
+    if missing:
+        raise ValueError('No such column(s): %s' % (', '.join(missing),))
+    return profile.iloc[[index[casefold(column)] for column in columns]]
+
+
+class ColumnSummary(object):
+    """Counts of the values of a column, in at most `capacity` counters.
+
+    Once more than `capacity` distinct values are counted, the counts are
+    reduced as in the Misra-Gries summary: every count is decreased by the
+    count of the value at the middle of the counters, and the values whose
+    count drops to zero are forgotten. A count is then low by at most the
+    number of values seen divided by `capacity / 2`. The type, minimum and
+    maximum of the values are kept exactly.
+    """
+
+    def __init__(self, capacity=MAX_DISTINCT):
+        self.capacity = capacity
+        self.counter = Counter()
+        self.null_count = 0
+        self.exact = True
+        self._types = set()
+        self._min = None
+        self._max = None
+
+    def update(self, values):
+        self.counter.update(values)
+        self.null_count += self.counter.pop(None, 0)
+        if len(self.counter) > self.capacity:
+            self._fold()
+            self.exact = False
+            counts = sorted(self.counter.itervalues())
+            threshold = counts[len(counts) - self.capacity // 2 - 1]
+            self.counter = Counter({
+                value: count - threshold
+                for value, count in self.counter.iteritems()
+                if count > threshold
+            })
+
+    def profile(self, top_k=TOP_K):
+        """Returns the profile of the column, see `profile_table`."""
+        self._fold()
+        types = self._types
+        if not types:
+            value_type = 'null'
+        elif len(types) == 1:
+            value_type = next(iter(types))
+        elif types == set(['integer', 'real']):
+            value_type = 'real'
+        else:
+            value_type = 'mixed'
+        return {
+            'null_count': self.null_count,
+            'distinct_count': len(self.counter) if self.exact else None,
+            'exact': self.exact,
+            'value_type': value_type,
+            'min': self._min,
+            'max': self._max,
+            'top_values': self.counter.most_common(top_k),
+        }
+
+    def _fold(self):
+        # Every value is in the counter until the counts are next reduced.
+        if not self.counter:
+            return
+        self._types.update(
+            _VALUE_TYPES.get(type(v), 'mixed') for v in self.counter)
+        lo = min(self.counter)
+        hi = max(self.counter)
+        self._min = lo if self._min is None else min(self._min, lo)
+        self._max = hi if self._max is None else max(self._max, hi)
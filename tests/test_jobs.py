@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import threading
+
+from iventure import jobs
+
+
+def test_job_result():
+    manager = jobs.JobManager()
+    job = manager.submit(lambda: 42, 'ESTIMATE 42')
+    assert job.wait(10)
+    assert job.status == jobs.DONE
+    assert job.result == 42
+    assert manager.get(1) is job
+    assert manager.active() == []
+
+
+def test_job_failure():
+    manager = jobs.JobManager()
+    def fail():
+        raise ValueError('boom')
+    job = manager.submit(fail, 'SELECT boom')
+    assert job.wait(10)
+    assert job.status == jobs.FAILED
+    assert 'boom' in job.exception
+
+
+def test_foreground_waits_and_cancel():
+    manager = jobs.JobManager(interrupt=lambda: None)
+    release = threading.Event()
+    blocker = manager.submit(lambda: release.wait(10), 'ANALYZE m')
+    pending = manager.submit(lambda: 1, 'SELECT 1')
+    while blocker.status != jobs.RUNNING:
+        blocker.wait(0.01)
+    manager.cancel(pending.jobid)
+    threading.Timer(0.2, release.set).start()
+    with manager.exclusive():
+        assert blocker.status == jobs.DONE
+    assert pending.wait(10)
+    assert pending.status == jobs.CANCELLED
+
+
+def test_checkpoint_lends_connection():
+    interrupts = []
+    manager = jobs.JobManager(interrupt=lambda: interrupts.append(1))
+    steps = []
+    started = threading.Event()
+    def analyze():
+        started.set()
+        for i in xrange(50):
+            manager.checkpoint()
+            steps.append(i)
+            threading.Event().wait(0.01)
+        return len(steps)
+    job = manager.submit(analyze, 'ANALYZE m FOR 50 ITERATIONS')
+    assert started.wait(10)
+    with manager.exclusive():
+        # The job is suspended at a checkpoint while the cell runs.
+        seen = len(steps)
+        threading.Event().wait(0.05)
+        assert len(steps) == seen < 50
+        assert not job.done()
+        manager.cancel(job.jobid)
+    assert job.wait(10)
+    assert job.status == jobs.CANCELLED
+    assert len(steps) == seen
+    assert interrupts == []
+    # Outside of a job, checkpoints do nothing.
+    manager.checkpoint()
+
+
+def test_in_job():
+    manager = jobs.JobManager()
+    assert not manager.in_job()
+    job = manager.submit(manager.in_job, 'ANALYZE m FOR 1 ITERATION')
+    assert job.wait(10)
+    assert job.result is True
+    assert not manager.in_job()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import base64
+import json
+
+import numpy as np
+import pandas as pd
+
+from iventure.jsviz import jsviz
+
+
+def test_encode_frame():
+    df = pd.DataFrame({
+        'x': [1.5, np.nan, -2.25],
+        'n': [1, 2, 300],
+        'l': ['a', None, 'a'],
+        'b': [True, False, True],
+    }, columns=['x', 'n', 'l', 'b'])
+    frame = json.loads(json.dumps(jsviz.encode_frame(df)))
+    assert frame['names'] == ['x', 'n', 'l', 'b']
+    assert frame['length'] == 3
+    [x, n, l, b] = frame['columns']
+    assert x['dtype'] == n['dtype'] == 'f4'
+    values = np.frombuffer(base64.b64decode(x['buffer']), dtype='<f4')
+    assert np.array_equal(values[[0, 2]], [1.5, -2.25])
+    assert np.isnan(values[1])
+    assert l['categories'] == ['a']
+    assert l['dtype'] == 'u1'
+    codes = np.frombuffer(base64.b64decode(l['buffer']), dtype='<u1')
+    assert codes.tolist() == [1, 0, 1]
+    assert b['categories'] == [True, False]
+
+
+def test_encode_frame_precision():
+    df = pd.DataFrame({
+        'n': [1, 2**24, np.nan],
+        'm': [1, 2**24 + 1, 2],
+        'x': [0.1, 0.5, 1.],
+        'y': [1e300, 0., -np.inf],
+    }, columns=['n', 'm', 'x', 'y'])
+    frame = jsviz.encode_frame(df)
+    assert [c['dtype'] for c in frame['columns']] == ['f4', 'f8', 'f8', 'f8']
+    m = np.frombuffer(base64.b64decode(frame['columns'][1]['buffer']), '<f8')
+    assert m.tolist() == [1, 2**24 + 1, 2]
+
+
+def test_runtime_in_each_output():
+    df = pd.DataFrame({'x': [1., 2.], 'y': [3., 4.]})
+    first = jsviz.interactive_scatter(df.copy()).data
+    second = jsviz.interactive_scatter(df.copy()).data
+    for output in [first, second]:
+        assert 'if (!iventureJsviz.scatter)' in output
+        assert 'function scatter' in output
+        assert 'iventureJsviz.decodeFrame = ' in output
+        assert 'function bar' not in output
+        assert 'iventureJsviz.scatter(element)' in output
+
+
+def test_heatmap_tiles():
+    from iventure import utils_plot
+    rng = np.random.RandomState(0)
+    values = rng.rand(600, 600)
+    labels = ['v%d' % (i,) for i in xrange(600)]
+    matrix = utils_plot.PairwiseMatrix(values, labels, labels)
+    tiles = jsviz.HeatmapTiles(matrix, size=100)
+    tiles.values[0, 0] = np.nan
+    overview = tiles.overview()
+    assert overview['xstarts'] == range(0, 600, 6)
+    assert sorted(overview['xlabels']) == sorted(labels)
+    assert (overview['vmin'], overview['vmax']) == (0, 1)
+    means = np.frombuffer(
+        base64.b64decode(overview['values']['buffer']), dtype='<f4')
+    assert means.shape == (100 * 100,)
+    assert np.isclose(means[0], np.nanmean(tiles.values[:6, :6]))
+    assert np.isclose(means[1], tiles.values[:6, 6:12].mean())
+    region = tiles.region(10, 30, 590, 700)
+    assert region['columns'] == [590, 600]
+    assert region['ystarts'] == range(10, 30)
+    entries = np.frombuffer(
+        base64.b64decode(region['values']['buffer']), dtype='<f4')
+    assert np.allclose(entries, tiles.values[10:30, 590:600].ravel())
+    assert jsviz._TILED[tiles.id] is tiles
+    js = jsviz.interactive_heatmap(matrix.to_tidy()).data
+    assert 'heatmap_tiles(element)' in js
+
+
+def test_pairplot_aggregates():
+    df = pd.DataFrame({
+        'x': [0., 1., 2., 3., np.nan, 3.],
+        'y': [10., 10., 10., 10., 10., 10.],
+        'c': ['a', 'b', 'a', 'c', 'a', None],
+    }, columns=['x', 'y', 'c'])
+    schema = [
+        {'name': 'x', 'stat_type': 'realAdditive'},
+        {'name': 'y', 'stat_type': 'realAdditive'},
+        {'name': 'c', 'stat_type': 'categorical'},
+    ]
+    aggregates = jsviz.pairplot_aggregates(df, schema, bins=3, categories=1)
+    assert aggregates['rows'] == 6
+    [x, y, c] = aggregates['variables']
+    assert x['edges'] == [0, 1, 2, 3]
+    assert (y['edges'][0], y['edges'][-1]) == (9.5, 10.5)
+    assert c['categories'] == ['a', jsviz.OTHER]
+    def counts(aggregate):
+        return np.frombuffer(
+            base64.b64decode(aggregate['counts']['buffer']), dtype='<u4')
+    assert counts(x).tolist() == [1, 1, 3]
+    assert counts(c).tolist() == [3, 2]
+    pairs = {(pair['y'], pair['x']): counts(pair)
+        for pair in aggregates['pairs']}
+    assert sorted(pairs) == [(1, 0), (2, 0), (2, 1)]
+    # Rows of c, columns of x, leaving out the missing values.
+    assert pairs[2, 0].tolist() == [1, 0, 1, 0, 1, 1]
+    js = jsviz.interactive_pairplot(df, schema, aggregate=True).data
+    assert 'pairplot_aggregates(element)' in js
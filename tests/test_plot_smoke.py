@@ -16,6 +16,7 @@
 
 
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import pytest
 
@@ -61,6 +62,89 @@ def test_scatter_smoke(axname, dfname, colorsname):
         uplt.scatter(df, ax=ax, **kwargs)
 
 
+def test_downsample_points():
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame({
+        'x': np.concatenate([rng.normal(size=5000), [100.]]),
+        'y': np.concatenate([rng.normal(size=5000), [-100.]]),
+        'l': ['a'] * 4999 + ['b', 'a'],
+    }, columns=['x', 'y', 'l'])
+    sample, dropped = uplt.downsample_points(df, 500)
+    assert len(sample) == 500
+    assert dropped == 4501
+    assert sample.index.is_monotonic_increasing
+    # The outlier and the rare label are kept.
+    assert 5000 in sample.index
+    assert 'b' in set(sample['l'])
+    assert uplt.downsample_points(df, 10000)[0] is df
+    fig = uplt.scatter(df, ax=plt.subplots()[1], max_points='500')
+    assert 'Showing 500 of 5001 points' in fig.axes[0].texts[0].get_text()
+
+
+def test_binned_kde():
+    rng = np.random.RandomState(0)
+    values = np.concatenate([rng.normal(size=3000), rng.normal(5, .5, 1000)])
+    grid, density = uplt.binned_kde(values)
+    from scipy.stats import gaussian_kde
+    assert np.allclose(density, gaussian_kde(values)(grid), atol=1e-4)
+    assert np.allclose(np.trapz(density, grid), 1, atol=1e-4)
+    assert len(uplt.thin_rug(values, 100)) <= 100
+    assert len(uplt.thin_rug(values[:50], 100)) == 50
+    df = pd.DataFrame({'x': values, 'l': ['a', 'b'] * 2000}, columns=['x', 'l'])
+    uplt.density(df, ax=plt.subplots()[1])
+
+
+def test_render_batch(tmpdir):
+    df = pd.DataFrame({'x': range(10), 'y': range(10)}, columns=['x', 'y'])
+    entries = [
+        ('scatter', df, str(tmpdir.join('a.png')), {'xmin': '0'}),
+        ('density', df[['x']], str(tmpdir.join('b.svg')), {'rug': 'False'}),
+        ('heatmap', uplt.tidy_pairwise(np.eye(3), list('abc'), list('abc')),
+            str(tmpdir.join('c.png')), {}),
+    ]
+    paths = uplt.render_batch(entries, processes=2)
+    assert paths == [path for _plot, _df, path, _kwargs in entries]
+    assert all(tmpdir.join(n).size() > 0 for n in ['a.png', 'b.svg', 'c.png'])
+    with pytest.raises(ValueError):
+        uplt.render('pie', df, str(tmpdir.join('d.png')))
+    with pytest.raises(ValueError) as e:
+        uplt.render_batch([('pie', df, str(tmpdir.join('d.png')), {})])
+    assert 'pie' in str(e.value)
+
+
+def test_figure_cache(tmpdir):
+    df = pd.DataFrame({'x': range(10), 'y': range(10)}, columns=['x', 'y'])
+    digest = uplt.frame_digest(df)
+    assert uplt.frame_digest(df.copy()) == digest
+    assert uplt.frame_digest(df.assign(y=df['y'] + 1)) != digest
+    assert uplt.frame_digest(df.set_index(df.index + 1)) != digest
+    labels = df.assign(y=['a'] * 10)
+    assert uplt.frame_digest(labels) == uplt.frame_digest(labels.copy())
+    assert uplt.frame_digest(labels.assign(y=['b'] * 10)) \
+        != uplt.frame_digest(labels)
+    uplt.scatter(df)
+    png = uplt.figure_png()
+    plt.close('all')
+    assert png.startswith('\x89PNG')
+    assert uplt.figure_png() is None
+    directory = str(tmpdir.join('figures'))
+    cache = uplt.FigureCache(directory, max_bytes=2 * len(png))
+    keys = [cache.key('scatter', {'xmin': str(i)}, digest) for i in xrange(3)]
+    assert cache.get(keys[0]) is None
+    cache.put(keys[0], png)
+    cache.put(keys[1], png)
+    assert cache.get(keys[0]) == png
+    cache.put(keys[2], png)
+    assert cache.get(keys[1]) is None
+    assert cache.evictions == 1
+    # The stored figures are found again by a new cache.
+    cache = uplt.FigureCache(directory, max_bytes=2 * len(png))
+    assert cache.get(keys[2]) == png
+    assert cache.stats()['entries'][0] == 2
+    cache.clear()
+    assert tmpdir.join('figures').listdir() == []
+
+
 BAR_DF = {
     'toosmall': pd.DataFrame([[1],[3],[5]]),
     'goldilocks': pd.DataFrame([[1,2],[3,4],[5,6]]),
@@ -183,3 +267,65 @@ def test_heatmap_smoke(axname, dfname):
     df = CHMAP_DF[dfname]
     # XXX figsize
     uplt.heatmap(df, ax=ax)
+
+
+def test_matrix_ordering():
+    # Two interleaved blocks of variables, which the ordering separates.
+    blocks = [0, 1, 0, 1, 0, 1]
+    D = np.array([[float(a == b) for b in blocks] for a in blocks])
+    (xordering, yordering) = uplt.matrix_ordering(D)
+    assert xordering == yordering
+    assert sorted(xordering) == range(6)
+    assert [blocks[i] for i in xordering] in ([0, 0, 0, 1, 1, 1],
+        [1, 1, 1, 0, 0, 0])
+    assert uplt.matrix_ordering(D.copy()) == (xordering, yordering)
+    assert uplt.matrix_ordering(np.ones((1, 3)))[1] == [0]
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'raster': 'True'},
+    {'blocks': '1'},
+])
+def test_raster_matrix_smoke(kwargs):
+    names = ['v%d' % (i,) for i in xrange(30)]
+    D = np.random.RandomState(0).rand(30, 30)
+    df = uplt.tidy_pairwise((D + D.T) / 2, names, names)
+    ax = uplt.heatmap(df, ax=plt.subplots()[1], **kwargs)
+    assert len(ax.get_images()) == 1
+    fig = uplt.clustermap(df, **kwargs)
+    plt.close(fig)
+
+
+def test_pairwise_matrix():
+    df = CHMAP_DF['DF']
+    matrix = uplt.PairwiseMatrix.from_tidy(df.iloc[::-1])
+    pivot = df.pivot(index=0, columns=1, values=2)
+    assert (matrix.values == pivot.values).all()
+    assert list(matrix.index) == list(pivot.index)
+    assert not matrix.is_unit()
+    tidy = matrix.to_tidy()
+    assert list(tidy.columns) == [0, 1, 2]
+    assert list(tidy.iloc[1]) == ['bar', 'baz', 47]
+    # Missing and null pairs are 0, but null values are out of bounds.
+    partial = pd.DataFrame([['a', 'a', 1.], ['a', 'b', .5], ['b', 'a', None]])
+    matrix = uplt.PairwiseMatrix.from_tidy(partial)
+    assert matrix.values.tolist() == [[1, .5], [0, 0]]
+    assert not matrix.is_unit()
+    with pytest.raises(ValueError):
+        uplt.PairwiseMatrix.from_tidy(pd.concat([partial, partial]))
+    uplt.heatmap(uplt.PairwiseMatrix.from_tidy(partial.fillna(0)))
+
+
+def test_histogram_weights():
+    df = HISTNUM_DF['DF2']
+    fig = uplt.histogram_numerical(df, ax=plt.subplots()[1])
+    heights = [patch.get_height() for patch in fig.axes[0].patches]
+    # The same points, counted.
+    counted = pd.DataFrame([(41.2,'x'),(87,'y'),(-3,'z'),(-3,'w'),(41.2,'v')])
+    fig = uplt.histogram_numerical(
+        counted, ax=plt.subplots()[1], weights=[1, 1, 1, 1, 1],
+        bins=np.linspace(-3, 87, 11))
+    assert [patch.get_height() for patch in fig.axes[0].patches] == heights
+    df = pd.DataFrame(['foo', 'bar', 'quux'])
+    fig = uplt.histogram_nominal(df, ax=plt.subplots()[1], weights=[3, 1, 1])
+    assert [patch.get_width() for patch in fig.axes[0].patches] == [3, 1, 1]
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import datetime
+import sqlite3
+import threading
+import time
+import zlib
+
+import pandas as pd
+import pytest
+
+from iventure import sessions
+from iventure.sessions import DBLogger
+from iventure.sessions import LogEntry
+from iventure.sessions import TextLogger
+
+
+def test_text_logger(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    logger = TextLogger(flush_interval=60, flush_bytes=2**20)
+    logger.new_session('user', 's1', '.logs')
+    logger.log('t0', 1, LogEntry('bql', 'SELECT 1', None, None))
+    logger.log('t1', 2, LogEntry('sql', 'SELECT x', None, 'Traceback'))
+    assert logger.flush(10)
+    path = tmpdir.join('.logs', 's1.txt')
+    assert path.read() == (
+        '---\n:TIME:t0\n:COUNTER:1\n:TYPE:bql\n:INPUT:SELECT 1\n'
+        ':OUTPUT:None\n:EXCEPTION:\n'
+        '---\n:TIME:t1\n:COUNTER:2\n:TYPE:sql\n:INPUT:SELECT x\n'
+        ':OUTPUT:None\n:EXCEPTION:Traceback\n')
+    logger.close()
+    assert logger.errors == 0
+
+
+def test_text_logger_flush_triggers(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    logger = TextLogger(flush_interval=0.05, flush_bytes=2**20)
+    logger.new_session('user', 's1', '.logs')
+    logger.log('t0', 1, LogEntry('bql', 'SELECT 1', None, None))
+    path = tmpdir.join('.logs', 's1.txt')
+    deadline = time.time() + 10
+    while not (path.check() and path.size()) and time.time() < deadline:
+        time.sleep(0.01)
+    assert 'SELECT 1' in path.read()
+    logger.close()
+    logger = TextLogger(flush_interval=60, flush_bytes=1)
+    logger.new_session('user', 's2', '.logs')
+    logger.log('t0', 1, LogEntry('bql', 'SELECT 2', None, None))
+    path = tmpdir.join('.logs', 's2.txt')
+    while not (path.check() and path.size()) and time.time() < deadline:
+        time.sleep(0.01)
+    assert 'SELECT 2' in path.read()
+    logger.close()
+    logger.log('t1', 2, LogEntry('bql', 'SELECT 3', None, None))
+    assert 'SELECT 3' not in path.read()
+
+
+def test_text_logger_unwriteable(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir.join('missing', 'home')))
+    logger = TextLogger()
+    logger.new_session('user', 's1', '.logs')
+    logger.log('t0', 1, LogEntry('bql', 'SELECT 1', None, None))
+    assert logger.flush(10)
+    assert logger.errors == 1
+    logger.close()
+
+
+def test_text_logger_converts_on_kernel_thread(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    class Stream(object):
+        threads = []
+        def __str__(self):
+            self.threads.append(threading.current_thread())
+            return 'rows'
+    logger = TextLogger(capture=sessions.HASH)
+    logger.new_session('user', 's1', '.logs')
+    logger.log('t0', 1, LogEntry('bql', 'SELECT x', Stream(), None))
+    assert logger.flush(10)
+    assert Stream.threads == [threading.current_thread()]
+    assert ':OUTPUT:type Stream; sha1 ' in tmpdir.join('.logs', 's1.txt').read()
+    logger.close()
+
+
+def test_text_logger_mutated_output(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    logger = TextLogger(flush_interval=60, flush_bytes=2**20)
+    logger.new_session('user', 's1', '.logs')
+    df = pd.DataFrame({'x': [1, 2, 3]})
+    logger.log('t0', 1, LogEntry('bql', 'SELECT x', df, None))
+    logger.capture = sessions.FULL
+    logger.log('t1', 2, LogEntry('bql', 'SELECT x', df, None))
+    df['x'] = [7, 8, 9]
+    df.drop(0, inplace=True)
+    assert logger.flush(10)
+    text = tmpdir.join('.logs', 's1.txt').read()
+    assert ':OUTPUT:shape 3 x 1; dtypes x:int64\n' in text
+    assert '7' not in text
+    full = pd.read_csv(str(tmpdir.join('.logs', 's1.2.csv.gz')), index_col=0)
+    assert full['x'].tolist() == [1, 2, 3]
+    logger.close()
+
+
+def test_text_logger_capture(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    df = pd.DataFrame({'x': range(100), 'y': ['a'] * 100})
+    logger = TextLogger(head_rows=2)
+    logger.new_session('user', 's1', '.logs')
+    logger.log('t0', 1, LogEntry('bql', 'SELECT x, y', df, None))
+    logger.log('t1', 2, LogEntry('bql', 'SELECT 1', '\n'.join('abcdef'), None))
+    logger.capture = sessions.HASH
+    logger.log('t2', 3, LogEntry('bql', 'SELECT x, y', df, None))
+    logger.capture = sessions.FULL
+    logger.log('t3', 4, LogEntry('bql', 'SELECT x, y', df, None))
+    assert logger.flush(10)
+    text = tmpdir.join('.logs', 's1.txt').read()
+    assert ':OUTPUT:shape 100 x 2; dtypes x:int64, y:object\n' in text
+    assert '\n...\n98  98  a\n99  99  a\n' in text
+    assert ':OUTPUT:a\nb\n... (6 lines)\ne\nf\n' in text
+    assert ':OUTPUT:shape 100 x 2; dtypes x:int64, y:object; sha1 ' in text
+    assert 's1.4.csv.gz' in text
+    full = pd.read_csv(str(tmpdir.join('.logs', 's1.4.csv.gz')), index_col=0)
+    assert full.equals(df)
+    logger.close()
+    with pytest.raises(ValueError):
+        TextLogger(capture='all')
+    assert sessions._digest(df) == sessions._digest(df.copy())
+    assert sessions._digest(df) != sessions._digest(df.assign(y='b'))
+    lists = pd.DataFrame({'z': [[1, 2], [3]]})
+    assert sessions._digest(lists) == sessions._digest(lists.copy())
+
+
+def test_text_logger_budget_rotation(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    logs = tmpdir.join('.logs').ensure(dir=True)
+    old = logs.join('s0.txt')
+    old.write('---\n:TIME:t\n')
+    sidecar = logs.join('s0.3.csv.gz').ensure()
+    notes = logs.join('notes.txt').ensure()
+    for path in [old, sidecar, notes]:
+        path.setmtime(time.time() - 100 * 24 * 3600)
+    assert TextLogger().retention_days is None
+    logger = TextLogger(
+        max_session_bytes=1000, max_file_bytes=500, retention_days=90)
+    logger.new_session('user', 's1', '.logs')
+    for i in xrange(10):
+        logger.log('t', i, LogEntry('bql', 'SELECT x', 'x' * 100, None))
+    assert logger.flush(10)
+    assert not old.check()
+    assert not sidecar.check()
+    assert notes.check()
+    assert logs.join('s1.1.txt').check()
+    text = ''.join(
+        logs.join(name).read() for name in ['s1.txt', 's1.1.txt', 's1.2.txt'])
+    assert text.count(':OUTPUT:' + 'x' * 100) < 10
+    assert ':OUTPUT:type str; sha1 ' in text
+    stale = logs.join('s0.4.txt.gz').ensure()
+    stale.setmtime(time.time() - 3 * 24 * 3600)
+    logger.expire(2)
+    assert logger.flush(10)
+    assert not stale.check()
+    assert notes.check()
+    logger.close()
+
+
+def test_db_logger(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    logger = DBLogger(flush_interval=60, flush_bytes=2**20)
+    logger.new_session('user', 's1', '.logs')
+    logger.log('2016-01-01T00:00:00', 1,
+        LogEntry('bql', 'SELECT x FROM t', None, None))
+    logger.log('2016-01-02T00:00:00', 2,
+        LogEntry('sql', 'SELECT 100% FROM t', None, 'Traceback'))
+    logger.log('2016-01-03T00:00:00', 3,
+        LogEntry('bql', 'SELECT y FROM u', pd.DataFrame({'y': [1]}), None))
+    found = logger.search('FROM t')
+    assert found['counter'].tolist() == [2, 1]
+    assert found['session'].tolist() == ['s1', 's1']
+    assert logger.search('100')['counter'].tolist() == [2]
+    assert logger.search('trace*')['counter'].tolist() == [2]
+    assert logger.search('"FROM u"')['counter'].tolist() == [3]
+    assert logger.search('', errors=True)['counter'].tolist() == [2]
+    assert logger.search('', entry_type='bql')['counter'].tolist() == [3, 1]
+    assert logger.search(
+        'SELECT', since='2016-01-02')['counter'].tolist() == [3, 2]
+    assert 'dtype' in logger.search('y', limit=1)['output'][0]
+    logger.close()
+    assert logger.errors == 0
+    path = str(tmpdir.join('.logs', 'iventure_logs.db'))
+    connection = sqlite3.connect(path)
+    assert connection.execute('PRAGMA journal_mode').fetchone() == ('wal',)
+    indexes = connection.execute('''
+        SELECT name FROM sqlite_master
+        WHERE type = 'index' AND tbl_name = 'iventure_log'
+    ''').fetchall()
+    assert len(indexes) == 4
+    connection.close()
+    with pytest.raises(ValueError):
+        logger.search('"unbalanced')
+    # Full outputs are stored compressed in the database.
+    logger = DBLogger(capture=sessions.FULL, wal=False)
+    logger.new_session('user', 's2', '.logs')
+    df = pd.DataFrame({u'lieu': [u'café']})
+    logger.log('2016-01-04T00:00:00', 1, LogEntry('bql', 'SELECT', df, None))
+    assert logger.search('content')['counter'].tolist() == [1]
+    logger.close()
+    assert not tmpdir.join('.logs', 's2.1.csv.gz').check()
+    connection = sqlite3.connect(path)
+    [(content,)] = connection.execute('''
+        SELECT content FROM iventure_log WHERE session = 's2'
+    ''').fetchall()
+    assert zlib.decompress(content) == df.to_csv(encoding='utf-8')
+    connection.close()
+    # Entries older than the retention are deleted with a new session.
+    logger = DBLogger(retention_days=1)
+    logger.new_session('user', 's3', '.logs')
+    assert len(logger.search('')) == 0
+    assert len(logger.search('SELECT')) == 0
+    logger.close()
+
+
+def test_parse_since():
+    now = datetime.datetime(2016, 1, 8, 12)
+    assert sessions.parse_since('12h', now) == '2016-01-08T00:00:00'
+    assert sessions.parse_since('1w', now) == '2016-01-01T12:00:00'
+    assert sessions.parse_since('2016-01-01 10:00') == '2016-01-01T10:00'
+    with pytest.raises(ValueError):
+        sessions.parse_since('yesterday')
+
+
+def test_text_logger_survives_failures(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+
+    class Unprintable(object):
+        def __str__(self):
+            raise RuntimeError('Cannot print.')
+
+    logger = TextLogger()
+    logger.new_session('user', 's1', '.logs')
+    logger.log('t0', 1, LogEntry('bql', 'SELECT 1', Unprintable(), None))
+    logger.log('t1', 2, LogEntry('bql', 'SELECT 2', None, None))
+    assert logger.flush(10)
+    assert logger.errors == 1
+    assert 'SELECT 2' in tmpdir.join('.logs', 's1.txt').read()
+    logger.close()
+
+
+def test_text_logger_capture_unicode(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    df = pd.DataFrame({u'lieu': [u'café', u'crème'], 'x': [[1], [2, 3]]})
+    logger = TextLogger()
+    logger.new_session('user', 's1', '.logs')
+    for counter, capture in enumerate(sessions.CAPTURE_POLICIES):
+        logger.capture = capture
+        logger.log('t', counter, LogEntry('bql', u"SELECT 'café'", df, None))
+    logger.log('t', 3, LogEntry('sql', 'SELECT 1', u'crème', 'caf\xc3\xa9'))
+    assert logger.flush(10)
+    assert logger.errors == 0
+    text = tmpdir.join('.logs', 's1.txt').read().decode('utf-8')
+    assert text.count(u":INPUT:SELECT 'café'\n") == 3
+    assert u'crème' in text
+    assert u':EXCEPTION:café\n' in text
+    assert '; sha1 ' in text
+    full = pd.read_csv(
+        str(tmpdir.join('.logs', 's1.2.csv.gz')), encoding='utf-8')
+    assert full[u'lieu'].tolist() == [u'café', u'crème']
+    logger.close()
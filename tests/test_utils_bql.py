@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import pandas as pd
+import pytest
+
+from bayeslite import bayesdb_open
+from bayeslite.core import bayesdb_has_table
+
+from iventure import utils_bql
+
+
+def test_normalize_bql():
+    assert utils_bql.normalize_bql('SELECT  x\n FROM t ;') == 'SELECT x FROM t'
+    assert utils_bql.normalize_bql("SELECT 'a  b'") == "SELECT 'a  b'"
+
+
+def test_split_statements():
+    assert utils_bql.split_statements(
+        "SELECT 'a;b' FROM t; SELECT \"c;\" FROM t -- d;e\n;\n ;"
+    ) == ["SELECT 'a;b' FROM t", 'SELECT "c;" FROM t -- d;e']
+    assert utils_bql.split_statements('-- nothing;\n') == []
+    assert utils_bql.split_statements(
+        '.scatter --xmin=0 SELECT x, y FROM t;\n.population p'
+    ) == ['.scatter --xmin=0 SELECT x, y FROM t', '.population p']
+    assert utils_bql.split_statements('SELECT 1 # a;b\n;SELECT 2 /* ; */') == [
+        'SELECT 1 # a;b', 'SELECT 2 /* ; */']
+
+
+def test_split_statements_clauses():
+    schema = (
+        'CREATE POPULATION p FOR t WITH SCHEMA (\n'
+        '    MODEL a AS NUMERICAL;\n'
+        '    MODEL b AS NOMINAL # Only 2 distinct values; may miss some\n'
+        ');\n'
+        'ANALYZE m FOR 2 ITERATIONS (OPTIMIZED; SKIP a);'
+    )
+    assert utils_bql.split_statements(schema) == [
+        'CREATE POPULATION p FOR t WITH SCHEMA (\n'
+        '    MODEL a AS NUMERICAL;\n'
+        '    MODEL b AS NOMINAL # Only 2 distinct values; may miss some\n'
+        ')',
+        'ANALYZE m FOR 2 ITERATIONS (OPTIMIZED; SKIP a)',
+    ]
+
+
+def test_query_cache():
+    cache = utils_bql.QueryCache()
+    with bayesdb_open(':memory:', builtin_backends=False) as bdb:
+        bdb.sql_execute('CREATE TABLE t (x)')
+        bdb.sql_execute('INSERT INTO t VALUES (1)')
+        df = utils_bql.query(bdb, 'SELECT x FROM t', cache=cache)
+        assert df.iloc[0, 0] == 1
+        bdb.sql_execute('INSERT INTO t VALUES (2)')
+        # Cache hit, as the INSERT did not go through the cache.
+        df = utils_bql.query(bdb, 'SELECT  x FROM t;', cache=cache)
+        assert len(df) == 1
+        assert cache.hits == 1
+        # Statements that modify the bdb advance the generation.
+        utils_bql.query(bdb, 'INSERT INTO t VALUES (3)', cache=cache)
+        df = utils_bql.query(bdb, 'SELECT x FROM t', cache=cache)
+        assert len(df) == 3
+        assert cache.generation == 1
+
+
+def test_query_cache_eviction():
+    df = pd.DataFrame({'x': range(100)})
+    nbytes = df.memory_usage(index=True, deep=True).sum()
+    cache = utils_bql.QueryCache(max_bytes=2 * nbytes)
+    cache.put('SELECT 1', (), df)
+    cache.put('SELECT 2', (), df)
+    assert cache.get('SELECT 1') is not None
+    cache.put('SELECT 3', (), df)
+    assert cache.get('SELECT 2') is None
+    assert cache.get('SELECT 1') is not None
+    assert cache.evictions == 1
+
+
+def test_cursor_to_df_types():
+    with bayesdb_open(':memory:', builtin_backends=False) as bdb:
+        bdb.sql_execute('CREATE TABLE t (x REAL, y TEXT, z, w)')
+        for i in xrange(10):
+            bdb.sql_execute('INSERT INTO t VALUES (?, ?, ?, ?)',
+                (i, str(i), i if i < 7 else 'NA', None))
+        cursor = bdb.sql_execute('SELECT x, y, z, w FROM t')
+        df = utils_bql.cursor_to_df(cursor, arraysize=3)
+        assert list(df.columns) == ['x', 'y', 'z', 'w']
+        assert df.shape == (10, 4)
+        assert df['x'].dtype == float
+        assert df['y'].dtype == object
+        assert df['z'].dtype == object
+        assert df['z'].iloc[-1] == 'NA'
+        assert df['w'].isnull().all()
+        cursor = bdb.sql_execute('SELECT x FROM t')
+        df = utils_bql.cursor_to_df(cursor, stattypes={'X': 'nominal'})
+        assert df['x'].dtype == object
+
+
+def test_cursor_to_df_fallback_after_first_batch():
+    with bayesdb_open(':memory:', builtin_backends=False) as bdb:
+        bdb.sql_execute('CREATE TABLE t (z)')
+        zips = ['02139', '10001', '94305', 'N/A', '02140']
+        for z in zips:
+            bdb.sql_execute('INSERT INTO t VALUES (?)', (z,))
+        cursor = bdb.sql_execute('SELECT z FROM t')
+        df = utils_bql.cursor_to_df(cursor, arraysize=2)
+        assert df['z'].dtype == object
+        assert df['z'].tolist() == zips
+
+
+def test_result_stream(tmpdir):
+    with bayesdb_open(':memory:', builtin_backends=False) as bdb:
+        bdb.sql_execute('CREATE TABLE t (x REAL)')
+        for i in xrange(25):
+            bdb.sql_execute('INSERT INTO t VALUES (?)', (i,))
+        stream = utils_bql.ResultStream(bdb.sql_execute('SELECT x FROM t'), 10)
+        assert len(stream.head()) == 10
+        assert stream.rows == 10
+        chunks = list(stream)
+        assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+        assert chunks[-1].index[0] == 20
+        stream = utils_bql.ResultStream(bdb.sql_execute('SELECT x FROM t'), 10)
+        path = str(tmpdir.join('t.csv'))
+        assert stream.to_csv(path) == 25
+        assert len(pd.read_csv(path)) == 25
+
+
+def test_cursor_to_table():
+    with bayesdb_open(':memory:', builtin_backends=False) as bdb:
+        bdb.sql_execute('CREATE TABLE t (x REAL, y TEXT)')
+        for i in xrange(25):
+            bdb.sql_execute('INSERT INTO t VALUES (?, ?)', (i, str(i)))
+        cursor = bdb.sql_execute('SELECT x, y, x + 1 AS z FROM t')
+        assert utils_bql.cursor_to_table(bdb, cursor, 'u', arraysize=10) == 25
+        cursor = bdb.sql_execute('SELECT COUNT(*), SUM(z) FROM u')
+        assert cursor.fetchall() == [(25, sum(xrange(1, 26)))]
+        cursor = bdb.sql_execute('SELECT x FROM t WHERE x < 0')
+        assert utils_bql.cursor_to_table(bdb, cursor, 'v') == 0
+        assert bdb.sql_execute('SELECT COUNT(*) FROM v').fetchall() == [(0,)]
+        cursor = bdb.sql_execute('DELETE FROM t WHERE x < 0')
+        with pytest.raises(ValueError):
+            utils_bql.cursor_to_table(bdb, cursor, 'w')
+        assert not bayesdb_has_table(bdb, 'w')
+
+
+def test_load_csv(tmpdir):
+    path = str(tmpdir.join('t.csv'))
+    with open(path, 'w') as f:
+        f.write('a,b,c\n1,x,1.5\n2,NA,\n3,y,2\n')
+    with bayesdb_open(':memory:', builtin_backends=False) as bdb:
+        rows = utils_bql.load_csv(bdb, 't', path, chunksize=2, nullify=['NA'])
+        assert rows == 3
+        cursor = bdb.sql_execute('SELECT a, b, c FROM t ORDER BY a')
+        assert cursor.fetchall() == [(1, 'x', 1.5), (2, None, None), (3, 'y', 2)]
+
+
+def test_load_csv_in_transaction(tmpdir):
+    path = str(tmpdir.join('t.csv'))
+    with open(path, 'w') as f:
+        f.write('a,d\n1,\n2,NA\n')
+    with bayesdb_open(':memory:', builtin_backends=False) as bdb:
+        with bdb.savepoint():
+            assert utils_bql.load_csv(bdb, 't', path, nullify=['NA']) == 2
+        cursor = bdb.sql_execute('PRAGMA table_info(t)')
+        assert [(row[1], row[2]) for row in cursor] == [
+            ('a', 'INTEGER'), ('d', 'TEXT')]
+
+
+def test_nullify_columns():
+    with bayesdb_open(':memory:', builtin_backends=False) as bdb:
+        bdb.sql_execute('CREATE TABLE t (a, b TEXT, c REAL)')
+        for row in [(1, 'NaN', 1.5), ('NaN', 'x', -1), (3, '', -1)]:
+            bdb.sql_execute('INSERT INTO t VALUES (?, ?, ?)', row)
+        counts = utils_bql.nullify_columns(
+            bdb, 't', ['NaN', -1, "''"], batch=2)
+        assert counts == {'a': 1, 'b': 2, 'c': 2}
+        assert utils_bql.nullify(bdb, 't', 3) == 1
+        cursor = bdb.sql_execute('SELECT a, b, c FROM t')
+        assert cursor.fetchall() == [
+            (1, None, 1.5), (None, 'x', None), (None, None, None)]
+
+
+def test_sample_table_rows():
+    with bayesdb_open(':memory:', builtin_backends=False) as bdb:
+        bdb.sql_execute('CREATE TABLE t (x, y)')
+        for i in xrange(1000):
+            bdb.sql_execute('INSERT INTO t VALUES (?, ?)', (i, i % 7))
+        columns, rows, count = utils_bql.sample_table_rows(bdb, 't', 100, 1)
+        assert columns == ['x', 'y']
+        assert count == 1000
+        assert len(set(rows)) == 100
+        assert rows == sorted(rows)
+        assert all(y == x % 7 for x, y in rows)
+        assert utils_bql.sample_table_rows(bdb, 't', 100, 1)[1] == rows
+        _columns, rows, count = utils_bql.sample_table_rows(bdb, 't', 5000)
+        assert len(rows) == count == 1000
+
+
+def test_histogram_counts():
+    with bayesdb_open(':memory:', builtin_backends=False) as bdb:
+        bdb.sql_execute('CREATE TABLE t (x, l)')
+        for i in xrange(20):
+            bdb.sql_execute('INSERT INTO t VALUES (?, ?)',
+                (i if i < 19 else None, 'ab'[i % 2]))
+        df, counts, edges = utils_bql.histogram_counts(
+            bdb, 'SELECT x FROM t', bins=3)
+        assert list(df.columns) == ['x']
+        assert edges.tolist() == [0, 6, 12, 18]
+        assert df['x'].tolist() == [3, 9, 15]
+        assert counts.tolist() == [6, 6, 7]
+        df, counts, edges = utils_bql.histogram_counts(
+            bdb, 'SELECT l, x > 9 FROM t')
+        assert edges is None
+        assert sorted(zip(df['l'], df.iloc[:,1], counts)) == [
+            ('a', 0, 5), ('a', 1, 5), ('b', 0, 5), ('b', 1, 4)]
+        df, counts, edges = utils_bql.histogram_counts(
+            bdb, 'SELECT x, l FROM t', bins=3, bql=True)
+        assert list(df.columns) == ['x', 'l']
+        assert edges.tolist() == [0, 6, 12, 18]
+        assert sorted(zip(df['x'], df['l'], counts)) == [
+            (3, 'a', 3), (3, 'b', 3), (9, 'a', 3), (9, 'b', 3),
+            (15, 'a', 4), (15, 'b', 3)]
+
+
+def test_histogram_counts_text_numbers():
+    with bayesdb_open(':memory:', builtin_backends=False) as bdb:
+        bdb.sql_execute('CREATE TABLE t (x TEXT, y)')
+        for v in ['1', '2.5', ' 3 ', 'NaN', '-1e1', None, '4',
+                '1e', '1-2', '1.2.3', '+-1', 'inf', '.']:
+            bdb.sql_execute('INSERT INTO t VALUES (?, ?)', (v, v))
+        for column in ['x', 'y']:
+            df, counts, edges = utils_bql.histogram_counts(
+                bdb, 'SELECT %s FROM t' % (column,), bins=2)
+            assert edges.tolist() == [-10, -3, 4]
+            assert df[column].tolist() == [-6.5, .5]
+            assert counts.tolist() == [1, 4]
+
+
+def test_analyze_steps():
+    assert utils_bql.analyze_steps('SELECT * FROM t') is None
+    assert utils_bql.analyze_steps(
+        'ANALYZE m MODELS 0-1 FOR 3 ITERATIONS CHECKPOINT 2 ITERATIONS') == [
+            'ANALYZE m MODELS 0-1 FOR 1 ITERATIONS CHECKPOINT 2 ITERATIONS',
+        ] * 3
+    assert utils_bql.analyze_steps('analyze m for 12 seconds (OPTIMIZED)') == [
+        'analyze m for 5 SECONDS (OPTIMIZED)',
+        'analyze m for 5 SECONDS (OPTIMIZED)',
+        'analyze m for 2 SECONDS (OPTIMIZED)',
+    ]
+    assert len(utils_bql.analyze_steps('ANALYZE m FOR 1 MINUTE')) == 12
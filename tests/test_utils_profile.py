@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import pandas as pd
+
+from bayeslite import bayesdb_open
+from bayeslite.core import bayesdb_has_table
+
+from iventure import utils_bql
+from iventure import utils_mml
+from iventure import utils_profile
+
+
+def _populate(bdb):
+    bdb.sql_execute('CREATE TABLE t (id, a, b TEXT, c REAL, d)')
+    for i in xrange(50):
+        bdb.sql_execute('INSERT INTO t VALUES (?, ?, ?, ?, ?)',
+            (i, i % 3, 'x%d' % (i % 5,) if i % 7 else None, i * .5, 1))
+
+
+def test_profile_table():
+    with bayesdb_open(':memory:', builtin_backends=False) as bdb:
+        _populate(bdb)
+        profile = utils_profile.profile_table(bdb, 't', top_k=2)
+        assert profile['name'].tolist() == ['id', 'a', 'b', 'c', 'd']
+        assert profile['row_count'].tolist() == [50] * 5
+        assert profile['null_count'].tolist() == [0, 0, 8, 0, 0]
+        assert profile['distinct_count'].tolist() == [50, 3, 5, 50, 1]
+        assert profile['exact'].all()
+        assert profile['value_type'].tolist() == \
+            ['integer', 'integer', 'text', 'real', 'integer']
+        assert profile['min'].tolist() == [0, 0, 'x0', 0, 1]
+        assert profile['max'].tolist() == [49, 2, 'x4', 24.5, 1]
+        assert sorted(profile['top_values'][1]) == [(0, 17), (1, 17)]
+        assert not bayesdb_has_table(bdb, 'iventure_column_profile')
+
+
+def test_profile_table_bounded():
+    with bayesdb_open(':memory:', builtin_backends=False) as bdb:
+        _populate(bdb)
+        profile = utils_profile.profile_table(
+            bdb, 't', top_k=2, max_distinct=10, arraysize=7)
+        assert profile['exact'].tolist() == [False, True, True, False, True]
+        assert profile['distinct_count'][1] == 3
+        assert pd.isnull(profile['distinct_count'][0])
+        assert profile['min'].tolist() == [0, 0, 'x0', 0, 1]
+        assert profile['max'].tolist() == [49, 2, 'x4', 24.5, 1]
+        assert len(profile['top_values'][0]) <= 2
+
+
+def test_column_summary():
+    summary = utils_profile.ColumnSummary(capacity=4)
+    values = [0] * 50 + range(1, 40) + [None] * 3
+    for start in xrange(0, len(values), 5):
+        summary.update(values[start:start + 5])
+    profile = summary.profile(top_k=1)
+    assert not profile['exact']
+    assert profile['null_count'] == 3
+    assert profile['min'] == 0 and profile['max'] == 39
+    # Counts are low by at most the number of values over capacity / 2.
+    [(value, count)] = profile['top_values']
+    assert value == 0
+    assert 50 - 89 / 2 <= count <= 50
+
+
+def test_profile_readers():
+    with bayesdb_open(':memory:', builtin_backends=False) as bdb:
+        _populate(bdb)
+        df = utils_bql.cardinality(bdb, 't', ['A', 'c'])
+        assert df['distinct_count'].tolist() == [3, 50]
+        df = utils_bql.cardinality(bdb, 't')
+        assert df['distinct_count'].tolist() == [50, 3, 5, 50, 1]
+        cache = utils_bql.QueryCache()
+        profiles = utils_profile.ProfileCache(
+            lambda: cache.generation, max_distinct=10)
+        df = utils_bql.cardinality(bdb, 't', profiles=profiles)
+        assert df['distinct_count'].tolist() == [50, 3, 5, 50, 1]
+        # Any statement that may modify the bdb discards the profiles, even
+        # if it keeps the largest rowid.
+        utils_bql.query(bdb, 'UPDATE t SET a = 7 WHERE id = 3', cache=cache)
+        df = utils_bql.cardinality(bdb, 't', ['a'], profiles=profiles)
+        assert df['distinct_count'].tolist() == [4]
+        schema = utils_mml.guess_schema(bdb, 't', False)
+        assert 'NUMERICAL' in schema and '"c"' in schema
+
+
+def test_guess_sample_stattypes():
+    rows = [(i, i % 3, 'x%d' % (i,) if i < 10 else 'y') for i in xrange(100)]
+    guesses = utils_mml.guess_sample_stattypes(['a', 'b', 'c'], rows, seed=1)
+    assert [guess[0].lower() for guess in guesses[1:]] == [
+        'nominal', 'nominal']
+    assert guesses[1][2] == 1.
+    assert guesses[1][3] == 0.
+    # The ten singleton categories of c carry a tenth of the values.
+    assert guesses[2][3] == .1